@@ -0,0 +1,27 @@
+"""Add modified to response_type
+
+Revision ID: 5c1e7a9d3b42
+Revises: 4b9d28136e18
+Create Date: 2026-10-18 09:12:31.482113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1e7a9d3b42'
+down_revision = '4b9d28136e18'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('response_type', sa.Column(
+        'modified', sa.DateTime(), nullable=False,
+        server_default=sa.func.now()))
+    op.alter_column('response_type', 'modified', server_default=None)
+
+
+def downgrade():
+    op.drop_column('response_type', 'modified')
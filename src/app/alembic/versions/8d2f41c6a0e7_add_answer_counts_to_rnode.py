@@ -0,0 +1,34 @@
+"""Add answer counts to rnode
+
+Revision ID: 8d2f41c6a0e7
+Revises: 5c1e7a9d3b42
+Create Date: 2026-10-18 14:03:52.716204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2f41c6a0e7'
+down_revision = '5c1e7a9d3b42'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('rnode', sa.Column(
+        'n_questions', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('rnode', sa.Column(
+        'n_answers', sa.Integer(), nullable=False, server_default='0'))
+    op.alter_column('rnode', 'n_questions', server_default=None)
+    op.alter_column('rnode', 'n_answers', server_default=None)
+
+    # Mark all submissions as stale so the recalculation daemon fills in the
+    # new counts.
+    op.execute("UPDATE survey SET modified = now() AT TIME ZONE 'utc'")
+
+
+def downgrade():
+    op.drop_column('rnode', 'n_answers')
+    op.drop_column('rnode', 'n_questions')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import base64
+import functools
 import logging.config
 import os
 import re
@@ -13,7 +14,9 @@ import sqlalchemy.orm
 import tornado
 import tornado.httpclient
 import tornado.httpserver
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 
 import configure_logging  # noqa: F401
@@ -83,6 +86,11 @@ def parse_options():
         "analytics_id", default=os.environ.get('ANALYTICS_ID', ''),
         help="Google Analytics ID, leave blank to disable (default: '')")
 
+    tornado.options.define(
+        "processes", default=os.environ.get('PROCESSES') or '1',
+        help="Number of server processes to fork; 0 starts one per CPU "
+             "(default: 1)")
+
     tornado.options.parse_command_line()
 
 
@@ -179,6 +187,8 @@ def get_mappings():
         (r"/(manifest.json|css/user_style.css)",
             template.UnauthenticatedTemplateHandler, {
                 'path': '../client/'}),
+        (r"/ping/metrics.json",
+            protocol.PingMetricsHandler, {}),
         (r"/ping.*",
             protocol.PingHandler, {}),
 
@@ -308,7 +318,11 @@ def start_web_server():
     settings = get_settings()
     default_settings()
 
-    application = tornado.web.Application(get_mappings(), **settings)
+    processes = int(tornado.options.options.processes)
+    if processes != 1 and settings['debug']:
+        # Each worker would restart on its own when files change.
+        log.warning("Autoreload is disabled when running multiple processes")
+        settings['autoreload'] = False
 
     try:
         # If port is a string, *some* GNU/Linux systems try to look up the port
@@ -344,9 +358,16 @@ def start_web_server():
         # https://blog.qualys.com/ssllabs/2014/10/15/ssl-3-is-dead-killed-by-the-poodle-attack
         ssl_opts['ciphers'] = 'DEFAULT:!SSLv2:!SSLv3:!RC4:!EXPORT:!DES'
 
+    # Bind before forking so that all workers accept connections on the same
+    # socket.
+    sockets = tornado.netutil.bind_sockets(port)
+    if processes != 1:
+        fork_workers(processes)
+
+    application = tornado.web.Application(get_mappings(), **settings)
     http_server = tornado.httpserver.HTTPServer(
         application, max_body_size=max_buffer_size, ssl_options=ssl_opts)
-    http_server.listen(port)
+    http_server.add_sockets(sockets)
 
     if log.isEnabledFor(logging.INFO):
         log.info("Tornado version: %s", tornado.version)
@@ -373,6 +394,48 @@ def start_web_server():
     tornado.ioloop.IOLoop.instance().start()
 
 
+def fork_workers(processes):
+    '''
+    Forks the worker processes. This only returns in the workers; the parent
+    process waits for them, restarting any that crash.
+    '''
+    # Database connections must not be shared between processes, so each
+    # worker connects again after the fork.
+    model.dispose_engines()
+
+    # Lead a new process group, so that forwarded signals only reach this
+    # process and its workers - not a wrapper shell or supervisor that
+    # started it. This fails if the process already leads its session, in
+    # which case the group is already its own.
+    try:
+        os.setpgrp()
+    except PermissionError:
+        pass
+
+    signal.signal(
+        signal.SIGTERM, functools.partial(forward_signal, os.getpid()))
+    task_id = tornado.process.fork_processes(processes)
+    # The parent's handler would forward the signal to the whole group.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    log.info("Started worker %d", task_id)
+    connect_db()
+    signal.signal(signal.SIGTERM, signal_handler)
+
+
+def forward_signal(parent_pid, signum, frame):
+    '''
+    Passes a signal sent to the parent process on to the workers. They exit
+    cleanly, after which the parent exits too.
+    '''
+    if os.getpid() != parent_pid:
+        # A worker that was signalled before it replaced this handler.
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+        return
+    signal.signal(signum, signal.SIG_IGN)
+    os.killpg(0, signum)
+
+
 def signal_handler(signum, frame):
     tornado.ioloop.IOLoop.instance().add_callback_from_signal(stop_web_server)
 
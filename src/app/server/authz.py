@@ -3,8 +3,6 @@
 import logging
 import re
 
-from munch import DefaultMunch
-
 from undefined import undefined
 
 
@@ -15,8 +13,7 @@ class Policy:
     def __init__(
             self, context=None, rules=None, error_factory=None, aspect=None):
         self.rules = rules if rules is not None else {}
-        self.context = context if context is not None else DefaultMunch(
-            undefined)
+        self.context = context if context is not None else Context()
         self.error_factory = error_factory if error_factory else AccessDenied
         self.aspect = aspect
 
@@ -33,14 +30,19 @@ class Policy:
 
     def copy(self):
         return Policy(
-            DefaultMunch(undefined, self.context),
+            Context(self.context.flatten()),
             self.rules.copy(),
             self.error_factory, self.aspect)
 
     def derive(self, context):
-        policy = self.copy()
-        policy.context.update(context)
-        return policy
+        '''
+        Create a policy with extra context. The new policy shares its rules
+        with this one, and looks up names that are not in the new context in
+        this policy's context.
+        '''
+        return Policy(
+            Context(context, parent=self.context), self.rules,
+            self.error_factory, self.aspect)
 
     def _check(self, rule_name, context):
         rule = self.rules.get(rule_name)
@@ -58,12 +60,14 @@ class Policy:
         return False
 
     def permission(self, rule_name):
-        context = self.context.copy()
-        context['_authz'] = lambda rule_name: self._check(rule_name, context)
-        context['len'] = lambda xs: len(xs)
-        context['_failures'] = []
+        failures = []
+        context = Context({
+            '_authz': lambda rule_name: self._check(rule_name, context),
+            'len': len,
+            '_failures': failures,
+        }, parent=self.context)
         success = self._check(rule_name, context)
-        return Permission(rule_name, success, context, context['_failures'])
+        return Permission(rule_name, success, context, failures)
 
     def check(self, *rule_names, match='ANY'):
         permissions = [self.permission(rule_name) for rule_name in rule_names]
@@ -88,6 +92,39 @@ class Policy:
             raise self.error_factory(str(permission))
 
 
+class Context(dict):
+    '''
+    Names that rule expressions can refer to. Names that are missing are
+    looked up in the parent context, and are undefined if no context has
+    them. Deriving a context is cheap, because the parent is not copied.
+    '''
+
+    def __init__(self, values=None, parent=None):
+        super().__init__(values or {})
+        self.parent = parent
+
+    def __missing__(self, key):
+        if self.parent is None:
+            return undefined
+        return self.parent[key]
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return self[key]
+
+    def flatten(self):
+        if isinstance(self.parent, Context):
+            context = self.parent.flatten()
+        else:
+            context = dict(self.parent or {})
+        context.update(self)
+        return context
+
+    def __repr__(self):
+        return 'Context(%r)' % self.flatten()
+
+
 class Permission:
     def __init__(self, rule_name, success, context, failures):
         self.rule_name = rule_name
@@ -121,12 +158,17 @@ class Rule:
         expression = self.translate_exp(expression)
         expression = self.interpolate(expression)
         self._expression = expression
+        try:
+            self._code = compile(expression, '<rule %s>' % name, 'eval')
+        except SyntaxError:
+            # Report the error when the rule is checked, like other errors in
+            # the expression.
+            self._code = expression
 
     def check(self, context):
         # This is not secure - but user-defined expressions should not be used.
         # Only the contents of context may be user-provided.
-        # print(self.name, context)
-        return eval(self._expression, {'__builtins__': {}}, context)
+        return eval(self._code, {'__builtins__': {}}, context)
 
     def translate_exp(self, expression):
         # Grammar is already the same as Python expressions
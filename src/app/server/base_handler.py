@@ -1,23 +1,24 @@
 import logging
 from math import ceil
+import os
 import re
 
-from expiringdict import ExpiringDict
 import sqlalchemy.exc
 from sqlalchemy.orm import joinedload
+from tornado import gen
 from tornado.escape import json_decode
 import tornado.options
 import tornado.web
 
 import errors
 import model
-from session import UserSession
+from session import identities, Identity, UserSession
 from utils import denormalise, truthy
 
 log = logging.getLogger('app.base_handler')
 
-
-cache = ExpiringDict(max_len=100, max_age_seconds=10)
+# Files are sent in chunks of this size (bytes)
+CHUNK_SIZE = 256 * 1024
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -35,36 +36,84 @@ class BaseHandler(tornado.web.RequestHandler):
             return
 
     def get_current_user(self):
-        with model.session_scope() as session:
-            return self.get_user_session(session)
+        identity, _ = self.get_identities()
+        return identity
 
     USER_IDS_PATTERN = re.compile(r'^user=([-\w]*)(?:, ?superuser=([-\w]*))?$')
 
-    def get_user_session(self, db_session):
-        # TODO: Currently, this is done twice: once for authentication, and
-        # again for authorisation. Because the database session is closed in
-        # get_current_user, the user session object can't be used in the
-        # request handler methods. Is there some way to do it without closing
-        # the session?
+    def get_user_ids(self):
         user_ids = self.get_secure_cookie('user')
         if not user_ids:
-            return None
+            return None, None
         user_ids = user_ids.decode('utf8')
 
         match = self.USER_IDS_PATTERN.match(user_ids)
         if not match:
-            return None
-        user_id, superuser_id = match.groups()
+            return None, None
+        return match.groups()
+
+    def get_identities(self):
+        '''
+        Check the user (and superuser, when impersonating) named in the
+        session cookie. Identities are cached across requests, so this
+        usually doesn't touch the database.
+        @return the identities of the user and superuser; the user's is None
+            if the session is not valid
+        '''
+        user_id, superuser_id = self.get_user_ids()
+        if not user_id:
+            return None, None
+
+        ids = [i for i in (user_id, superuser_id) if i]
+        with model.session_scope() as db_session:
+            found = identities.get(db_session, ids)
+
+        if superuser_id:
+            super_identity = found.get(superuser_id)
+            if not super_identity:
+                # True user's session has expired.
+                return None, None
+            if super_identity.deleted:
+                raise errors.AuthzError("Your account has been disabled")
+        else:
+            super_identity = None
+
+        identity = found.get(user_id)
+        if not identity:
+            return None, None
+        if identity.deleted:
+            raise errors.AuthzError("Your account has been disabled")
 
+        return identity, super_identity
+
+    def get_user_session(self, db_session):
+        # The user session is kept for the rest of the request, for each
+        # database session that asks for it.
+        try:
+            user_sessions = self._user_sessions
+        except AttributeError:
+            user_sessions = self._user_sessions = {}
+        if db_session in user_sessions:
+            return user_sessions[db_session]
+
+        user_id, superuser_id = self.get_user_ids()
         if not user_id:
             return None
 
+        # Load the user and superuser together. These rows are checked again
+        # here rather than trusting the cached identities, which may be a
+        # few seconds old.
+        ids = {i for i in (user_id, superuser_id) if i}
+        users = {
+            str(user.id): user for user in
+            db_session.query(model.AppUser)
+            .options(joinedload('organisation'))
+            .options(joinedload('surveygroups'))
+            .filter(model.AppUser.id.in_(ids))}
+        identities.update(Identity.from_user(u) for u in users.values())
+
         if superuser_id:
-            superuser = (
-                db_session.query(model.AppUser)
-                .options(joinedload('organisation'))
-                .options(joinedload('surveygroups'))
-                .get(superuser_id))
+            superuser = users.get(superuser_id)
             if not superuser:
                 # True user's session has expired.
                 return None
@@ -73,11 +122,7 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             superuser = None
 
-        user = (
-            db_session.query(model.AppUser)
-            .options(joinedload('organisation'))
-            .options(joinedload('surveygroups'))
-            .get(user_id))
+        user = users.get(user_id)
         if not user:
             return None
         if user.deleted or user.organisation.deleted:
@@ -93,6 +138,7 @@ class BaseHandler(tornado.web.RequestHandler):
             })
             policy.verify('user_impersonate')
 
+        user_sessions[db_session] = user_session
         return user_session
 
     @property
@@ -125,6 +171,22 @@ class BaseHandler(tornado.web.RequestHandler):
         message = BaseHandler._INVALID_HEADER_CHAR_RE.sub('; ', message)
         self.add_header("Operation-Details", message)
 
+    @gen.coroutine
+    def write_file(self, f):
+        '''
+        Sends the contents of a file object. Each chunk is flushed before the
+        next is read, so the response is never held in memory as a whole.
+        '''
+        f.seek(0, os.SEEK_END)
+        self.set_header('Content-Length', f.tell())
+        f.seek(0)
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            self.write(data)
+            yield self.flush()
+
     def log_exception(self, typ, value, tb):
         # Print stack trace for InternalModelErrors, since they are very
         # similar to uncaught errors.
@@ -0,0 +1,447 @@
+'''
+Recalculates the scores of many submissions of a survey at once.
+
+The per-submission Calculator walks the survey graph node by node, which is
+fine when one response changes but slow when a structural change makes every
+submission of a survey stale. The BatchCalculator instead holds the responses
+of a batch of submissions in arrays indexed by (measure, submission):
+
+- Measures whose score is a plain function of the response (multiple choice
+parts without conditions, and numerical parts with constant bounds) are scored
+with array operations.
+
+- Measures that need expressions to be evaluated (formulas, option
+conditions, variable bounds or bindings to other measures) are scored one
+response at a time with the usual ResponseOps, in dependency order.
+
+- Rnode aggregates are rolled up the qnode tree one level at a time, using a
+parent index array and `np.add.at`.
+
+The results are the same as scoring each submission with
+`Calculator.scoring` after marking the entire survey dirty.
+'''
+
+import numpy as np
+from sqlalchemy.orm.session import object_session
+
+import model
+from response_type import MultipleChoice, Numerical, response_types
+from score import Calculator, compiled_survey_graph, count_answers, \
+    node_key, QnodeOps, ResponseOps, SurveyOps, SurveyStructure
+
+
+APPROVAL_RANKS = {'draft': 1, 'final': 2, 'reviewed': 3, 'approved': 4}
+
+# Counters that are summed up the tree, and the minimum approval rank of a
+# response that is counted by each one.
+APPROVAL_COUNTS = [
+    ('n_draft', 1),
+    ('n_final', 2),
+    ('n_reviewed', 3),
+    ('n_approved', 4),
+]
+
+
+class BatchCalculator:
+    '''
+    Scores a batch of submissions of one survey. All submissions must belong
+    to the survey, and are scored in the survey's session.
+    '''
+
+    def __init__(self, survey, submissions):
+        self.survey = survey
+        self.submissions = list(submissions)
+
+    def execute(self):
+        if not self.submissions:
+            return
+
+        compiled = compiled_survey_graph(self.survey)
+        if not compiled.acyclic:
+            # Cyclic dependencies are reported by the graph evaluator.
+            for submission in self.submissions:
+                calculator = Calculator.scoring(submission, preload=True)
+                calculator.mark_entire_survey_dirty(self.survey)
+                calculator.execute()
+            return
+
+        session = object_session(self.survey)
+        # Hold the structure so the linked relationships stay in the session.
+        self.structure = SurveyStructure(self.survey)
+        self.tree = QnodeTree(self.survey)
+        self.load_responses(session)
+        self.load_rnodes(session)
+        with session.no_autoflush:
+            self.score_responses(compiled)
+            self.roll_up()
+        session.flush()
+
+    def load_responses(self, session):
+        tree = self.tree
+        columns = {s.id: j for j, s in enumerate(self.submissions)}
+        rows = {qm.measure_id: m for m, qm in enumerate(tree.qnode_measures)}
+        shape = (len(tree.qnode_measures), len(self.submissions))
+
+        self.responses = [[None] * shape[1] for _ in range(shape[0])]
+        self.rows = rows
+        self.present = np.zeros(shape, dtype=bool)
+        self.not_relevant = np.zeros(shape, dtype=int)
+        self.approval = np.zeros(shape, dtype=int)
+        self.n_questions = np.zeros(shape, dtype=int)
+        self.n_answers = np.zeros(shape, dtype=int)
+
+        responses = (
+            session.query(model.Response)
+            .filter(model.Response.submission_id.in_(list(columns)),
+                    model.Response.program_id == self.survey.program_id,
+                    model.Response.survey_id == self.survey.id)
+            .all())
+        for response in responses:
+            m = rows.get(response.measure_id)
+            if m is None:
+                continue
+            j = columns[response.submission_id]
+            self.responses[m][j] = response
+            self.present[m, j] = True
+            self.not_relevant[m, j] = bool(response.not_relevant)
+            self.approval[m, j] = APPROVAL_RANKS.get(response.approval, 0)
+            parts = tree.qnode_measures[m].measure.response_type.parts
+            self.n_questions[m, j], self.n_answers[m, j] = count_answers(
+                parts, response.response_parts)
+
+    def load_rnodes(self, session):
+        '''
+        Find the rnodes of every qnode in every submission, and insert the
+        missing ones with a single flush.
+        '''
+        tree = self.tree
+        columns = {s.id: j for j, s in enumerate(self.submissions)}
+        rows = {qnode.id: i for i, qnode in enumerate(tree.qnodes)}
+
+        self.rnodes = [[None] * len(self.submissions) for _ in tree.qnodes]
+        rnodes = (
+            session.query(model.ResponseNode)
+            .filter(model.ResponseNode.submission_id.in_(list(columns)))
+            .all())
+        for rnode in rnodes:
+            i = rows.get(rnode.qnode_id)
+            if i is not None:
+                self.rnodes[i][columns[rnode.submission_id]] = rnode
+
+        for qnode, row in zip(tree.qnodes, self.rnodes):
+            for j, submission in enumerate(self.submissions):
+                if row[j] is not None:
+                    continue
+                rnode = model.ResponseNode(program=qnode.program, qnode=qnode)
+                rnode.submission_id = submission.id
+                session.add(rnode)
+                row[j] = rnode
+        session.flush()
+
+    def score_responses(self, compiled):
+        tree = self.tree
+        shape = self.present.shape
+        self.score = np.zeros(shape)
+        self.error = np.zeros(shape, dtype=int)
+
+        ops = [
+            ResponseOps(submission, BatchLookup(self, j))
+            for j, submission in enumerate(self.submissions)]
+        has_quality = self.survey.program.has_quality
+
+        # Array-scored measures don't depend on other measures, so they can
+        # all go first. The rest are scored in dependency order.
+        deferred = []
+        for m, qnode_measure in enumerate(tree.qnode_measures):
+            response_type = response_types.get(
+                qnode_measure.measure.response_type)
+            if (qnode_measure.source_vars or
+                    not ArrayResponseType.supports(response_type)):
+                deferred.append(m)
+                continue
+            array_type = ArrayResponseType(response_type)
+            self.score_measure(m, array_type, has_quality, ops)
+
+        depth = lambda m: self.depth(compiled, tree.qnode_measures[m])
+        for m in sorted(deferred, key=depth):
+            self.score_measure(m, None, has_quality, ops)
+
+    def depth(self, compiled, qnode_measure):
+        key = node_key(qnode_measure)
+        if key not in compiled:
+            compiled = compiled_survey_graph(self.survey, refresh=True)
+        return compiled.depths[compiled.indices[key]]
+
+    def score_measure(self, m, array_type, has_quality, ops):
+        '''
+        Score one measure in every submission. Responses that can't be scored
+        with the array type (e.g. because they are invalid or not relevant)
+        are passed to the submission's ResponseOps instead, so that their
+        errors are reported in the usual way.
+        '''
+        qnode_measure = self.tree.qnode_measures[m]
+        columns = []
+        values = []
+        for j, response in enumerate(self.responses[m]):
+            if response is None:
+                continue
+            if array_type is not None and not response.not_relevant and not (
+                    has_quality and (
+                        response.quality is None or response.quality <= 0)):
+                parts = array_type.extract(response.response_parts)
+                if parts is not None:
+                    columns.append(j)
+                    values.append(parts)
+                    continue
+            self.score_response(m, j, qnode_measure, ops[j])
+
+        if not columns:
+            return
+
+        raw, valid = array_type.score(values)
+        weight = qnode_measure.measure.weight
+        weighted = raw * weight
+        for j, parts, r, w, ok in zip(
+                columns, values, raw.tolist(), weighted.tolist(),
+                valid.tolist()):
+            if not ok:
+                self.score_response(m, j, qnode_measure, ops[j])
+                continue
+            response = self.responses[m][j]
+            variables = array_type.variables(parts)
+            variables['_raw'] = r
+            variables['_score'] = w
+            variables['_weight'] = weight
+            response.score = w
+            response.variables = variables
+            response.error = None
+            self.score[m, j] = w
+
+    def score_response(self, m, j, qnode_measure, ops):
+        response = self.responses[m][j]
+        ops.evaluate(qnode_measure, None, None)
+        self.score[m, j] = response.score
+        self.error[m, j] = bool(response.error)
+
+    def roll_up(self):
+        '''
+        Sum the response scores and counters up the qnode tree, deepest level
+        first, and write them to the rnodes.
+        '''
+        tree = self.tree
+        shape = (len(tree.qnodes), len(self.submissions))
+        present = self.present
+        contributions = {
+            'score': np.where(present, self.score, 0.0),
+            'n_not_relevant': self.not_relevant,
+            'n_questions': self.n_questions,
+            'n_answers': self.n_answers,
+        }
+        for field, rank in APPROVAL_COUNTS:
+            contributions[field] = (self.approval >= rank).astype(int)
+        sums = {
+            field: np.zeros(shape, dtype=values.dtype)
+            for field, values in contributions.items()}
+        n_measure_errors = np.zeros(shape, dtype=int)
+        n_child_errors = np.zeros(shape, dtype=int)
+        has_error = np.zeros(shape, dtype=int)
+        # Maximum importance of the children; see ResponseNodeStats.
+        child_importance = np.zeros(shape)
+        max_importance = np.zeros(shape)
+
+        qnode_ops = QnodeOps()
+        for depth in reversed(range(len(tree.levels))):
+            nodes = tree.levels[depth]
+            measures = tree.level_measures[depth]
+            owners = tree.measure_qnodes[measures]
+
+            # Children have already been added, so the responses come after
+            # them, just as in ResponseNodeStats.
+            for field, total in sums.items():
+                np.add.at(total, owners, contributions[field][measures])
+            np.add.at(n_measure_errors, owners, self.error[measures])
+
+            for i in range(nodes.start, nodes.stop):
+                scores = sums['score'][i].tolist()
+                counts = {
+                    field: sums[field][i].tolist() for field in sums
+                    if field != 'score'}
+                stat_importance = child_importance[i].tolist()
+                n_children = n_child_errors[i].tolist()
+                n_measures = n_measure_errors[i].tolist()
+                for j, rnode in enumerate(self.rnodes[i]):
+                    rnode.score = scores[j]
+                    for field, values in counts.items():
+                        setattr(rnode, field, values[j])
+                    rnode.max_importance = (
+                        rnode.importance or stat_importance[j])
+                    # Matches ResponseNodeStats, which derives the maximum
+                    # urgency from the children's importance.
+                    rnode.max_urgency = rnode.urgency or stat_importance[j]
+                    qnode_ops.errors(rnode, n_children[j], n_measures[j])
+                    max_importance[i, j] = rnode.max_importance
+                    has_error[i, j] = bool(rnode.error)
+
+            if depth == 0:
+                continue
+            parents = tree.parents[nodes]
+            for field, total in sums.items():
+                np.add.at(total, parents, total[nodes])
+            np.add.at(n_child_errors, parents, has_error[nodes])
+            np.maximum.at(child_importance, parents, max_importance[nodes])
+
+        survey_ops = SurveyOps()
+        n_errors = has_error[tree.levels[0]].sum(axis=0).tolist()
+        for submission, n in zip(self.submissions, n_errors):
+            survey_ops.errors(submission, n)
+
+
+class QnodeTree:
+    '''
+    The qnodes of a survey in breadth-first order, so that each level of the
+    tree is a contiguous range of indices. The qnode measures are ordered the
+    same way, so each level's measures are also contiguous.
+    '''
+
+    def __init__(self, survey):
+        self.qnodes = []
+        self.levels = []
+        self.qnode_measures = []
+        self.level_measures = []
+        parents = []
+        measure_qnodes = []
+
+        level = [(-1, qnode) for qnode in survey.qnodes]
+        while level:
+            start = len(self.qnodes)
+            measure_start = len(self.qnode_measures)
+            next_level = []
+            for parent, qnode in level:
+                i = len(self.qnodes)
+                self.qnodes.append(qnode)
+                parents.append(parent)
+                for qnode_measure in qnode.qnode_measures:
+                    self.qnode_measures.append(qnode_measure)
+                    measure_qnodes.append(i)
+                next_level.extend((i, child) for child in qnode.children)
+            self.levels.append(slice(start, len(self.qnodes)))
+            self.level_measures.append(
+                slice(measure_start, len(self.qnode_measures)))
+            level = next_level
+
+        self.parents = np.array(parents, dtype=int)
+        self.measure_qnodes = np.array(measure_qnodes, dtype=int)
+
+
+class ArrayResponseType:
+    '''
+    Scores many responses to a response type with array operations. Only
+    response types whose scores don't depend on expressions are supported.
+    '''
+
+    def __init__(self, response_type):
+        self.parts = response_type.parts
+        self.option_scores = []
+        self.bounds = []
+        for part in self.parts:
+            if isinstance(part, MultipleChoice):
+                self.option_scores.append(
+                    np.array([option.score for option in part.options]))
+                self.bounds.append(None)
+            else:
+                self.option_scores.append(None)
+                self.bounds.append((part.lower({}), part.upper({})))
+
+    @staticmethod
+    def supports(response_type):
+        if response_type.formula is not None:
+            return False
+        for part in response_type.parts:
+            if isinstance(part, MultipleChoice):
+                if any(option.predicate for option in part.options):
+                    return False
+            elif isinstance(part, Numerical):
+                if part.free_vars:
+                    return False
+                try:
+                    part.lower({})
+                    part.upper({})
+                except Exception:
+                    return False
+            else:
+                return False
+        return True
+
+    def extract(self, response_parts):
+        '''
+        Returns:
+            The chosen option index or the value of each part, or None if the
+            response isn't well-formed.
+        '''
+        if (not isinstance(response_parts, list) or
+                len(response_parts) < len(self.parts)):
+            return None
+        values = []
+        for part, part_r in zip(self.parts, response_parts):
+            if not isinstance(part_r, dict):
+                return None
+            if isinstance(part, MultipleChoice):
+                value = part_r.get('index')
+                if (type(value) is not int or
+                        not 0 <= value < len(part.options)):
+                    return None
+            else:
+                value = part_r.get('value')
+                if type(value) not in (int, float):
+                    return None
+            values.append(value)
+        return values
+
+    def score(self, values):
+        '''
+        Returns:
+            (raw, valid): the raw score of each response, and whether each one
+            is within the bounds of its numerical parts.
+        '''
+        raw = np.zeros(len(values))
+        valid = np.ones(len(values), dtype=bool)
+        for p, (option_scores, bounds) in enumerate(
+                zip(self.option_scores, self.bounds)):
+            column = [parts[p] for parts in values]
+            if option_scores is not None:
+                raw += option_scores[np.array(column, dtype=int)]
+            else:
+                column = np.array(column, dtype=float)
+                lower, upper = bounds
+                valid &= (column >= lower) & (column <= upper)
+                raw += column
+        return raw, valid
+
+    def variables(self, values):
+        variables = {}
+        for part, value in zip(self.parts, values):
+            if not part.id_:
+                continue
+            if isinstance(part, MultipleChoice):
+                variables[part.id_] = part.options[value].score
+                variables[part.id_ + '__i'] = value
+            else:
+                variables[part.id_] = value
+        return variables
+
+
+class BatchLookup:
+    '''
+    Serves the responses of one submission of a batch to ResponseOps.
+    '''
+
+    def __init__(self, calculator, column):
+        self.calculator = calculator
+        self.column = column
+
+    def response(self, qnode_measure):
+        m = self.calculator.rows.get(qnode_measure.measure_id)
+        if m is None:
+            return None
+        return self.calculator.responses[m][self.column]
+
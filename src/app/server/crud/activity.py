@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 import time
@@ -11,13 +10,12 @@ import tornado.web
 from activity import Activities
 import base_handler
 import errors
+import executors
 import model
 from surveygroup_actions import assign_surveygroups
 from utils import ToSon, updater
 
 
-MAX_WORKERS = 4
-
 log = logging.getLogger('app.crud.activity')
 
 
@@ -39,7 +37,7 @@ def perf():
 
 class ActivityHandler(base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('io')
 
     TO_SON = ToSon(
         r'/id$',
@@ -7,7 +7,6 @@ import botocore
 from tornado.escape import json_encode
 from tornado import gen
 import tornado.web
-from concurrent.futures import ThreadPoolExecutor
 
 import aws
 import base_handler
@@ -18,8 +17,6 @@ from utils import ToSon
 
 log = logging.getLogger('app.crud.attachment')
 
-MAX_WORKERS = 4
-
 
 class AttachmentHandler(base_handler.Paginate, base_handler.BaseHandler):
 
@@ -83,8 +80,6 @@ class AttachmentHandler(base_handler.Paginate, base_handler.BaseHandler):
 class ResponseAttachmentsHandler(
         base_handler.Paginate, base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-
     @tornado.web.authenticated
     def put(self, submission_id, measure_id):
         son = self.request_son
@@ -250,8 +245,6 @@ class ResponseAttachmentsHandler(
 class ResponseSubmeasureAttachmentsHandler(
         base_handler.Paginate, base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-
     @tornado.web.authenticated
     def put(self, submission_id, measure_id, submeasure_id):
         son = self.request_son
@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
 import logging
 
 from tornado import gen
@@ -9,6 +8,7 @@ import tornado.web
 import base_handler
 import config
 import errors
+import executors
 import model
 import image
 
@@ -16,7 +16,6 @@ from utils import to_camel_case, to_snake_case, ToSon
 
 
 log = logging.getLogger('app.crud.config')
-MAX_WORKERS = 4
 
 
 class SystemConfigHandler(base_handler.BaseHandler):
@@ -65,7 +64,7 @@ class SystemConfigHandler(base_handler.BaseHandler):
 
 class SystemConfigItemHandler(base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('io')
 
     @tornado.web.authenticated
     def get(self, name):
@@ -1,17 +1,16 @@
-from concurrent.futures import ThreadPoolExecutor
-
 from tornado import gen
 from tornado.concurrent import run_on_executor
 
 import base_handler
 import errors
+import executors
 import image
 import model
 
 
 class IconHandler(base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=1)
+    executor = executors.get('icons')
 
     @gen.coroutine
     def get(self, size):
@@ -11,11 +11,10 @@ import voluptuous.error
 
 from activity import Activities
 import base_handler
-from cache import instance_method_lru_cache
 import errors
 import logging
 import model
-from response_type import ResponseType
+from response_type import response_types
 from score import Calculator
 from utils import falsy, reorder, ToSon, truthy, updater
 from response_type import ResponseTypeError
@@ -386,10 +385,8 @@ class MeasureHandler(base_handler.Paginate, base_handler.BaseHandler):
         #         declared_vars.append({'id': v, 'name': v})
         # return declared_vars
 
-    @instance_method_lru_cache()
     def get_response_type(self, response_type):
-        return ResponseType(
-            response_type.name, response_type.parts, response_type.formula)
+        return response_types.get(response_type)
 
     def query_children_of(self, qnode_id):
         program_id = self.get_argument('programId', '')
@@ -1969,6 +1966,7 @@ class MeasureHandler(base_handler.Paginate, base_handler.BaseHandler):
             # Check if modified now to avoid problems with autoflush later
             if session.is_modified(response_type):
                 verbs.append('update')
+                response_types.invalidate(response_type)
                 calculator = Calculator.structural()
                 for measure in response_type.measures:
                     for qnode_measure in measure.qnode_measures:
@@ -13,6 +13,7 @@ import errors
 import model
 
 from cache import LruCache
+from session import identities
 from surveygroup_actions import assign_surveygroups, filter_surveygroups
 from utils import ToSon, truthy, updater
 
@@ -212,6 +213,8 @@ class OrgHandler(base_handler.Paginate, base_handler.BaseHandler):
             act.record(user_session.user, org, verbs)
             act.ensure_subscription(user_session.user, org, org, self.reason)
 
+        # Users of this organisation may have been enabled or disabled
+        identities.clear()
         self.get(organisation_id)
 
     @tornado.web.authenticated
@@ -240,6 +243,7 @@ class OrgHandler(base_handler.Paginate, base_handler.BaseHandler):
 
             org.deleted = True
 
+        identities.clear()
         self.finish()
 
     def _update(self, org, son):
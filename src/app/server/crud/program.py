@@ -1,17 +1,17 @@
-from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 
 from tornado import gen
-from tornado.concurrent import run_on_executor
 from tornado.escape import json_encode
 import tornado.web
-from sqlalchemy.orm import joinedload
-from sqlalchemy.orm.session import make_transient
+from sqlalchemy import and_, cast, exists, select, union
+from sqlalchemy.orm import aliased, joinedload
 
 from activity import Activities
 import base_handler
 import errors
+import executors
+import jobs
 import model
 from score import Calculator
 from surveygroup_actions import assign_surveygroups, filter_surveygroups
@@ -20,11 +20,40 @@ from utils import ToSon, truthy, updater
 
 log = logging.getLogger('app.crud.program')
 
-MAX_WORKERS = 4
+# Number of progress steps reported while duplicating a program
+DUPLICATION_STEPS = 6
+
+
+def live_qnodes(session, program_id):
+    '''
+    Build a recursive CTE of the qnodes of a program that are not deleted,
+    and that are not below a deleted qnode or in a deleted survey.
+    '''
+    QN1 = model.QuestionNode
+    start = (
+        session.query(QN1.id, QN1.program_id)
+        .join(model.Survey,
+              (model.Survey.id == QN1.survey_id) &
+              (model.Survey.program_id == QN1.program_id))
+        .filter(QN1.program_id == program_id,
+                QN1.parent_id == None,
+                QN1.deleted == False,
+                model.Survey.deleted == False)
+        .cte(name='live_qnode', recursive=True))
+
+    QN2 = aliased(model.QuestionNode, name='qnode2')
+    recurse = (
+        session.query(QN2.id, QN2.program_id)
+        .filter(QN2.parent_id == start.c.id,
+                QN2.program_id == start.c.program_id,
+                QN2.deleted == False))
+
+    cte = start.union_all(recurse)
+    return select([cte.c.id])
 
 
 class ProgramHandler(base_handler.Paginate, base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('imports')
 
     @tornado.web.authenticated
     def get(self, program_id):
@@ -184,7 +213,9 @@ class ProgramHandler(base_handler.Paginate, base_handler.BaseHandler):
                 policy.verify('surveygroup_interact')
                 policy.verify('program_view')
 
-                yield self.duplicate_structure(
+                yield jobs.run(
+                    self.executor, "Duplicate program",
+                    DUPLICATION_STEPS, self.duplicate_structure,
                     source_program, program, session)
                 source_program.finalised_date = datetime.datetime.utcnow()
                 act.record(user_session.user, source_program, ['state'])
@@ -197,86 +228,91 @@ class ProgramHandler(base_handler.Paginate, base_handler.BaseHandler):
 
         self.get(program_id)
 
-    @run_on_executor
-    def duplicate_structure(self, source_program, target_program, session):
+    def duplicate_structure(
+            self, job, source_program, target_program, session):
         '''
         Duplicate an existing program - just the structure (e.g. survey,
         qnodes and measures).
+
+        Each table is copied with a single INSERT ... SELECT, so the rows
+        never leave the database. Deleted surveys and qnodes (and everything
+        below them) are not copied, and neither are measures and response
+        types that are no longer used by the remaining structure.
         '''
         log.debug('Duplicating %s from %s', target_program, source_program)
 
         target_program.tracking_id = source_program.tracking_id
-
-        def dissociate(entity):
-            # Expunge followed by make_transient tells SQLAlchemy to use INSERT
-            # instead of UPDATE, thus duplicating the row in the table.
-            session.expunge(entity)
-            make_transient(entity)
-            session.add(entity)
-            return entity
-
-        def dup_surveys(surveys):
-            for survey in surveys:
-                if survey.deleted:
-                    continue
-                log.debug('Duplicating %s', survey)
-                qs = survey.qnodes
-                dissociate(survey)
-                survey.program_id = target_program.id
-                dup_qnodes(qs)
-
-        def dup_qnodes(qnodes):
-            for qnode in qnodes:
-                if qnode.deleted:
-                    continue
-                log.debug('Duplicating %s', qnode)
-                children = qnode.children
-                qnode_measures = qnode.qnode_measures
-                dissociate(qnode)
-                qnode.program_id = target_program.id
-                dup_qnodes(children)
-                dup_qnode_measures(qnode_measures)
-
-        # Measures are shared, so we keep track of which ones have already been
-        # duplicated.
-        processed_measure_ids = set()
-        processed_response_type_ids = set()
-
-        def dup_qnode_measures(qnode_measures):
-            for qnode_measure in qnode_measures:
-                log.debug('Duplicating %s', qnode_measure)
-                if qnode_measure.measure_id not in processed_measure_ids:
-                    dup_measure(qnode_measure.measure)
-                for measure_variable in qnode_measure.source_vars:
-                    dup_variable(measure_variable)
-                dissociate(qnode_measure)
-                qnode_measure.program_id = target_program.id
-
-        def dup_variable(measure_variable):
-            log.debug('Duplicating %s', measure_variable)
-            if measure_variable.source_measure_id not in processed_measure_ids:
-                dup_measure(measure_variable.source_qnode_measure.measure)
-            if measure_variable.target_measure_id not in processed_measure_ids:
-                dup_measure(measure_variable.target_qnode_measure.measure)
-            dissociate(measure_variable)
-            measure_variable.program_id = target_program.id
-            session.add(measure_variable)
-
-        def dup_measure(measure):
-            log.debug('Duplicating %s', measure)
-            if measure.response_type_id not in processed_response_type_ids:
-                dup_response_type(measure.response_type)
-            dissociate(measure)
-            measure.program_id = target_program.id
-            processed_measure_ids.add(measure.id)
-
-        def dup_response_type(response_type):
-            log.debug('Duplicating %s', response_type)
-            dissociate(response_type)
-            response_type.program_id = target_program.id
-            processed_response_type_ids.add(response_type.id)
-
-        dup_surveys(source_program.surveys)
+        session.flush()
+
+        source_id = source_program.id
+        target_id = target_program.id
+
+        def copy_rows(entity, *criteria):
+            table = entity.__table__
+            columns = [
+                cast(target_id, col.type) if col.name == 'program_id'
+                else col
+                for col in table.c]
+            query = select(columns).where(
+                and_(table.c.program_id == source_id, *criteria))
+            insert = table.insert().from_select(
+                [col.name for col in table.c], query)
+            n_rows = session.execute(insert).rowcount
+            log.debug('Copied %d rows of %s', n_rows, table.name)
+
+        Survey = model.Survey
+        QuestionNode = model.QuestionNode
+        QnodeMeasure = model.QnodeMeasure
+        MeasureVariable = model.MeasureVariable
+        Measure = model.Measure
+
+        job.advance("surveys")
+        copy_rows(Survey, Survey.deleted == False)
+
+        job.advance("categories")
+        copy_rows(QuestionNode, QuestionNode.id.in_(
+            live_qnodes(session, source_id)))
+
+        # The new program's qnodes are exactly the live qnodes of the source
+        # program, so the rest of the structure is selected relative to them.
+        live_qnode_ids = select([QuestionNode.id]).where(
+            QuestionNode.program_id == target_id)
+        live_qnode_measures = (
+            select([QnodeMeasure.measure_id])
+            .where(and_(
+                QnodeMeasure.program_id == source_id,
+                QnodeMeasure.qnode_id.in_(live_qnode_ids))))
+        live_variables = exists().where(and_(
+            QnodeMeasure.program_id == source_id,
+            QnodeMeasure.survey_id == MeasureVariable.survey_id,
+            QnodeMeasure.measure_id == MeasureVariable.target_measure_id,
+            QnodeMeasure.qnode_id.in_(live_qnode_ids)))
+        live_measure_ids = union(
+            live_qnode_measures,
+            select([MeasureVariable.source_measure_id])
+            .where(and_(
+                MeasureVariable.program_id == source_id,
+                live_variables)))
+
+        job.advance("response types")
+        copy_rows(model.ResponseType, model.ResponseType.id.in_(
+            select([Measure.response_type_id])
+            .where(and_(
+                Measure.program_id == source_id,
+                Measure.id.in_(live_measure_ids)))))
+
+        job.advance("measures")
+        copy_rows(Measure, Measure.id.in_(live_measure_ids))
+
+        job.advance("measure links")
+        copy_rows(QnodeMeasure, QnodeMeasure.qnode_id.in_(live_qnode_ids))
+
+        job.advance("variables")
+        copy_rows(MeasureVariable, live_variables)
+
+        # The copied rows were never loaded, so anything the session holds
+        # for the new program is stale.
+        session.expire(target_program)
 
     @tornado.web.authenticated
     def delete(self, program_id):
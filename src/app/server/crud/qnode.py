@@ -17,6 +17,84 @@ from utils import reorder, ToSon, truthy, updater
 log = logging.getLogger('app.crud.qnode')
 
 
+def leaf_descendants(session, program_id, qnode_ids):
+    '''
+    Build a subquery that maps each of the given qnodes to the leaf
+    categories below it, using a recursive CTE like query_by_level. A qnode
+    that has no children maps to itself.
+    '''
+    QN1 = model.QuestionNode
+    start = (
+        session.query(
+            QN1.id.label('root_id'),
+            QN1.id,
+            QN1.program_id)
+        .filter(QN1.id.in_(qnode_ids),
+                QN1.program_id == program_id)
+        .cte(name='descendant', recursive=True))
+
+    QN2 = aliased(model.QuestionNode, name='qnode2')
+    recurse = (
+        session.query(
+            start.c.root_id,
+            QN2.id,
+            QN2.program_id)
+        .filter(QN2.parent_id == start.c.id,
+                QN2.program_id == start.c.program_id))
+
+    cte = start.union_all(recurse)
+
+    QN3 = aliased(model.QuestionNode, name='qnode3')
+    has_children = (
+        session.query(QN3)
+        .filter(QN3.parent_id == cte.c.id,
+                QN3.program_id == cte.c.program_id)
+        .exists())
+
+    return (
+        session.query(cte.c.root_id, cte.c.id, cte.c.program_id)
+        .filter(~has_children)
+        .subquery())
+
+
+def count_questions(session, program_id, qnode_ids):
+    '''
+    Count the questions of the measures below each of the given qnodes.
+    @return a map of qnode ID to question count
+    '''
+    if not qnode_ids:
+        return {}
+
+    leaves = leaf_descendants(session, program_id, qnode_ids)
+    rows = (
+        session.query(leaves.c.root_id, model.ResponseType.parts)
+        .select_from(leaves)
+        .join(model.QnodeMeasure,
+              (model.QnodeMeasure.qnode_id == leaves.c.id) &
+              (model.QnodeMeasure.program_id == leaves.c.program_id))
+        .join(model.Measure,
+              (model.Measure.id == model.QnodeMeasure.measure_id) &
+              (model.Measure.program_id == model.QnodeMeasure.program_id))
+        .join(model.ResponseType,
+              (model.ResponseType.id == model.Measure.response_type_id) &
+              (model.ResponseType.program_id == model.Measure.program_id))
+        .filter(model.Measure.deleted != True,
+                model.Measure.submeasure_seq >= 0)
+        .order_by(leaves.c.root_id, leaves.c.id, model.QnodeMeasure.seq))
+
+    counts = {}
+    for qnode_id, parts in rows:
+        question = counts.get(qnode_id, 0)
+        seq = 0
+        for p in parts:
+            if "submeasure_seq" in p and p["submeasure_seq"] > question:
+                seq = p["submeasure_seq"]
+            else:
+                question += 1
+        counts[qnode_id] = question + seq
+    return counts
+
+
 class QuestionNodeHandler(base_handler.Paginate, base_handler.BaseHandler):
 
     @tornado.web.authenticated
@@ -204,7 +282,8 @@ class QuestionNodeHandler(base_handler.Paginate, base_handler.BaseHandler):
             if user_session.user.role == 'clerk':
                 to_son.exclude(r'/total_weight$')
 
-            sons = to_son(query.all())
+            qnodes = query.all()
+            sons = to_son(qnodes)
             # test use session to keep status
             #status_session = self.get_secure_cookie('status')
             #status_ids = status_session.decode('utf8')
@@ -213,49 +292,10 @@ class QuestionNodeHandler(base_handler.Paginate, base_handler.BaseHandler):
             #    if son.id in status_array:
             #        son['hideDetail'] = True
             #####################################
-            for son in sons:
-                question=0
-                ids = []
-                pIds=[son.id]
-                
-                for pId in pIds:
-                    sIds = (
-                        session.query(model.QuestionNode)
-                        .filter(model.QuestionNode.parent_id == pId))
-                    if not sIds.first():
-                         ids.append(pId)
-                    else: 
-                        for cid in sIds:
-                            pIds.append(cid.id)
-                #qnodeMeasures = (
-                    #session.query(model.Measure, model.QnodeMeasure)
-                    #.filter(model.Measure.id == model.QnodeMeasure.measure_id)
-                    #.filter(model.QnodeMeasure.qnode_id.in_(ids))) 
-                qnodeMeasures = (
-                    session.query(model.Measure, model.QnodeMeasure)
-                        .filter(model.Measure.deleted != True)
-                        .filter(model.Measure.submeasure_seq >= 0)
-                        .filter(model.Measure.program_id == program_id)
-                        .filter(model.QnodeMeasure.program_id == model.Measure.program_id)
-                        .filter(model.Measure.id == model.QnodeMeasure.measure_id)
-                        .filter(model.QnodeMeasure.qnode_id.in_(ids))) 
-                        #.filter(model.QuestionMeasure.program_id == model.Program.id)
-                        #.filter(model.Program.deleted != True)
-                        #.order_by(model.QnodeMeasure.seq)) 
-                for qnodeMeasure in qnodeMeasures:
-                    rt = (
-                        session.query(model.ResponseType)
-                        .filter(model.ResponseType.id == qnodeMeasure.Measure.response_type_id)
-                        .filter(model.ResponseType.program_id == program_id)
-                        .first())
-                    seq = 0
-                    for p in rt.parts:
-                        if "submeasure_seq" in p and p["submeasure_seq"] > question:
-                            seq = p["submeasure_seq"]
-                        else:
-                            question += 1
-                    question = question + seq
-                son['nQuestion'] = question
+            n_questions = count_questions(
+                session, program_id, [qnode.id for qnode in qnodes])
+            for qnode, son in zip(qnodes, sons):
+                son['nQuestion'] = n_questions.get(qnode.id, 0)
 
             #    if son.id in status_array:
             #        son['hideDetail'] = True
@@ -9,7 +9,7 @@ import base_handler
 import errors
 import logging
 import model
-from response_type import ResponseTypeError
+from response_type import ResponseTypeError, response_types
 from score import Calculator
 from utils import ToSon, updater
 
@@ -361,6 +361,7 @@ class ResponseTypeHandler(base_handler.Paginate, base_handler.BaseHandler):
             # Check if modified now to avoid problems with autoflush later
             if session.is_modified(response_type):
                 verbs.append('update')
+                response_types.invalidate(response_type)
                 calculator = Calculator.structural()
                 for measure in response_type.measures:
                     for qnode_measure in measure.qnode_measures:
@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
 import logging
 
 from sqlalchemy import func
@@ -11,6 +10,7 @@ import tornado.web
 from activity import Activities
 import base_handler
 import errors
+import executors
 import model
 from response_type import ResponseTypeError
 from score import Calculator
@@ -23,12 +23,10 @@ import openpyxl as xl
 
 log = logging.getLogger('app.crud.rnode')
 
-MAX_WORKERS = 4
-
 
 class ResponseNodeHandler(base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('imports')
 
     @tornado.web.authenticated
     def get(self, submission_id, qnode_id):
@@ -86,7 +84,9 @@ class ResponseNodeHandler(base_handler.BaseHandler):
                     n_final=0,
                     n_reviewed=0,
                     n_approved=0,
-                    n_not_relevant=0)
+                    n_not_relevant=0,
+                    n_questions=0,
+                    n_answers=0)
 
             policy = user_session.policy.derive({
                 'org': submission.organisation,
@@ -201,92 +201,9 @@ class ResponseNodeHandler(base_handler.BaseHandler):
                     r'/total_weight$'
                 )
             sons = to_son(children)
-            
-
-
-            
-            for son in sons:
-                answer=0
-                ids = []
-                pIds=[son.qnode.id]
-                
-                for pId in pIds:
-                    sIds = (
-                        session.query(model.QuestionNode)
-                        .filter(model.QuestionNode.parent_id == pId))
-                    if not sIds.first():
-                         ids.append(pId)
-                    else: 
-                        for cid in sIds:
-                            pIds.append(cid.id)
-
-
-
-                #answerResponses = (
-                #    session.query(model.Response, model.Measure, model.QnodeMeasure)
-                #    .filter(model.Response.submission_id == submission_id)
-                #    .filter(model.Response.measure_id == model.Measure.id)
-                #    .filter(model.Measure.id == model.QnodeMeasure.measure_id)
-                #    .filter(model.QnodeMeasure.qnode_id.in_(ids)))  
-                answerResponses = (
-                    session.query(model.Response, model.Measure, model.QnodeMeasure)
-                    .filter(model.Response.submission_id == submission_id)
-                    .filter(model.Response.program_id == model.Measure.program_id)
-                    .filter(model.Response.measure_id == model.Measure.id)
-                    .filter(model.Measure.program_id == submission.program_id)
-                    .filter(model.QnodeMeasure.program_id == model.Measure.program_id)
-                    .filter(model.Measure.id == model.QnodeMeasure.measure_id)
-                    .filter(model.QnodeMeasure.qnode_id.in_(ids)))  
-                #for answerResponse in answerResponses:
-                #    if answerResponse.Response.variables != {}:
-                #        answer=answer+1
-                #son.qnode['nAnswer']=answer
-                question = 0
-                answer = 0    
-                for answerResponse in answerResponses:
-                    #if answerResponse.Response.variables != {}:
-                    if len(answerResponse.Response.response_parts)>0:
-                        #calculate answer question number
-                        hasAnswer = True
-                        seq = 0
-
-                        rt = answerResponse.Measure.response_type.parts
-                        for r, p in enumerate(rt):
-                            if (not 'submeasure_seq' in p ):
-                                if (seq > 0):
-                                    question += 1
-                                    if (hasAnswer):
-                                        answer += 1
-                                    else:
-                                        hasAnswer=True
-                                if ((answerResponse.Response.response_parts[r] is None or answerResponse.Response.response_parts[r] == {} or
-                                    ((not 'index' in answerResponse.Response.response_parts[r].keys()) and 
-                                    (not 'value' in answerResponse.Response.response_parts[r].keys()))) and hasAnswer):
-                                    hasAnswer=False    
-                            else:           
-                                if (hasAnswer or seq != p['submeasure_seq']):
-                                    if (seq != p['submeasure_seq']):
-                                        if (seq > 0):
-                                            question += 1
-                                            if (hasAnswer):
-                                                answer += 1
-                                            else:
-                                                hasAnswer=True
-
-                                        seq = p['submeasure_seq']
-                                    if (r >= 0 and r < len(answerResponse.Response.response_parts)):
-                                        if ((answerResponse.Response.response_parts[r] is None or answerResponse.Response.response_parts[r] == {} or
-                                            ((not 'index' in answerResponse.Response.response_parts[r].keys()) and 
-                                            (not 'value' in answerResponse.Response.response_parts[r].keys()))) and hasAnswer):
-                                            hasAnswer=False   
-                                    else :
-                                       hasAnswer=False      
-                  
-                        if (seq > 0 and  hasAnswer):
-                            answer += 1
-                            question += 1
-                    son.qnode['nAnswer']=answer
-                    son.qnode['nQuestion']=question
+            for rnode, son in zip(children, sons):
+                son.qnode['nAnswer'] = rnode.n_answers
+                son.qnode['nQuestion'] = rnode.n_questions
 
         self.set_header("Content-Type", "application/json")
         self.write(json_encode(sons))
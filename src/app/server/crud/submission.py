@@ -1,17 +1,19 @@
-from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 
 from tornado import gen
 from tornado.escape import json_encode
 import tornado.web
-from sqlalchemy.orm.session import make_transient
+from sqlalchemy import and_, bindparam, cast, literal, select
 
 from activity import Activities
 import base_handler
 import errors
+import executors
+import jobs
 import model
-from score import Calculator
+from model.guid import GUID
+from score import Calculator, SurveyStructure
 from utils import ToSon, truthy, updater
 from .approval import APPROVAL_STATES
 from surveygroup_actions import filter_surveygroups
@@ -19,11 +21,68 @@ from response_type import ResponseTypeError
 import os
 log = logging.getLogger('app.crud.submission')
 
-MAX_WORKERS = 4
+# Number of progress steps reported while duplicating a submission
+DUPLICATION_STEPS = 5
+
+
+def copy_rows_statement(table, overrides, *criteria):
+    '''
+    Build an INSERT ... SELECT that copies rows of a table, replacing the
+    values of some columns.
+    '''
+    columns = [overrides.get(col.name, col) for col in table.c]
+    return table.insert().from_select(
+        [col.name for col in table.c],
+        select(columns).where(and_(*criteria)))
+
+
+def copy_rows(session, table, overrides, *criteria):
+    return session.execute(
+        copy_rows_statement(table, overrides, *criteria)).rowcount
+
+
+def is_stale(submission):
+    '''
+    Whether the submission's scores are older than its survey's structure,
+    by the same rule as the recalculation daemon.
+    '''
+    survey_modified = submission.survey.modified
+    if survey_modified is None:
+        return False
+    return (
+        submission.modified is None or submission.modified < survey_modified)
+
+
+def qnode_signature(qnode):
+    '''
+    The parts of a qnode that its rnode's score is calculated from, apart
+    from the scores of its children.
+    '''
+    return (
+        qnode.parent_id,
+        frozenset(child.id for child in qnode.children),
+        frozenset(qm.measure_id for qm in qnode.qnode_measures))
+
+
+def measure_signature(qnode_measure):
+    '''
+    The parts of a measure that its response's score is calculated from,
+    apart from the response itself.
+    '''
+    measure = qnode_measure.measure
+    response_type = measure.response_type
+    return (
+        qnode_measure.qnode_id,
+        measure.weight,
+        response_type.parts,
+        response_type.formula,
+        sorted(
+            (var.source_measure_id, var.source_field, var.target_field)
+            for var in qnode_measure.source_vars))
 
 
 class SubmissionHandler(base_handler.Paginate, base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('imports')
 
     @tornado.web.authenticated
     def get(self, submission_id):
@@ -247,8 +306,10 @@ class SubmissionHandler(base_handler.Paginate, base_handler.BaseHandler):
             submission_id = str(submission.id)
 
             if source_submission:
-                yield SubmissionHandler.executor.submit(
-                    self.duplicate, submission, source_submission, session)
+                yield jobs.run(
+                    self.executor, "Duplicate submission",
+                    DUPLICATION_STEPS, self.duplicate,
+                    submission, source_submission, session)
 
             act = Activities(session)
             act.record(user_session.user, submission, ['create'])
@@ -258,76 +319,130 @@ class SubmissionHandler(base_handler.Paginate, base_handler.BaseHandler):
 
         self.get(submission_id)
 
-    def duplicate(self, submission, s_submission, session):
-        measure_ids = {
-            str(qm.measure_id)
-            for qm in submission.survey.ordered_qnode_measures}
-
-        qnode_ids = {str(q.id) for q in submission.survey.ordered_qnodes}
-
-        s_rnodes = (
-            session.query(model.ResponseNode)
-            .filter_by(submission_id=s_submission.id)
-            .filter(model.ResponseNode.qnode_id.in_(qnode_ids))
-            .all())
-
-        for rnode in s_rnodes:
-            if str(rnode.qnode_id) not in qnode_ids:
-                continue
-
-            # Duplicate
-            session.expunge(rnode)
-            make_transient(rnode)
-
-            # Customise
-            rnode.program = submission.program
-            rnode.submission = submission
-            session.add(rnode)
-            session.flush()
-            # No need to flush because no dependencies
-
-        for response in s_submission.responses:
-            if str(response.measure_id) not in measure_ids:
-                continue
-
-            attachments = list(response.attachments)
-
-            # Fetch lazy-loaded fields
-            response.comment
-
-            # Duplicate
-            session.expunge(response)
-            make_transient(response)
-
-            # Customise
-            response.submission_id = submission.id
-            response.program_id = submission.program_id
-            response.survey_id = submission.survey_id
-            response.approval = 'draft'
-
-            session.add(response)
-            session.flush()
-
-            # Same thing for attachments
-            for attachment in attachments:
-                # Fetch lazy-loaded fields
-                attachment.blob
-
-                # Duplicate
-                session.expunge(attachment)
-                make_transient(attachment)
-                attachment.id = None
-
-                # Customise
-                attachment.response = response
-
-                session.add(attachment)
-
-        session.flush()
-        calculator = Calculator.scoring(submission)
-        calculator.mark_entire_survey_dirty(submission.survey)
+    def duplicate(self, job, submission, s_submission, session):
+        '''
+        Copy the rnodes, responses and attachments of another submission
+        with INSERT ... SELECT, so that none of them are loaded here. The
+        copies are reset to draft. Only the scores that may differ in the new
+        submission's survey are recalculated.
+        '''
+        job.advance("structure")
+        survey = submission.survey
+        # Keep the structure loaded (the session only holds it weakly) until
+        # scoring is done.
+        structure = SurveyStructure(survey)
+        qnodes = list(survey.ordered_qnodes)
+        qnode_measures = list(survey.ordered_qnode_measures)
+        qnode_ids = [qnode.id for qnode in qnodes]
+        measure_ids = [qm.measure_id for qm in qnode_measures]
+
+        target_id = cast(submission.id, model.Submission.id.type)
+        program_id = cast(submission.program_id, model.Program.id.type)
+        survey_id = cast(submission.survey_id, model.Survey.id.type)
+
+        job.advance("categories")
+        # Every copied response is a draft, so the counts of responses at
+        # later approval states go to zero.
+        ResponseNode = model.ResponseNode
+        copy_rows(
+            session, ResponseNode.__table__, {
+                'submission_id': target_id,
+                'program_id': program_id,
+                'n_final': literal(0),
+                'n_reviewed': literal(0),
+                'n_approved': literal(0),
+            },
+            ResponseNode.submission_id == s_submission.id,
+            ResponseNode.qnode_id.in_(qnode_ids))
+
+        job.advance("responses")
+        Response = model.Response
+        copy_rows(
+            session, Response.__table__, {
+                'submission_id': target_id,
+                'program_id': program_id,
+                'survey_id': survey_id,
+                'approval': literal('draft'),
+            },
+            Response.submission_id == s_submission.id,
+            Response.measure_id.in_(measure_ids))
+
+        job.advance("attachments")
+        # Attachments need new IDs, so they are copied one row per set of
+        # parameters. The blobs are copied by the database; files in S3 are
+        # stored by content hash, so the copies share the same object.
+        Attachment = model.Attachment
+        attachment_ids = [
+            attachment_id for attachment_id, in
+            session.query(Attachment.id)
+            .filter(Attachment.submission_id == s_submission.id,
+                    Attachment.measure_id.in_(measure_ids))]
+        if attachment_ids:
+            session.execute(
+                copy_rows_statement(
+                    Attachment.__table__, {
+                        'id': cast(
+                            bindparam('new_id', type_=Attachment.id.type),
+                            Attachment.id.type),
+                        'submission_id': target_id,
+                    },
+                    Attachment.id == bindparam('old_id')),
+                [{'new_id': GUID.gen(), 'old_id': attachment_id}
+                 for attachment_id in attachment_ids])
+
+        job.advance("scores")
+        calculator = Calculator.scoring(submission, preload=True)
+        s_survey = s_submission.survey
+        if (is_stale(s_submission) or
+                submission.program.has_quality !=
+                s_submission.program.has_quality):
+            # The source scores are stale, or were calculated by other rules.
+            calculator.mark_entire_survey_dirty(survey)
+        else:
+            if s_survey is survey:
+                s_qnodes = qnodes
+                s_qnode_measures = qnode_measures
+            else:
+                # Keep the source structure loaded while it's compared.
+                s_structure = SurveyStructure(s_survey)
+                s_qnodes = list(s_survey.ordered_qnodes)
+                s_qnode_measures = list(s_survey.ordered_qnode_measures)
+
+            # Responses with errors may refer to the paths of other measures.
+            error_measure_ids = {
+                measure_id for measure_id, in
+                session.query(Response.measure_id)
+                .filter(Response.submission_id == submission.id,
+                        Response.error != None)}
+            copied_qnode_ids = {
+                qnode_id for qnode_id, in
+                session.query(ResponseNode.qnode_id)
+                .filter(ResponseNode.submission_id == submission.id)}
+
+            s_qnodes = {
+                qnode.id: qnode_signature(qnode) for qnode in s_qnodes}
+            for qnode in qnodes:
+                if (qnode.id not in copied_qnode_ids or
+                        s_qnodes.get(qnode.id) != qnode_signature(qnode)):
+                    calculator.mark_qnode_dirty(qnode)
+
+            s_qnode_measures = {
+                qm.measure_id: measure_signature(qm)
+                for qm in s_qnode_measures}
+            for qm in qnode_measures:
+                if (qm.measure_id in error_measure_ids or
+                        s_qnode_measures.get(qm.measure_id) !=
+                        measure_signature(qm)):
+                    calculator.mark_measure_dirty(qm)
+
+            # The submission's own error count is cheap to refresh.
+            calculator.mark_survey_dirty(survey)
         calculator.execute()
 
+        # The scores are now up to date with the survey, so the recalculation
+        # daemon doesn't need to score this submission again.
+        submission.modified = survey.modified
+
     @tornado.web.authenticated
     def put(self, submission_id):
         '''Update existing.'''
@@ -364,32 +479,13 @@ class SubmissionHandler(base_handler.Paginate, base_handler.BaseHandler):
                 verbs.append('update')
             
             # update measures approval state, when save edited submission no approval, so here should not 
+            n_promoted = 0
             if approval!='':
                 approval_level = APPROVAL_STATES.index(approval) 
                 if 'state' in verbs and approval_level > current_level:    
-                    approval_level=approval_level-1
-                    responses = (
-                        session.query(model.Response)
-                        .filter(model.Response.submission_id == submission.id,
-                         model.Response.approval == APPROVAL_STATES[approval_level])
-                    )
-                    for response in responses:
-                        # update = updater(response, error_factory=errors.ModelError)
-                        # update('title', son)
-                        response.approval = approval
-                        try:
-                            calculator = Calculator.scoring(submission)
-                            calculator.mark_measure_dirty(response.qnode_measure)
-                            calculator.execute()
-                        except ResponseTypeError as e:
-                            raise errors.ModelError(str(e))
-
-
-                        act = Activities(session)
-                        act.record(user_session.user, response, verbs)
-                        act.ensure_subscription(
-                            user_session.user, response, response.submission,
-                            self.reason)
+                    previous_approval = APPROVAL_STATES[approval_level - 1]
+                    n_promoted = self.promote_responses(
+                        session, submission, previous_approval, approval)
 
             if submission.deleted:
                 submission.deleted = False
@@ -397,12 +493,81 @@ class SubmissionHandler(base_handler.Paginate, base_handler.BaseHandler):
 
             act = Activities(session)
             act.record(user_session.user, submission, verbs)
+            if n_promoted:
+                # One activity for all of the promoted responses, instead of
+                # one each. It's added separately so that it isn't merged
+                # with the submission's own activity.
+                desc = submission.action_descriptor
+                action = model.Activity(
+                    subject=user_session.user, verbs=['state'],
+                    **desc._asdict())
+                action.message = "%s: %d response(s) set to %s" % (
+                    desc.message, n_promoted, approval)
+                action.surveygroups = set(submission.surveygroups)
+                session.add(action)
+                # Subscribe to the submission, as editing its responses
+                # would.
+                act.ensure_subscription(
+                    user_session.user, submission, submission, self.reason)
             act.ensure_subscription(
                 user_session.user, submission, submission.organisation,
                 self.reason)
 
         self.get(submission_id)
 
+    def promote_responses(
+            self, session, submission, previous_approval, approval):
+        '''
+        Raises the approval state of all of the submission's responses that
+        are at `previous_approval`, and recalculates the affected scores.
+        @return the number of responses that were changed
+        '''
+        filters = (
+            (model.Response.submission_id == submission.id) &
+            (model.Response.approval == previous_approval))
+
+        qnode_measures = (
+            session.query(model.QnodeMeasure)
+            .join(model.Response, (
+                (model.Response.program_id == model.QnodeMeasure.program_id) &
+                (model.Response.survey_id == model.QnodeMeasure.survey_id) &
+                (model.Response.measure_id == model.QnodeMeasure.measure_id)))
+            .filter(filters)
+            .all())
+        if not qnode_measures:
+            return 0
+
+        # Keep the version history that would have been written if each
+        # response had been changed through the ORM.
+        response_table = model.Response.__table__
+        history_table = model.Response.__history_mapper__.local_table
+        columns = [
+            c.name for c in history_table.columns if c.name != 'changed']
+        session.flush()
+        session.execute(
+            history_table.insert().from_select(
+                columns + ['changed'],
+                select(
+                    [response_table.columns[c] for c in columns] +
+                    [literal(datetime.datetime.utcnow())])
+                .where(filters)))
+        (session.query(model.Response)
+            .filter(filters)
+            .update({
+                model.Response.approval: approval,
+                model.Response.version: model.Response.version + 1,
+            }, synchronize_session='fetch'))
+
+        try:
+            calculator = Calculator.scoring(submission, preload=True)
+            for qnode_measure in qnode_measures:
+                calculator.mark_measure_dirty(qnode_measure)
+            calculator.execute()
+        except ResponseTypeError as e:
+            raise errors.ModelError(str(e))
+
+        return len(qnode_measures)
+
     @tornado.web.authenticated
     def delete(self, submission_id):
         if submission_id == '':
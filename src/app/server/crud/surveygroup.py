@@ -1,5 +1,4 @@
 import cairosvg
-from concurrent.futures import ThreadPoolExecutor
 import os
 
 from tornado import gen
@@ -10,12 +9,13 @@ import tornado.web
 from activity import Activities
 import base_handler
 import errors
+import executors
 import image
 import model
+from session import identities
 from utils import ToSon, truthy, updater, get_package_dir, to_camel_case
 
 
-MAX_WORKERS = 4
 SCHEMA = {
     'group_logo': {
         'type': 'image',
@@ -27,7 +27,7 @@ SCHEMA = {
 
 class SurveyGroupIconHandler(base_handler.BaseHandler):
 
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('io')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -292,6 +292,8 @@ class SurveyGroupHandler(base_handler.Paginate, base_handler.BaseHandler):
 
             surveygroup_id = str(surveygroup.id)
 
+        # Undeleting a group restores its members' access
+        identities.clear()
         self.get(surveygroup_id)
 
     @tornado.web.authenticated
@@ -319,6 +321,7 @@ class SurveyGroupHandler(base_handler.Paginate, base_handler.BaseHandler):
 
             surveygroup.deleted = True
 
+        identities.clear()
         self.get(surveygroup_id)
 
     def get_logo(self, surveygroup):
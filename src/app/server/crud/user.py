@@ -10,6 +10,7 @@ import base_handler
 import config
 import errors
 import model
+from session import identities
 from surveygroup_actions import assign_surveygroups, filter_surveygroups
 from utils import ToSon, truthy, updater
 
@@ -315,6 +316,7 @@ class UserHandler(base_handler.Paginate, base_handler.BaseHandler):
                     act.subscribe(user, user.organisation)
                     self.reason("User subscribed to organisation")
 
+        identities.invalidate(user_id)
         self.get(user_id)
 
     @tornado.web.authenticated
@@ -345,6 +347,7 @@ class UserHandler(base_handler.Paginate, base_handler.BaseHandler):
 
             user.deleted = True
 
+        identities.invalidate(user_id)
         self.finish()
 
     def check_password(self, password):
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 
 
 class DagError(Exception):
@@ -109,6 +109,287 @@ class GraphBuilder:
         return self.meta_nodes[node]
 
 
+class IterativeGraphBuilder(GraphBuilder):
+    '''
+    A GraphBuilder that doesn't use recursion. Nodes are discovered with
+    explicit stacks, and sorted with Kahn's algorithm over arrays of integer
+    node indices. It can handle graphs of any depth, and it avoids the
+    function call overhead of the recursive builder on large graphs.
+
+    The resulting Graph is evaluated in the same way: nodes that are part of
+    (or are downstream from) a cycle have infinite depth, and are passed to
+    `Ops.cyclic` instead of `Ops.evaluate`.
+    '''
+
+    def build(self):
+        nodes = list(self.meta_nodes)
+        indices = {node: i for i, node in enumerate(nodes)}
+        metas = [
+            NodeMeta(node, meta.dependants.copy(), meta.ops)
+            for node, meta in self.meta_nodes.items()]
+
+        dependants = []
+        in_degree = [0] * len(nodes)
+        for meta in metas:
+            ds = [indices[d] for d in meta.dependants]
+            for d in ds:
+                in_degree[d] += 1
+                metas[d].dependencies.add(meta.node)
+            dependants.append(ds)
+
+        depths = [0] * len(nodes)
+        queue = deque(i for i, n in enumerate(in_degree) if n == 0)
+        graph = []
+        while queue:
+            i = queue.popleft()
+            depth = depths[i]
+            metas[i].depth = depth
+            graph.append(metas[i])
+            for d in dependants[i]:
+                if depths[d] <= depth:
+                    depths[d] = depth + 1
+                in_degree[d] -= 1
+                if in_degree[d] == 0:
+                    queue.append(d)
+
+        # Anything left over is part of (or downstream from) a cycle.
+        for i, n in enumerate(in_degree):
+            if n > 0:
+                metas[i].depth = INFINITY
+                graph.append(metas[i])
+
+        return Graph(graph)
+
+    def add_with_dependants(self, node, node_builder, force=False):
+        meta_nodes = self.meta_nodes
+        if not force and meta_nodes[node].dependants_added:
+            return
+
+        visited = set()
+        stack = [(node, node_builder)]
+        while stack:
+            node, node_builder = stack.pop()
+            meta = meta_nodes[node]
+            if force:
+                if node in visited:
+                    continue
+                visited.add(node)
+            elif meta.dependants_added:
+                continue
+            meta.dependants_added = True
+
+            meta.ops = node_builder.ops(node)
+            for dependant, builder in node_builder.dependants(node):
+                meta.dependants.add(dependant)
+                stack.append((dependant, builder))
+
+    def add_with_dependencies(self, node, node_builder):
+        stack = [(node, node_builder)]
+        while stack:
+            node, node_builder = stack.pop()
+            self.add_with_dependants(node, node_builder)
+            meta = self.meta_nodes[node]
+            if meta.dependencies_added:
+                continue
+            meta.dependencies_added = True
+            stack.extend(node_builder.dependencies(node))
+
+
+class CompiledGraph:
+    '''
+    A graph topology reduced to integer node indices. It holds no references
+    to the nodes themselves - just a hashable key for each one - so it can be
+    cached and reused for many evaluations. The transitive dependants of each
+    node (its ancestor chain) and the topological depths are computed once,
+    when the graph is compiled.
+
+    Use `CompiledGraphBuilder` to evaluate parts of the graph.
+    '''
+
+    def __init__(self, keys, dependants):
+        '''
+        Args:
+            keys: A sequence of unique, hashable node keys.
+            dependants: A sequence of the same length as `keys`; each item is
+                an iterable of the indices of the direct dependants of the
+                corresponding node.
+        '''
+        self.keys = list(keys)
+        self.indices = {key: i for i, key in enumerate(self.keys)}
+        self.dependants = [tuple(sorted(set(ds))) for ds in dependants]
+        self.dependencies = [[] for _ in self.keys]
+        for i, ds in enumerate(self.dependants):
+            for d in ds:
+                self.dependencies[d].append(i)
+        depths = topological_depths(
+            range(len(self.keys)), self.dependants, self.dependencies)
+        self.depths = [depths[i] for i in range(len(self.keys))]
+        self.acyclic = all(d != INFINITY for d in self.depths)
+        self.ancestors = self.ancestor_chains()
+
+    @classmethod
+    def from_builder(cls, builder, key):
+        '''
+        Compile the topology of a graph that has been added to a
+        `GraphBuilder`.
+
+        Args:
+            builder: The GraphBuilder.
+            key: A function that returns a hashable key for a node.
+        '''
+        nodes = list(builder.meta_nodes)
+        indices = {node: i for i, node in enumerate(nodes)}
+        dependants = [
+            [indices[d] for d in builder.meta_nodes[node].dependants]
+            for node in nodes]
+        return cls([key(node) for node in nodes], dependants)
+
+    def ancestor_chains(self):
+        chains = [None] * len(self.keys)
+        # Dependants are deeper than their dependencies, so visiting the
+        # deepest nodes first means each node's dependants are done before
+        # the node itself. Nodes in cycles have infinite depth and are
+        # visited first, by walking the graph.
+        for i in sorted(
+                range(len(self.keys)), key=self.depths.__getitem__,
+                reverse=True):
+            if self.depths[i] == INFINITY:
+                chains[i] = self.reachable(i)
+            else:
+                chains[i] = frozenset((i,)).union(
+                    *(chains[d] for d in self.dependants[i]))
+        return chains
+
+    def reachable(self, i):
+        seen = {i}
+        stack = [i]
+        while stack:
+            for d in self.dependants[stack.pop()]:
+                if d not in seen:
+                    seen.add(d)
+                    stack.append(d)
+        return frozenset(seen)
+
+    def __contains__(self, key):
+        return key in self.indices
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CompiledGraphBuilder:
+    '''
+    Selects nodes from a `CompiledGraph` for evaluation. This has the same
+    interface as `GraphBuilder`, but the dependants of each node are looked up
+    in the compiled graph instead of being discovered by a `NodeBuilder`.
+    '''
+
+    def __init__(self, compiled, key, resolve, ops):
+        '''
+        Args:
+            compiled: The CompiledGraph.
+            key: A function that returns the key of a node.
+            resolve: A function that returns the node for a key.
+            ops: A function that returns the Ops for a node.
+        '''
+        self.compiled = compiled
+        self.key = key
+        self.resolve = resolve
+        self.ops = ops
+        self.dirty = set()
+
+    def index(self, key):
+        return self.compiled.indices[key]
+
+    def add_with_dependants(self, node, node_builder=None, force=False):
+        '''
+        Add the node and all of its dependants to the graph. The arguments
+        after `node` are accepted for compatibility with `GraphBuilder`; the
+        compiled topology is always used.
+        '''
+        key = self.key(node)
+        self.index(key)
+        self.dirty.add(key)
+
+    def add_with_dependencies(self, node, node_builder=None):
+        '''
+        Add the node, all of its dependencies, and all of their dependants,
+        to the graph.
+        '''
+        i = self.index(self.key(node))
+        compiled = self.compiled
+        seen = {i}
+        stack = [i]
+        while stack:
+            for d in compiled.dependencies[stack.pop()]:
+                if d not in seen:
+                    seen.add(d)
+                    stack.append(d)
+        self.dirty.update(compiled.keys[d] for d in seen)
+
+    def build(self):
+        # Look up the indices now rather than when the nodes are added, in
+        # case the compiled graph has been replaced in the meantime.
+        indices = [self.index(key) for key in self.dirty]
+        compiled = self.compiled
+        members = frozenset().union(
+            *(compiled.ancestors[i] for i in indices))
+        if compiled.acyclic:
+            depths = {i: compiled.depths[i] for i in members}
+        else:
+            depths = topological_depths(
+                members, compiled.dependants, compiled.dependencies)
+
+        nodes = {i: self.resolve(compiled.keys[i]) for i in members}
+        graph = []
+        for i in members:
+            node = nodes[i]
+            meta = NodeMeta(
+                node, {nodes[d] for d in compiled.dependants[i]},
+                self.ops(node))
+            meta.dependencies = {
+                nodes[d] for d in compiled.dependencies[i] if d in members}
+            meta.depth = depths[i]
+            graph.append(meta)
+        graph.sort(key=lambda meta: meta.depth)
+        return Graph(graph)
+
+
+def topological_depths(nodes, dependants, dependencies):
+    '''
+    Find the depth of each node using Kahn's algorithm. The depth is the
+    length of the longest path from a source. Nodes that are part of (or are
+    downstream from) a cycle have infinite depth.
+
+    Args:
+        nodes: The indices of the nodes to consider.
+        dependants: A sequence of direct dependants for each node index.
+        dependencies: A sequence of direct dependencies for each node index.
+            Dependencies that are not in `nodes` are ignored.
+
+    Returns:
+        A dict of node index to depth.
+    '''
+    nodes = set(nodes)
+    in_degree = {
+        i: sum(1 for d in dependencies[i] if d in nodes) for i in nodes}
+    depths = dict.fromkeys(nodes, 0)
+    queue = deque(i for i in nodes if in_degree[i] == 0)
+    while queue:
+        i = queue.popleft()
+        for d in dependants[i]:
+            if d not in nodes:
+                continue
+            depths[d] = max(depths[d], depths[i] + 1)
+            in_degree[d] -= 1
+            if in_degree[d] == 0:
+                queue.append(d)
+    for i, n in in_degree.items():
+        if n > 0:
+            depths[i] = INFINITY
+    return depths
+
+
 class ProtoNodeMeta:
     __slots__ = ('dependants', 'dependants_added', 'dependencies_added', 'ops')
     def __init__(self):
@@ -66,6 +66,16 @@ class InternalModelError(tornado.web.HTTPError):
             self, 500, reason=reason, log_message=log_message, *args, **kwargs)
 
 
+class ServiceUnavailableError(tornado.web.HTTPError):
+    '''
+    The server is too busy to accept the request; the client should try again
+    later.
+    '''
+    def __init__(self, reason="Service unavailable", log_message=None, *args, **kwargs):
+        tornado.web.HTTPError.__init__(
+            self, 503, reason=reason, log_message=log_message, *args, **kwargs)
+
+
 integrity_error_lut = {
     'organisation_name_key': "An organisation with that name already exists",
     'org_meta_asset_types_check': "Unknown asset type",
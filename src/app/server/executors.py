@@ -0,0 +1,181 @@
+'''
+Shared thread pools for blocking work that handlers run off the IO loop.
+
+Handlers used to create their own pools, which let dozens of threads hit the
+database at once. Instead, each kind of work has a named, bounded pool:
+
+- reports: exports and other read-heavy reports
+- imports: imports, duplication and other long-running writes
+- io: short blocking calls, e.g. cleaning images and listing activities
+- icons: icon rendering, which is done one at a time
+
+When a pool already has as many tasks waiting as its queue allows, new tasks
+are refused with a 503 so that clients can back off and try again.
+'''
+
+__all__ = [
+    'BoundedExecutor',
+    'get',
+    'stats',
+]
+
+from concurrent.futures import Executor, ThreadPoolExecutor
+import logging
+import os
+from threading import Lock
+import time
+
+import errors
+
+
+log = logging.getLogger('app.executors')
+
+# Default (workers, queue depth) for each pool. These can be overridden with
+# EXECUTOR_<NAME>_WORKERS and EXECUTOR_<NAME>_QUEUE.
+POOLS = {
+    'reports': (4, 16),
+    'imports': (2, 4),
+    'io': (4, 32),
+    'icons': (1, 8),
+}
+
+executors = {}
+executors_lock = Lock()
+
+
+class ExecutorMetrics:
+    '''
+    Counts tasks and how long they waited for and spent in a worker.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.n_submitted = 0
+        self.n_rejected = 0
+        self.n_completed = 0
+        self.n_failed = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.total_run_time = 0.0
+        self.max_run_time = 0.0
+
+    def completed(self, queue_time, run_time, failed):
+        with self.lock:
+            self.n_completed += 1
+            if failed:
+                self.n_failed += 1
+            self.total_queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            self.total_run_time += run_time
+            self.max_run_time = max(self.max_run_time, run_time)
+
+
+class BoundedExecutor(Executor):
+    '''
+    A thread pool that refuses new work when too much is already waiting.
+    Tasks that are refused raise ServiceUnavailableError from `submit`.
+    '''
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.metrics = ExecutorMetrics()
+        self.n_pending = 0
+        self.n_running = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='%s-' % name)
+
+    def submit(self, fn, *args, **kwargs):
+        metrics = self.metrics
+        with metrics.lock:
+            if self.n_pending >= self.max_workers + self.max_queue:
+                metrics.n_rejected += 1
+                log.warning(
+                    "Executor %s is saturated; rejecting task %s",
+                    self.name, getattr(fn, '__qualname__', fn))
+                raise errors.ServiceUnavailableError(
+                    "The server is busy. Please try again later.")
+            metrics.n_submitted += 1
+            self.n_pending += 1
+
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            with metrics.lock:
+                self.n_running += 1
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                finished = time.perf_counter()
+                with metrics.lock:
+                    self.n_pending -= 1
+                    self.n_running -= 1
+                metrics.completed(
+                    started - submitted, finished - started, failed)
+
+        try:
+            return self._executor.submit(run)
+        except:
+            with metrics.lock:
+                self.n_pending -= 1
+            raise
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        metrics = self.metrics
+        with metrics.lock:
+            return {
+                'workers': self.max_workers,
+                'queue_limit': self.max_queue,
+                'running': self.n_running,
+                'queued': self.n_pending - self.n_running,
+                'submitted': metrics.n_submitted,
+                'rejected': metrics.n_rejected,
+                'completed': metrics.n_completed,
+                'failed': metrics.n_failed,
+                'queue_time_total': metrics.total_queue_time,
+                'queue_time_max': metrics.max_queue_time,
+                'queue_time_mean': (
+                    metrics.total_queue_time / metrics.n_completed
+                    if metrics.n_completed else 0.0),
+                'run_time_total': metrics.total_run_time,
+                'run_time_max': metrics.max_run_time,
+                'run_time_mean': (
+                    metrics.total_run_time / metrics.n_completed
+                    if metrics.n_completed else 0.0),
+            }
+
+
+def get_pool_size(name):
+    max_workers, max_queue = POOLS[name]
+    prefix = 'EXECUTOR_%s_' % name.upper()
+    max_workers = int(os.environ.get(prefix + 'WORKERS') or max_workers)
+    max_queue = int(os.environ.get(prefix + 'QUEUE') or max_queue)
+    return max_workers, max_queue
+
+
+def get(name):
+    '''
+    Returns the shared executor with the given name. Threads are only
+    started when work is submitted.
+    '''
+    with executors_lock:
+        executor = executors.get(name)
+        if executor is None:
+            executor = BoundedExecutor(name, *get_pool_size(name))
+            executors[name] = executor
+        return executor
+
+
+def stats():
+    with executors_lock:
+        return {
+            name: executor.stats()
+            for name, executor in executors.items()}
@@ -1,7 +1,7 @@
+from collections import defaultdict
 import json
 import logging
 import os
-import tempfile
 import xlrd
 
 import bleach
@@ -9,23 +9,29 @@ import tornado
 from tornado import gen
 from tornado.concurrent import run_on_executor
 from tornado.escape import json_decode
-from concurrent.futures import ThreadPoolExecutor
 
 import errors
+import executors
 import base_handler
 import model
-from score import Calculator
+from model.guid import GUID
+from score import Calculator, SurveyStructure
 from utils import denormalise
 from .utils import col2num
 
 
-MAX_WORKERS = 4
-
 log = logging.getLogger('app.importer.prog_import')
 
+# The column that holds the order of each type of header row
+HEADER_ORDER_COLUMNS = {
+    "Function Header": "C",
+    "Process Header": "D",
+    "SubProcess Header": "E",
+}
+
 
 class ImportStructureHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('imports')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -42,10 +48,7 @@ class ImportStructureHandler(base_handler.BaseHandler):
 
     @run_on_executor
     def background_task(self, title, description, surveygroup_ids):
-        with tempfile.NamedTemporaryFile() as fd:
-            fileinfo = self.request.files['file'][0]
-            fd.write(fileinfo['body'])
-            all_rows = self.read_sheet(fd.name)
+        fileinfo = self.request.files['file'][0]
 
         with model.session_scope() as session:
             user_session = self.get_user_session(session)
@@ -74,19 +77,65 @@ class ImportStructureHandler(base_handler.BaseHandler):
             policy.verify('surveygroup_interact')
             policy.verify('program_add')
 
-            self.process_structure_file(all_rows, session, program)
+            self.process_structure_file(
+                self.read_sheet(fileinfo['body']), session, program)
 
         return program_id
 
-    def read_sheet(self, path):
-        with xlrd.open_workbook(path) as book:
+    def read_sheet(self, body):
+        '''
+        Yields the rows of the scoring sheet one at a time. The upload is read
+        from memory, and only the scoring sheet is loaded.
+        '''
+        with xlrd.open_workbook(file_contents=body, on_demand=True) as book:
             sheet = book.sheet_by_name("Scoring")
-            all_rows = [
-                sheet.row_values(row_i)
-                for row_i in range(0, sheet.nrows - 1)]
-        return all_rows
-
-    def process_structure_file(self, all_rows, session, program):
+            for row_i in range(0, sheet.nrows - 1):
+                yield sheet.row_values(row_i)
+
+    def scan_rows(self, rows):
+        '''
+        Reads the headers and measures from the rows in a single pass. The
+        description of each header and measure is collected from the rows
+        that follow it as they are read.
+        @return a dict of header lists keyed by header type, and a dict of
+            measure lists keyed by (function, process, subprocess) order
+        '''
+        headers = {header_type: [] for header_type in HEADER_ORDER_COLUMNS}
+        measures = defaultdict(list)
+        open_descriptions = []
+
+        for row_num, row in enumerate(rows):
+            open_descriptions = [
+                desc for desc in open_descriptions if desc.feed(row)]
+
+            header_type = str(row[col2num("S")])
+            if header_type in HEADER_ORDER_COLUMNS:
+                desc = ParagraphDescription()
+                headers[header_type].append({
+                    "title": row[col2num("J")],
+                    "order": row[col2num(HEADER_ORDER_COLUMNS[header_type])],
+                    "row_num": row_num,
+                    "description": desc,
+                })
+                open_descriptions.append(desc)
+
+            if row[col2num("F")] != 0 and row[col2num("G")] == 1:
+                desc = LabelledDescription("Description")
+                key = (
+                    row[col2num("C")], row[col2num("D")], row[col2num("E")])
+                measures[key].append({
+                    "title": row[col2num("k")],
+                    "row_num": row_num,
+                    "order": row[col2num("F")],
+                    "weight": row[col2num("L")],
+                    "resp_num": row[col2num("F")],
+                    "description": desc,
+                })
+                open_descriptions.append(desc)
+
+        return headers, measures
+
+    def process_structure_file(self, rows, session, program):
         response_types = self.create_response_types(session, program)
 
         survey = model.Survey()
@@ -102,73 +151,49 @@ class ImportStructureHandler(base_handler.BaseHandler):
 
         log.info("survey: %s" % survey.id)
 
-        function_title_row = [{
-            "title": row[col2num("J")],
-            "order": row[col2num("C")],
-            "row_num": all_rows.index(row)
-        } for row in all_rows
-            if str(row[col2num("S")]) == "Function Header"]
-
-        process_title_row = [{
-            "title": row[col2num("J")],
-            "order": row[col2num("D")],
-            "row_num": all_rows.index(row)
-        } for row in all_rows
-            if str(row[col2num("S")]) == "Process Header"]
-
-        subprocess_title_row = [{
-            "title": row[col2num("J")],
-            "order": row[col2num("E")],
-            "row_num": all_rows.index(row)
-        } for row in all_rows
-            if str(row[col2num("S")]) == "SubProcess Header"]
-
-        for function in function_title_row:
+        headers, measure_rows = self.scan_rows(rows)
+
+        # The structure is built as plain rows and inserted in bulk. Parents
+        # are listed before their children to satisfy the foreign keys.
+        qnodes = []
+        measures = []
+        qnode_measures = []
+
+        def add_qnode(parent_id, order, title, description):
+            qnode = {
+                "id": GUID.gen(),
+                "program_id": program.id,
+                "survey_id": survey.id,
+                "parent_id": parent_id,
+                "seq": order - 1,
+                "title": title,
+                "description": bleach.clean(description, strip=True),
+            }
+            qnodes.append(qnode)
+            return qnode["id"]
+
+        for function in headers["Function Header"]:
             function_order = int(function['order'])
             function_title = function['title'].replace("{} - ".format(
                 function_order), "")
-            function_description = self.parse_description(
-                all_rows, function['row_num'])
-
-            qnode_function = model.QuestionNode()
-            qnode_function.program = program
-            qnode_function.survey = survey
-            qnode_function.seq = function_order - 1
-            qnode_function.title = function_title
-            qnode_function.description = bleach.clean(
-                function_description, strip=True)
-
-            session.add(qnode_function)
-            session.flush()
+            function_id = add_qnode(
+                None, function_order, function_title,
+                function['description'].text)
 
             process_row = [
-                row for row in process_title_row
+                row for row in headers["Process Header"]
                 if "{}.".format(function_order) in row['title']]
 
             for process in process_row:
                 process_order = int(process['order'])
                 process_title = process['title'].replace(
                     "{}.{} - ".format(function_order, process_order), "")
-
-                # print("process order:", process_order)
-                # print("process title:", process_title)
-                process_description = self.parse_description(
-                    all_rows, process['row_num'], "")
-
-                qnode_process = model.QuestionNode()
-                qnode_process.program = program
-                qnode_process.survey = survey
-                qnode_process.parent = qnode_function
-                qnode_process.seq = process_order - 1
-                qnode_process.title = process_title
-                qnode_process.description = bleach.clean(
-                    process_description, strip=True)
-                # log.info("qnode_process: %s" % qnode_process)
-                session.add(qnode_process)
-                session.flush()
+                process_id = add_qnode(
+                    function_id, process_order, process_title,
+                    process['description'].text)
 
                 subprocess_row = [
-                    row for row in subprocess_title_row
+                    row for row in headers["SubProcess Header"]
                     if "{}.{}.".format(
                         function_order, process_order) in row['title']]
                 for subprocess in subprocess_row:
@@ -178,74 +203,57 @@ class ImportStructureHandler(base_handler.BaseHandler):
                             function_order, process_order,
                             subprocess_order),
                         "")
+                    subprocess_id = add_qnode(
+                        process_id, subprocess_order, subprocess_title,
+                        subprocess['description'].text)
 
-                    # print("subprocess order:", subprocess_order)
-                    # print("subprocess title:", subprocess_title)
-                    subprocess_description = self.parse_description(
-                        all_rows, subprocess['row_num'], "")
-
-                    qnode_subprocess = model.QuestionNode()
-                    qnode_subprocess.program = program
-                    qnode_subprocess.survey = survey
-                    qnode_subprocess.parent = qnode_process
-                    qnode_subprocess.seq = subprocess_order - 1
-                    qnode_subprocess.title = subprocess_title
-                    qnode_subprocess.description = bleach.clean(
-                        subprocess_description, strip=True)
-
-                    session.add(qnode_subprocess)
-                    session.flush()
-
-                    measure_title_row = [
-                        {
-                            "title": row[col2num("k")],
-                            "row_num": all_rows.index(row),
-                            "order": row[col2num("F")],
-                            "weight": row[col2num("L")],
-                            "resp_num": row[col2num("F")]
-                        }
-                        for row in all_rows
-                        if function_order == row[col2num("C")] and
-                        process_order == row[col2num("D")] and
-                        subprocess_order == row[col2num("E")] and
-                        row[col2num("F")] != 0 and
-                        row[col2num("G")] == 1]
-
-                    for measure in measure_title_row:
+                    measure_title_row = measure_rows.get(
+                        (function_order, process_order, subprocess_order),
+                        [])
+
+                    for seq, measure in enumerate(measure_title_row):
                         measure_order = int(measure["order"])
                         measure_title = measure['title'].replace(
                             "{}.{}.{}.{} - ".format(
                                 function_order, process_order,
                                 subprocess_order, measure_order),
                             "")
-
-                        measure_description = self.parse_description(
-                            all_rows, measure['row_num'], "Description")
                         # Comments are part of the response, so ignore that
                         # row
-                        measure_weight = measure['weight']
-
-                        m = model.Measure()
-                        m.program = program
-                        m.title = measure_title
-                        m.weight = measure_weight
-                        m.description = bleach.clean(
-                            measure_description, strip=True)
                         rt_id = "standard"
                         if function_order == 7:
                             rt_id = "business-support-%s" % int(
                                 measure['resp_num'])
-                        # log.info("response_type: %s", rt_id)
-                        m.response_type = response_types[rt_id]
-                        session.add(m)
-                        session.flush()
-                        qnode_measure = model.QnodeMeasure(
-                            program=program, survey=survey,
-                            qnode=qnode_subprocess, measure=m)
-                        qnode_subprocess.qnode_measures.reorder()
-                        session.add(qnode_measure)
-                        session.flush()
 
+                        measure_id = GUID.gen()
+                        measures.append({
+                            "id": measure_id,
+                            "program_id": program.id,
+                            "title": measure_title,
+                            "weight": measure['weight'],
+                            "description": bleach.clean(
+                                measure['description'].text, strip=True),
+                            "response_type_id": response_types[rt_id].id,
+                        })
+                        qnode_measures.append({
+                            "program_id": program.id,
+                            "survey_id": survey.id,
+                            "qnode_id": subprocess_id,
+                            "measure_id": measure_id,
+                            "seq": seq,
+                        })
+
+        log.info(
+            "Inserting %d qnodes and %d measures",
+            len(qnodes), len(measures))
+        session.bulk_insert_mappings(model.QuestionNode, qnodes)
+        session.bulk_insert_mappings(model.Measure, measures)
+        session.bulk_insert_mappings(model.QnodeMeasure, qnode_measures)
+
+        # Load the new structure in a few queries, so the calculator doesn't
+        # have to fetch it one node at a time. Keep it loaded (the session
+        # only holds it weakly) until scoring is done.
+        structure = SurveyStructure(survey)
         calculator = Calculator.structural()
         calculator.mark_entire_survey_dirty(survey)
         calculator.execute()
@@ -266,42 +274,55 @@ class ImportStructureHandler(base_handler.BaseHandler):
                 log.info("Added RT %s", rt_def['id'])
                 response_types[rt_def['id']] = response_type
 
+        session.flush()
         return response_types
 
-    def parse_description(
-            self, all_rows, starting_row_num, prev_column=None,
-            paragraph=None):
-        # print("starting_row_num", starting_row_num, "sheet", sheet.nrows)
-        if starting_row_num + 1 >= len(all_rows):
-            return ""
-
-        if prev_column:
-            header_cell = all_rows[starting_row_num + 1][col2num("J")]
-
-            if prev_column == header_cell:
-                description_cell = all_rows[starting_row_num + 1][
-                    col2num("K")]
-                desc = description_cell
-                desc += self.parse_description(
-                    all_rows, starting_row_num + 1, prev_column)
-                return desc
-            else:
-                return ""
+
+class ParagraphDescription:
+    '''
+    The description of a header: the text in column K of the rows that
+    follow it, for as long as they are in the same paragraph (column I).
+    Paragraphs are separated by blank lines.
+    '''
+
+    def __init__(self):
+        self.parts = []
+        self.paragraph = None
+
+    def feed(self, row):
+        '''@return False when the row is not part of the description'''
+        para = row[col2num("I")]
+        if self.paragraph:
+            if para != self.paragraph:
+                return False
+            self.parts.append(chr(10) + chr(10) + row[col2num("K")])
         else:
-            para = all_rows[starting_row_num + 1][col2num("I")]
-            description_cell = all_rows[starting_row_num + 1][
-                col2num("K")]
-
-            if paragraph:
-                if para == paragraph:
-                    desc = chr(10) + chr(10) + description_cell
-                    desc += self.parse_description(
-                        all_rows, starting_row_num + 1, None, paragraph=para)
-                    return desc
-                else:
-                    return ""
-            else:
-                desc = description_cell
-                desc += self.parse_description(
-                    all_rows, starting_row_num + 1, None, paragraph=para)
-                return desc
+            self.parts.append(row[col2num("K")])
+            self.paragraph = para
+        return True
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+class LabelledDescription:
+    '''
+    The description of a measure: the text in column K of the rows that
+    follow it, for as long as column J has the given label.
+    '''
+
+    def __init__(self, label):
+        self.parts = []
+        self.label = label
+
+    def feed(self, row):
+        '''@return False when the row is not part of the description'''
+        if row[col2num("J")] != self.label:
+            return False
+        self.parts.append(row[col2num("K")])
+        return True
+
+    @property
+    def text(self):
+        return "".join(self.parts)
@@ -1,7 +1,8 @@
+from collections import defaultdict
 import datetime
 import logging
 import re
-import sqlalchemy
+from sqlalchemy.orm import joinedload
 import tempfile
 import xlrd
 
@@ -9,9 +10,9 @@ import tornado
 from tornado import gen
 from tornado.concurrent import run_on_executor
 from tornado.escape import json_decode
-from concurrent.futures import ThreadPoolExecutor
 
 import errors
+import executors
 import base_handler
 import model
 from score import Calculator
@@ -20,13 +21,14 @@ from .utils import col2num
 from .errors import ImportError
 
 
-MAX_WORKERS = 4
-
 log = logging.getLogger('app.importer.sub_import')
 
+# Rows with problems beyond this many are counted but not listed
+MAX_REPORTED_PROBLEMS = 20
+
 
 class ImportSubmissionHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('imports')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -98,87 +100,136 @@ class ImportSubmissionHandler(base_handler.BaseHandler):
         return all_rows
 
     def process_submission_file(self, all_rows, session, submission, user):
-        program_qnodes = (
-            session.query(model.QuestionNode)
-            .filter_by(program_id=submission.program.id))
+        qnode_paths, measures = self.index_survey(session, submission.survey)
 
-        try:
+        # Check every row before writing anything, so that all problems can
+        # be reported at once.
+        response_rows = {}
+        problems = []
+        for row_num in range(0, len(all_rows) - 1):
             order = title = ''
-            for row_num in range(0, len(all_rows) - 1):
-                order, title = self.parse_order_title(all_rows, row_num, "A")
-                function = program_qnodes.filter_by(
-                    parent_id=None, title=title).one()
-                log.debug("function: %s", function)
-                function_order = order
-
-                order, title = self.parse_order_title(all_rows, row_num, "B")
-                process = program_qnodes.filter_by(
-                    parent_id=function.id, title=title).one()
-                log.debug("process: %s", process)
-
-                order, title = self.parse_order_title(all_rows, row_num, "C")
-                subprocess = program_qnodes.filter_by(
-                    parent_id=process.id, title=title).one()
-                log.debug("subprocess: %s", subprocess)
+            try:
+                path = ()
+                for col_chr in "ABC":
+                    order, title = self.parse_order_title(
+                        all_rows, row_num, col_chr)
+                    if col_chr == "A":
+                        function_order = order
+                    path += (title,)
+                    if path not in qnode_paths:
+                        raise ImportError(
+                            "Survey structure does not match")
 
                 order, title = self.parse_order_title(all_rows, row_num, "D")
-                measure = [
-                    qm.measure for qm in subprocess.qnode_measures
-                    if qm.measure.title.split('\n')[0] == title]
-
-                if len(measure) == 1:
-                    measure = measure[0]
-                else:
-                    raise Exception(
-                        "This survey does not match the target survey.")
+                matches = measures.get(path + (title,), [])
+                if len(matches) != 1:
+                    raise ImportError(
+                        "This survey does not match the target survey")
+                measure = matches[0]
                 log.debug("measure: %s", measure)
 
-                log.debug(
-                    "measure response_type: %s",
-                    measure.response_type.name)
-
-                response = model.Response()
-                response.program_id = submission.program.id
-                response.survey_id = submission.survey.id
-                response.measure_id = measure.id
-                response.submission_id = submission.id
-                response.user_id = user.id
-                response.comment = all_rows[row_num][col2num("K")]
-                # FIXME: Hard-coded; should be read from file
-                response.not_relevant = False
-                response.modified = datetime.datetime.utcnow()
-                response.approval = 'draft'
-                response_part = []
+                if measure.id in response_rows:
+                    raise ImportError(
+                        "Same measure as row %d" %
+                        (response_rows[measure.id][0] + 2))
 
-                response_part.append(self.parse_response_type(
-                    all_rows, row_num, measure.response_type, "E"))
+                response_type = measure.response_type
+                response_parts = [self.parse_response_type(
+                    all_rows, row_num, response_type, "E")]
                 if function_order != "7":
-                    response_part.append(self.parse_response_type(
-                        all_rows, row_num, measure.response_type, "F"))
-                    response_part.append(self.parse_response_type(
-                        all_rows, row_num, measure.response_type, "G"))
-                    response_part.append(self.parse_response_type(
-                        all_rows, row_num, measure.response_type, "H"))
-                response.response_parts = response_part
-                response.audit_reason = "Import"
-                session.add(response)
-        except sqlalchemy.orm.exc.NoResultFound:
-            raise errors.ModelError(
-                "Survey structure does not match: Row %d: %s %s" %
-                (row_num + 2, order, title))
-        except ImportError as e:
+                    response_parts.extend(
+                        self.parse_response_type(
+                            all_rows, row_num, response_type, col_chr)
+                        for col_chr in "FGH")
+            except ImportError as e:
+                problems.append(
+                    "Row %d: %s %s: %s" % (row_num + 2, order, title, str(e)))
+                continue
+            except Exception as e:
+                raise errors.InternalModelError(
+                    "Row %d: %s %s: %s" %
+                    (row_num + 2, order, title, str(e)))
+
+            response_rows[measure.id] = (row_num, response_parts)
+
+        if problems:
+            message = "\n".join(problems[:MAX_REPORTED_PROBLEMS])
+            if len(problems) > MAX_REPORTED_PROBLEMS:
+                message += "\n... and %d more" % (
+                    len(problems) - MAX_REPORTED_PROBLEMS)
             raise errors.ModelError(
-                "Row %d: %s %s: %s" %
-                (row_num + 2, order, title, str(e)))
-        except Exception as e:
-            raise errors.InternalModelError(
-                "Row %d: %s %s: %s" %
-                (row_num + 2, order, title, str(e)))
-
-        calculator = Calculator.scoring(submission)
+                "Could not import %d row(s):\n%s" % (len(problems), message))
+
+        modified = datetime.datetime.utcnow()
+        session.bulk_insert_mappings(model.Response, [
+            {
+                'program_id': submission.program_id,
+                'survey_id': submission.survey_id,
+                'measure_id': measure_id,
+                'submission_id': submission.id,
+                'user_id': user.id,
+                'comment': all_rows[row_num][col2num("K")],
+                # FIXME: Hard-coded; should be read from file
+                'not_relevant': False,
+                'modified': modified,
+                'approval': 'draft',
+                'response_parts': response_parts,
+                'audit_reason': "Import",
+            }
+            for measure_id, (row_num, response_parts)
+            in response_rows.items()])
+
+        calculator = Calculator.scoring(submission, preload=True)
         calculator.mark_entire_survey_dirty(submission.survey)
         calculator.execute()
 
+    def index_survey(self, session, survey):
+        '''
+        Indexes the survey's structure by title.
+        @return a set of qnode title paths, e.g. (function, process,
+            subprocess); and a dict of lists of measures keyed by the path of
+            their qnode plus the first line of their own title
+        '''
+        qnodes = {
+            qnode.id: qnode for qnode in (
+                session.query(model.QuestionNode)
+                .filter(model.QuestionNode.program_id == survey.program_id,
+                        model.QuestionNode.survey_id == survey.id,
+                        model.QuestionNode.deleted == False))}
+
+        qnode_paths = {}
+
+        def get_path(qnode):
+            if qnode.id not in qnode_paths:
+                if qnode.parent_id is None:
+                    parent_path = ()
+                else:
+                    parent = qnodes.get(qnode.parent_id)
+                    if parent is None:
+                        # Descendant of a deleted qnode
+                        parent_path = (None,)
+                    else:
+                        parent_path = get_path(parent)
+                qnode_paths[qnode.id] = parent_path + (qnode.title,)
+            return qnode_paths[qnode.id]
+
+        for qnode in qnodes.values():
+            get_path(qnode)
+
+        qnode_measures = (
+            session.query(model.QnodeMeasure)
+            .options(joinedload('measure').joinedload('response_type'))
+            .filter(model.QnodeMeasure.program_id == survey.program_id,
+                    model.QnodeMeasure.survey_id == survey.id))
+        measures = defaultdict(list)
+        for qm in qnode_measures:
+            if qm.qnode_id not in qnode_paths:
+                continue
+            title = qm.measure.title.split('\n')[0]
+            measures[qnode_paths[qm.qnode_id] + (title,)].append(qm.measure)
+
+        return set(qnode_paths.values()), measures
+
     def parse_response_type(self, all_rows, row_num, response_type, col_chr):
         response_text = all_rows[row_num][col2num(col_chr)]
         index = ord(col_chr) - ord("E")
@@ -0,0 +1,126 @@
+'''
+Tracks long-running tasks that are run on the shared executors, so that
+their progress can be seen while they run (see /ping/metrics.json, which
+is only available to super administrators).
+
+A job is a function that takes the Job as its first argument, and calls
+`job.advance` as it moves from one step to the next.
+'''
+
+__all__ = [
+    'Job',
+    'get',
+    'run',
+    'stats',
+]
+
+from collections import OrderedDict
+import logging
+from threading import Lock
+import time
+import uuid
+
+
+log = logging.getLogger('app.jobs')
+
+# Finished jobs are forgotten once there are more than this many jobs.
+MAX_JOBS = 100
+
+jobs = OrderedDict()
+jobs_lock = Lock()
+
+
+class Job:
+    '''
+    The state of a task, and how many of its steps have been done.
+    '''
+
+    def __init__(self, name, n_steps):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.n_steps = n_steps
+        self.n_done = 0
+        self.step = None
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def advance(self, step):
+        '''
+        Marks the current step as done and starts the next one.
+        '''
+        if self.step is not None:
+            self.n_done += 1
+        self.step = step
+        log.debug(
+            "Job %s (%s): step %d/%d: %s", self.id, self.name,
+            self.n_done + 1, self.n_steps, step)
+
+    def to_son(self):
+        now = time.time()
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'step': self.step,
+            'done': self.n_done,
+            'total': self.n_steps,
+            'error': self.error,
+            'queue_time': (self.started or now) - self.created,
+            'run_time': (
+                (self.finished or now) - self.started
+                if self.started else 0.0),
+        }
+
+
+def run(executor, name, n_steps, fn, *args, **kwargs):
+    '''
+    Runs `fn(job, *args, **kwargs)` on an executor as a tracked job.
+    @return a Future for the result of `fn`
+    '''
+    job = Job(name, n_steps)
+
+    def task():
+        job.state = 'running'
+        job.started = time.time()
+        try:
+            result = fn(job, *args, **kwargs)
+        except Exception as e:
+            # The message may contain details that shouldn't be shown with
+            # the job's progress, so only the type of error is kept.
+            log.error("Job %s (%s) failed: %s", job.id, name, e)
+            job.state = 'failed'
+            job.error = type(e).__name__
+            raise
+        finally:
+            job.finished = time.time()
+        job.n_done = job.n_steps
+        job.state = 'done'
+        return result
+
+    future = executor.submit(task)
+    with jobs_lock:
+        jobs[job.id] = job
+        forget_finished_jobs()
+    log.info("Started job %s (%s)", job.id, name)
+    return future
+
+
+def forget_finished_jobs():
+    for job_id in list(jobs):
+        if len(jobs) <= MAX_JOBS:
+            break
+        if jobs[job_id].finished is not None:
+            del jobs[job_id]
+
+
+def get(job_id):
+    with jobs_lock:
+        return jobs.get(job_id)
+
+
+def stats():
+    with jobs_lock:
+        return [job.to_son() for job in jobs.values()]
@@ -1,8 +1,11 @@
 __all__ = [
     'connect_db',
     'connect_db_ro',
+    'dispose_engines',
     'get_database_url',
+    'get_engine_options',
     'MissingUser',
+    'pool_stats',
     'session_scope',
     'WrongPassword',
 ]
@@ -11,11 +14,13 @@ from contextlib import contextmanager
 from itertools import count
 import logging
 import os
+from threading import Lock
 import time
 
 from sqlalchemy import create_engine
 import sqlalchemy.exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from .base import ModelError
 from .config import SystemConfig
@@ -28,6 +33,9 @@ Session = None
 VersionedSession = None
 ReadonlySession = None
 
+# Engines by name, for reporting pool statistics
+engines = {}
+
 
 @contextmanager
 def session_scope(version=False, readonly=False):
@@ -65,11 +73,142 @@ def get_database_url():
         database=database)
 
 
+def get_engine_options():
+    '''
+    Connection pool settings from the environment. Settings that are not
+    given keep SQLAlchemy's defaults.
+    - DB_POOL_SIZE: number of connections to keep open
+    - DB_MAX_OVERFLOW: extra connections to allow when the pool is in use
+    - DB_POOL_TIMEOUT: seconds to wait for a connection before giving up
+    - DB_POOL_RECYCLE: seconds after which connections are replaced
+    - DB_POOL_PRE_PING: test connections before using them (True/False)
+    - DB_STATEMENT_TIMEOUT: milliseconds after which the database cancels a
+      statement
+    '''
+    options = {}
+    for name, key in (
+            ('DB_POOL_SIZE', 'pool_size'),
+            ('DB_MAX_OVERFLOW', 'max_overflow'),
+            ('DB_POOL_TIMEOUT', 'pool_timeout'),
+            ('DB_POOL_RECYCLE', 'pool_recycle')):
+        value = os.environ.get(name)
+        if value:
+            options[key] = int(value)
+
+    pre_ping = os.environ.get('DB_POOL_PRE_PING')
+    if pre_ping:
+        options['pool_pre_ping'] = pre_ping.lower() in {'true', 'yes', '1'}
+
+    statement_timeout = os.environ.get('DB_STATEMENT_TIMEOUT')
+    if statement_timeout:
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % int(statement_timeout)}
+
+    return options
+
+
+class PoolMetrics:
+    '''
+    Counts connection checkouts and how long they had to wait.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.n_checkouts = 0
+        self.n_overflows = 0
+        self.n_timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def checkout(self, wait, overflowed):
+        with self.lock:
+            self.n_checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if overflowed:
+                self.n_overflows += 1
+
+    def timeout(self):
+        with self.lock:
+            self.n_timeouts += 1
+
+
+class MeteredQueuePool(QueuePool):
+    '''
+    A QueuePool that records checkout wait times and overflow events.
+    '''
+
+    def __init__(self, *args, metrics=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics or PoolMetrics()
+
+    def _do_get(self):
+        overflow = self.overflow()
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            self.metrics.timeout()
+            raise
+        # Overflow counts up from -pool_size as connections are opened; it's
+        # only positive when the pool has grown beyond its size.
+        self.metrics.checkout(
+            time.perf_counter() - start, self.overflow() > max(overflow, 0))
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def stats(self):
+        metrics = self.metrics
+        with metrics.lock:
+            return {
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'checkouts': metrics.n_checkouts,
+                'overflows': metrics.n_overflows,
+                'timeouts': metrics.n_timeouts,
+                'wait_total': metrics.total_wait,
+                'wait_max': metrics.max_wait,
+                'wait_mean': (
+                    metrics.total_wait / metrics.n_checkouts
+                    if metrics.n_checkouts else 0.0),
+            }
+
+
+def create_metered_engine(name, url):
+    engine = create_engine(
+        url, poolclass=MeteredQueuePool, **get_engine_options())
+    engines[name] = engine
+    return engine
+
+
+def dispose_engines():
+    '''
+    Closes all pooled connections. Call this before forking: connections
+    can't be shared between processes, so each process needs its own engines.
+    '''
+    for engine in engines.values():
+        engine.dispose()
+    engines.clear()
+
+
+def pool_stats():
+    return {
+        name: engine.pool.stats()
+        for name, engine in engines.items()
+        if isinstance(engine.pool, MeteredQueuePool)}
+
+
 def connect_db(url, max_attempts=5):
     global Session, VersionedSession
     for i in count():
         try:
-            engine = create_engine(url)
+            engine = create_metered_engine('default', url)
             engine.execute('SELECT 1')
             break
         except sqlalchemy.exc.OperationalError:
@@ -126,7 +265,7 @@ def connect_db_ro(base_url):
         host=parsed_url.host,
         port=parsed_url.port,
         database=parsed_url.database)
-    engine_readonly = create_engine(readonly_url)
+    engine_readonly = create_metered_engine('readonly', readonly_url)
     ReadonlySession = sessionmaker(bind=engine_readonly)
 
     # Try to connect now so we know if the password is OK
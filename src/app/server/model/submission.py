@@ -113,6 +113,10 @@ class ResponseNode(Observable, Base):
     n_reviewed = Column(Integer, default=0, nullable=False)
     n_approved = Column(Integer, default=0, nullable=False)
     n_not_relevant = Column(Integer, default=0, nullable=False)
+    # Number of questions (submeasures) and answered questions below this
+    # node; maintained by the score calculator.
+    n_questions = Column(Integer, default=0, nullable=False)
+    n_answers = Column(Integer, default=0, nullable=False)
     score = Column(Float, default=0.0, nullable=False)
     error = Column(Text)
 
@@ -150,10 +154,9 @@ class ResponseNode(Observable, Base):
             rnode.submission_id = sid
             session.add(rnode)
             # Without this flush, rnode.responses may be incomplete. Test with
-            # test_daemon.DaemonTest.
-            # TODO: Perahps this could be avoided if the recalculation was done
-            # in two stages: first create required rnodes, then flush, then
-            # update their scores?
+            # test_daemon.DaemonTest. The score calculator doesn't use this;
+            # it creates all of its rnodes in one batch before evaluating the
+            # graph (see score.SessionLookup.create_rnodes).
             session.flush()
         return rnode
 
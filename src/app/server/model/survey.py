@@ -465,6 +465,11 @@ class ResponseType(Observable, Base):
     name = Column(Text, nullable=False)
     parts = Column(JSON, nullable=False)
     formula = Column(Text)
+    # Version stamp for cached materialised response types; see
+    # response_type.ResponseTypeCache
+    modified = Column(
+        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow,
+        nullable=False)
 
     __table_args__ = (
         ForeignKeyConstraint(
@@ -487,11 +492,15 @@ class ResponseType(Observable, Base):
         parts = validate_with_humanized_errors(
            parts, response_type.response_parts_schema)
         response_type.validate_parts(parts)
+        # Stamp now rather than on flush, so that the new definition is
+        # materialised even if it's scored before being flushed.
+        self.modified = datetime.utcnow()
         return parts
 
     @validates('formula')
     def validate_formula(self, k, formula):
         response_type.validate_formula(formula)
+        self.modified = datetime.utcnow()
         return formula
 
     @property
@@ -1,9 +1,13 @@
 import logging
 
+from tornado.escape import json_encode
 import tornado.web
 
 import base_handler
+import executors
+import jobs
 import model
+from response_type import response_types
 
 
 log = logging.getLogger('app.protocol')
@@ -25,6 +29,31 @@ class PingHandler(base_handler.BaseHandler):
         self.finish()
 
 
+class PingMetricsHandler(base_handler.BaseHandler):
+    '''
+    Reports connection pool, executor and cache statistics for this process,
+    for sizing the pools against real load, and the progress of recent jobs.
+    Unlike PingHandler, this is only available to super administrators.
+    '''
+
+    @tornado.web.authenticated
+    def get(self):
+        with model.session_scope() as session:
+            user_session = self.get_user_session(session)
+            user_session.policy.verify('metrics_view')
+
+        son = {
+            'pools': model.pool_stats(),
+            'executors': executors.stats(),
+            'jobs': jobs.stats(),
+            'response_types': response_types.stats(),
+        }
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(json_encode(son))
+        self.finish()
+
+
 class RedirectHandler(base_handler.BaseHandler):
 
     @tornado.web.authenticated
@@ -7,6 +7,7 @@ import time
 
 from sqlalchemy import or_
 
+from batch_score import BatchCalculator
 from mail import send
 import model
 from score import Calculator
@@ -41,15 +42,15 @@ def send_email(config, errors):
 def process_once(config):
     count = 0
     n_errors = 0
+    batch_size = config.get('BATCH_SIZE') or 1
     while True:
         with model.session_scope() as session:
-            record = (session.query(model.Submission,
-                                   model.Survey.modified)
+            stale = (session.query(model.Submission)
                 .join(model.Survey)
                 .filter((model.Submission.modified < model.Survey.modified) |
                         ((model.Submission.modified == None) &
-                         (model.Survey.modified != None)))
-                .first())
+                         (model.Survey.modified != None))))
+            record = stale.add_columns(model.Survey.modified).first()
             if record is None:
                 break
             sub, htime = record
@@ -59,14 +60,26 @@ def process_once(config):
             if count == 0:
                 log.info("Starting new job")
 
-            calculator = Calculator.scoring(sub)
-            calculator.mark_entire_survey_dirty(sub.survey)
-            calculator.execute()
-            if sub.error:
-                n_errors += 1
-            count += 1
-
-            sub.modified = sub.survey.modified
+            if batch_size > 1:
+                # Score all stale submissions of the same survey together
+                subs = (stale
+                    .filter(model.Submission.program_id == sub.program_id,
+                            model.Submission.survey_id == sub.survey_id)
+                    .limit(batch_size)
+                    .all())
+                log.info("Scoring %d submissions together", len(subs))
+                BatchCalculator(sub.survey, subs).execute()
+            else:
+                subs = [sub]
+                calculator = Calculator.scoring(sub, preload=True)
+                calculator.mark_entire_survey_dirty(sub.survey)
+                calculator.execute()
+
+            for submission in subs:
+                if submission.error:
+                    n_errors += 1
+                count += 1
+                submission.modified = submission.survey.modified
             session.commit()
 
     log.info("Successfully recalculated scores for %d submissions.", count)
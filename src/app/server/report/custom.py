@@ -1,5 +1,4 @@
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 import csv
 from datetime import datetime
@@ -19,6 +18,7 @@ import xlsxwriter
 import base_handler
 import config
 import errors
+import executors
 import model
 from undefined import undefined
 from utils import ToSon
@@ -40,7 +40,6 @@ TYPES = {
 }
 CHUNKSIZE = 100
 MAX_LIMIT = 2500
-BUF_SIZE = 4096
 
 
 class CustomQueryReportHandler(base_handler.BaseHandler):
@@ -125,15 +124,8 @@ class CustomQueryReportHandler(base_handler.BaseHandler):
                 self.reason(message)
             self.set_header("Content-Type", writer.content_type)
             self.set_header('Content-Disposition', 'attachment')
-            self.transfer_file(path)
-
-    def transfer_file(self, path):
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(BUF_SIZE)
-                if not data:
-                    break
-                self.write(data)
+            with open(path, 'rb') as f:
+                yield self.write_file(f)
 
 
 class CustomQueryPreviewHandler(CustomQueryReportHandler):
@@ -162,7 +154,7 @@ class CustomQueryPreviewHandler(CustomQueryReportHandler):
 
 class QueryRunner:
 
-    executor = ThreadPoolExecutor(max_workers=4)
+    executor = executors.get('reports')
 
     def __init__(self, writer):
         self.writer = writer
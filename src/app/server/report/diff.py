@@ -1,4 +1,4 @@
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 import time
 
 from sqlalchemy.orm import aliased
@@ -10,14 +10,13 @@ from tornado.concurrent import run_on_executor
 
 import base_handler
 import errors
+import executors
 import model
 import logging
 
 from utils import ToSon
 
 
-MAX_WORKERS = 4
-
 log = logging.getLogger('app.report.diff')
 
 
@@ -38,7 +37,7 @@ def perf():
 
 
 class DiffHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('reports')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -403,7 +402,10 @@ class DiffEngine:
 
         reorder_ignore = set().union(deleted, added, relocated)
 
-        reorder_time = 0.0
+        start = perf()
+        a_siblings = self.get_qnode_siblings(self.program_id_a, reorder_ignore)
+        b_siblings = self.get_qnode_siblings(self.program_id_b, reorder_ignore)
+        reorder_time = perf() - start
         for (a, b), diff_item in zip(qnode_pairs, qnode_diff):
             a_son, b_son = diff_item['pair']
             if a:
@@ -412,7 +414,9 @@ class DiffEngine:
                 b_son['path'] = b.get_path()
             if a and b and str(a.parent_id) == str(b.parent_id):
                 start = perf()
-                if self.qnode_was_reordered(a, b, reorder_ignore):
+                if self.was_reordered(
+                        str(a.id), a_siblings[str(a.parent_id)],
+                        str(b.id), b_siblings[str(b.parent_id)]):
                     diff_item['tags'].append('reordered')
                 reorder_time += perf() - start
         self.timing.append("Qnode reorder filter took %gs" % reorder_time)
@@ -434,7 +438,12 @@ class DiffEngine:
 
         reorder_ignore = set().union(deleted, added, relocated)
 
-        reorder_time = 0.0
+        start = perf()
+        a_siblings = self.get_measure_siblings(
+            self.program_id_a, reorder_ignore)
+        b_siblings = self.get_measure_siblings(
+            self.program_id_b, reorder_ignore)
+        reorder_time = perf() - start
         for (a, b), diff_item in zip(measure_pairs, measure_diff):
             a_son, b_son = diff_item['pair']
             if a:
@@ -451,70 +460,53 @@ class DiffEngine:
                 b_son['seq'] = qm_b.seq
             if a and b and a_son['parentId'] == b_son['parentId']:
                 start = perf()
-                if self.measure_was_reordered(a, b, reorder_ignore):
+                if self.was_reordered(
+                        str(a.id), a_siblings[a_son['parentId']],
+                        str(b.id), b_siblings[b_son['parentId']]):
                     diff_item['tags'].append('reordered')
                 reorder_time += perf() - start
         self.timing.append("Measure reorder filter took %gs" % reorder_time)
 
-    def qnode_was_reordered(self, a, b, reorder_ignore):
-        a_siblings = (
-            self.session.query(model.QuestionNode.id)
-            .filter(model.QuestionNode.parent_id == a.parent_id,
-                    model.QuestionNode.program_id == self.program_id_a,
-                    ~model.QuestionNode.id.in_(reorder_ignore))
-            .order_by(model.QuestionNode.seq)
-            .all())
-        b_siblings = (
-            self.session.query(model.QuestionNode.id)
-            .filter(model.QuestionNode.parent_id == b.parent_id,
-                    model.QuestionNode.program_id == self.program_id_b,
-                    ~model.QuestionNode.id.in_(reorder_ignore))
-            .order_by(model.QuestionNode.seq)
-            .all())
-        a_siblings = [str(id_) for (id_,) in a_siblings]
-        b_siblings = [str(id_) for (id_,) in b_siblings]
-        if not str(a.id) in a_siblings or not str(b.id) in b_siblings:
-            return False
-        a_index = a_siblings.index(str(a.id))
-        a_siblings = a_siblings[max(a_index - 1, 0):
-                                min(a_index + 1, len(a_siblings))]
-        b_index = b_siblings.index(str(b.id))
-        b_siblings = b_siblings[max(b_index - 1, 0):
-                                min(b_index + 1, len(b_siblings))]
-        return a_siblings != b_siblings
-
-    def measure_was_reordered(self, a, b, reorder_ignore):
-        a_qnode_measure = a.get_qnode_measure(self.survey_id)
-        b_qnode_measure = b.get_qnode_measure(self.survey_id)
-        a_siblings = (
-            self.session.query(model.Measure.id)
-            .join(model.QnodeMeasure,
-                  (model.QnodeMeasure.program_id == model.Measure.program_id) &
-                  (model.QnodeMeasure.measure_id == model.Measure.id))
-            .filter(model.QnodeMeasure.qnode_id == a_qnode_measure.qnode_id,
-                    model.QnodeMeasure.program_id == self.program_id_a,
-                    ~model.Measure.id.in_(reorder_ignore))
-            .order_by(model.QnodeMeasure.seq)
-            .all())
-        b_siblings = (
-            self.session.query(model.Measure.id)
-            .join(model.QnodeMeasure,
-                  (model.QnodeMeasure.program_id == model.Measure.program_id) &
-                  (model.QnodeMeasure.measure_id == model.Measure.id))
-            .filter(model.QnodeMeasure.qnode_id == b_qnode_measure.qnode_id,
-                    model.QnodeMeasure.program_id == self.program_id_b,
-                    ~model.Measure.id.in_(reorder_ignore))
-            .order_by(model.QnodeMeasure.seq)
-            .all())
-
-        a_siblings = [str(id_) for (id_,) in a_siblings]
-        b_siblings = [str(id_) for (id_,) in b_siblings]
-        if not str(a.id) in a_siblings or not str(b.id) in b_siblings:
+    def get_qnode_siblings(self, program_id, reorder_ignore):
+        '''
+        @return a dict of lists of qnode IDs in order, keyed by parent ID
+        '''
+        query = (
+            self.session.query(
+                model.QuestionNode.parent_id, model.QuestionNode.id)
+            .filter(model.QuestionNode.program_id == program_id,
+                    model.QuestionNode.survey_id == self.survey_id)
+            .order_by(model.QuestionNode.seq))
+        siblings = defaultdict(list)
+        for parent_id, id_ in query:
+            if str(id_) not in reorder_ignore:
+                siblings[str(parent_id)].append(str(id_))
+        return siblings
+
+    def get_measure_siblings(self, program_id, reorder_ignore):
+        '''
+        @return a dict of lists of measure IDs in order, keyed by qnode ID
+        '''
+        query = (
+            self.session.query(
+                model.QnodeMeasure.qnode_id, model.QnodeMeasure.measure_id)
+            .filter(model.QnodeMeasure.program_id == program_id,
+                    model.QnodeMeasure.survey_id == self.survey_id)
+            .order_by(model.QnodeMeasure.seq))
+        siblings = defaultdict(list)
+        for qnode_id, measure_id in query:
+            if str(measure_id) not in reorder_ignore:
+                siblings[str(qnode_id)].append(str(measure_id))
+        return siblings
+
+    def was_reordered(self, a_id, a_siblings, b_id, b_siblings):
+        # Items count as reordered if the item before them has changed.
+        if a_id not in a_siblings or b_id not in b_siblings:
             return False
-        a_index = a_siblings.index(str(a.id))
+        a_index = a_siblings.index(a_id)
         a_siblings = a_siblings[max(a_index - 1, 0):
                                 min(a_index + 1, len(a_siblings))]
-        b_index = b_siblings.index(str(b.id))
+        b_index = b_siblings.index(b_id)
         b_siblings = b_siblings[max(b_index - 1, 0):
                                 min(b_index + 1, len(b_siblings))]
         return a_siblings != b_siblings
@@ -1,6 +1,8 @@
+from collections import defaultdict
 import logging
 import string
 
+from sqlalchemy.orm import joinedload
 import xlsxwriter
 
 import errors
@@ -27,7 +29,7 @@ class Exporter:
         """
         Open and write an Excel file
         """
-        workbook = xlsxwriter.Workbook(file_name)
+        workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True})
         worksheet = workbook.add_worksheet('Scoring')
         worksheet.set_column(0, 0, 12)
         worksheet.set_column(1, 1, 100)
@@ -50,73 +52,83 @@ class Exporter:
 
             prefix = ""
 
-            list1 = (session.query(model.QuestionNode)
-                .filter(model.QuestionNode.program_id == program_id,
-                        model.QuestionNode.survey_id == survey.id,
-                        model.QuestionNode.deleted == False)
-                .all())
-
-            qnode_list = [{"id": str(item.id),
-                           "parent_id": str(item.parent_id),
-                           "title": item.title,
-                           "description": item.description,
-                           "seq": item.seq,
-                           "total_weight": item.total_weight}
-                          for item in list1]
-
-            list2 = session.query(model.QnodeMeasure).filter(
-                model.QnodeMeasure.program_id == program_id).all()
-
-            measure_list = [{"measure_id": str(item.measure.id),
-                             "qnode_id": str(item.qnode_id),
-                             "title": item.measure.title,
-                             "description": item.measure.description,
-                             "weight": item.measure.weight,
-                             "response_type": item.measure.response_type,
-                             "seq": item.seq}
-                            for item in list2]
-
-            response_list = []
-            response_qnode_list = []
+            children, qnode_measures = self.load_structure(
+                session, program_id, survey_id)
+
+            responses = {}
+            rnodes = {}
             log.debug('Exporting submission %s of program %s', submission_id, program_id)
-            if submission_id != '':
-                responses = (session.query(model.Response)
-                             .filter(model.Response.submission_id == submission_id)
-                             .all())
-
-                if responses:
-                    response_list = [{"measure_id": str(item.measure.id),
-                                      "response_parts": item.response_parts,
-                                      "weight": item.measure.weight,
-                                      "comment": item.comment,
-                                      "not_relevant": item.not_relevant,
-                                      "score": item.score}
-                                     for item in responses]
-                response_nodes = session.query(model.ResponseNode)\
-                    .filter(model.ResponseNode.submission_id == submission_id,
-                            model.ResponseNode.program_id == program_id).all()
-                if response_nodes:
-                    response_qnode_list = [{"qnode_id": str(item.qnode.id),
-                                            "weight": item.qnode.total_weight,
-                                            "score": item.score}
-                                           for item in response_nodes]
-
-            self.write_qnode_to_worksheet(session, workbook, worksheet,
-                                          qnode_list, response_qnode_list,
-                                          measure_list, response_list,
-                                          'None', prefix, 0, user_role)
+            if submission_id:
+                responses = {
+                    response.measure_id: response
+                    for response in (
+                        session.query(model.Response)
+                        .filter(model.Response.submission_id == submission_id))}
+                rnodes = {
+                    rnode.qnode_id: rnode
+                    for rnode in (
+                        session.query(model.ResponseNode)
+                        .filter(model.ResponseNode.submission_id == submission_id,
+                                model.ResponseNode.program_id == program_id))}
+
+            # The names of a measure's response parts are written on the rows
+            # above its comments, so that many rows must stay open.
+            self.backtrack = max((
+                len(qnode_measure.measure.response_type.parts)
+                for qnode_measure_list in qnode_measures.values()
+                for qnode_measure in qnode_measure_list), default=0)
+            self.formats = {}
+            rows = RowBuffer(worksheet)
+
+            self.write_qnode_to_worksheet(workbook, rows,
+                                          children, qnode_measures,
+                                          rnodes, responses,
+                                          None, prefix, 0, user_role)
+            rows.flush()
 
         workbook.close()
 
-    def write_qnode_to_worksheet(
-            self, session, workbook, worksheet,
-            qnode_list, response_qnode_list, measure_list, response_list,
-            parent_id, prefix, depth, user_role):
-
-        filtered = [node for node in qnode_list
-                    if node["parent_id"] == parent_id]
-
-        filtered_list = sorted(filtered, key=lambda node: node["seq"])
+    def load_structure(self, session, program_id, survey_id):
+        '''
+        Loads the survey's categories and measures.
+
+        Returns:
+            The categories by parent ID, and the qnode/measures by category
+            ID, each in order.
+        '''
+        qnodes = (
+            session.query(model.QuestionNode)
+            .filter(model.QuestionNode.program_id == program_id,
+                    model.QuestionNode.survey_id == survey_id,
+                    model.QuestionNode.deleted == False)
+            .order_by(model.QuestionNode.seq))
+        children = defaultdict(list)
+        for qnode in qnodes:
+            children[qnode.parent_id].append(qnode)
+
+        qnode_measures = (
+            session.query(model.QnodeMeasure)
+            .options(joinedload('measure').joinedload('response_type'))
+            .filter(model.QnodeMeasure.program_id == program_id,
+                    model.QnodeMeasure.survey_id == survey_id)
+            .order_by(model.QnodeMeasure.seq))
+        measures = defaultdict(list)
+        for qnode_measure in qnode_measures:
+            measures[qnode_measure.qnode_id].append(qnode_measure)
+
+        return children, measures
+
+    def ordered_qnode_measures(self, children, qnode_measures, parent_id=None):
+        '''Returns all qnode/measures in depth-first order'''
+        for qnode in children.get(parent_id, []):
+            yield from self.ordered_qnode_measures(
+                children, qnode_measures, qnode.id)
+            yield from qnode_measures.get(qnode.id, [])
+
+    def get_qnode_formats(self, workbook, depth):
+        key = ('qnode', depth)
+        if key in self.formats:
+            return self.formats[key]
 
         format = workbook.add_format()
         format.set_text_wrap()
@@ -146,57 +158,69 @@ class Exporter:
         else:
             format.set_font_size(11)
 
-        format.set_bg_color(depth_colors[depth])
-        format2.set_bg_color(depth_colors[depth])
-        format_percent.set_bg_color(depth_colors[depth])
+        color = depth_colors[min(depth, len(depth_colors) - 1)]
+        format.set_bg_color(color)
+        format2.set_bg_color(color)
+        format_percent.set_bg_color(color)
+
+        self.formats[key] = format, format_percent, format2
+        return self.formats[key]
+
+    def write_qnode_to_worksheet(
+            self, workbook, rows, children, qnode_measures,
+            rnodes, responses, parent_id, prefix, depth, user_role):
+
+        filtered_list = children.get(parent_id)
+        if not filtered_list:
+            return
+
+        format, format_percent, format2 = self.get_qnode_formats(
+            workbook, depth)
 
         for qnode in filtered_list:
-            response_score = [r for r in response_qnode_list
-                              if r["qnode_id"] == qnode["id"]]
+            rows.flush(self.line - self.backtrack)
+
+            rnode = rnodes.get(qnode.id)
             percent = None
-            if response_score and response_score[0]["weight"] != 0:
-                percent = response_score[0]["score"] / response_score[0]["weight"]
+            if rnode and qnode.total_weight != 0:
+                percent = rnode.score / qnode.total_weight
 
-            numbering = prefix + str(qnode["seq"] + 1) + ". "
-            worksheet.merge_range("A{0}:B{0}".format(self.line + 1),
-                                  numbering + qnode["title"], format)
+            numbering = prefix + str(qnode.seq + 1) + ". "
+            rows.merge_range(self.line, 0, self.line, 1,
+                             numbering + qnode.title, format)
 
             # Hide some data from certain users
             if user_role in {'clerk', 'org_admin'}:
                 weight = None
             else:
-                weight = qnode['total_weight']
+                weight = qnode.total_weight
 
             if user_role == 'clerk':
                 score = None
             else:
                 score = percent
 
-            worksheet.write(self.line, 2, weight, format)
-            worksheet.write(self.line, 3, score, format_percent)
+            rows.write(self.line, 2, weight, format)
+            rows.write(self.line, 3, score, format_percent)
 
             self.line = self.line + 1
-            worksheet.write(self.line, 0, '', format2)
-            worksheet.write(self.line, 1, qnode["description"], format2)
-            worksheet.write(self.line, 2, '', format2)
-            worksheet.write(self.line, 3, '', format2)
+            rows.write(self.line, 0, '', format2)
+            rows.write(self.line, 1, qnode.description, format2)
+            rows.write(self.line, 2, '', format2)
+            rows.write(self.line, 3, '', format2)
             self.line = self.line + 1
-            self.write_qnode_to_worksheet(session, workbook, worksheet,
-                                          qnode_list, response_qnode_list,
-                                          measure_list, response_list,
-                                          qnode["id"], numbering, depth + 1,
+            self.write_qnode_to_worksheet(workbook, rows,
+                                          children, qnode_measures,
+                                          rnodes, responses,
+                                          qnode.id, numbering, depth + 1,
                                           user_role)
-            self.write_measure_to_worksheet(session, workbook, worksheet,
-                                            measure_list, response_list,
-                                            qnode["id"], numbering, user_role)
-
-    def write_measure_to_worksheet(self, session, workbook, worksheet,
-                                   measure_list, response_list, qnode_id,
-                                   prefix, user_role):
+            self.write_measure_to_worksheet(workbook, rows,
+                                            qnode_measures, responses,
+                                            qnode.id, numbering, user_role)
 
-        filtered = [node for node in measure_list
-                    if node["qnode_id"] == qnode_id]
-        filtered_list = sorted(filtered, key=lambda node: node["seq"])
+    def get_measure_formats(self, workbook):
+        if 'measure' in self.formats:
+            return self.formats['measure']
 
         format = workbook.add_format()
         format.set_text_wrap()
@@ -220,11 +244,6 @@ class Exporter:
         format_header.set_text_wrap()
         format_header.set_bottom_color('white')
         format_header.set_bottom(1)
-        format_end = workbook.add_format()
-        format_end.set_text_wrap()
-        format_end.set_bg_color("#FABF8F")
-        format_end.set_bottom_color('white')
-        format_end.set_bottom(1)
         format_header_end = workbook.add_format()
         format_header_end.set_bg_color("#FFE4E1")
         format_header_end.set_bottom_color('white')
@@ -256,22 +275,40 @@ class Exporter:
         format_end3.set_bottom_color('white')
         format_end3.set_bottom(1)
 
+        self.formats['measure'] = {
+            'format': format,
+            'bold_header': format_bold_header,
+            'percent': format_percent,
+            'header': format_header,
+            'header_end': format_header_end,
+            'part': format_part,
+            'part_answer': format_part_answer,
+            'end1': format_end1,
+            'end2': format_end2,
+            'end3': format_end3,
+        }
+        return self.formats['measure']
+
+    def write_measure_to_worksheet(self, workbook, rows, qnode_measures,
+                                   responses, qnode_id, prefix, user_role):
+
+        formats = self.get_measure_formats(workbook)
+        format = formats['format']
+        format_header = formats['header']
+
+        for qnode_measure in qnode_measures.get(qnode_id, []):
+            rows.flush(self.line - self.backtrack)
+
+            measure = qnode_measure.measure
+            response = responses.get(qnode_measure.measure_id)
 
-        for qnode_measure in filtered_list:
-            response = [r for r in response_list
-                        if r["measure_id"] == qnode_measure["measure_id"]]
             if response:
-                response = response[0]
-            else:
-                response = None
-
-            if response:
-                if qnode_measure["weight"] != 0:
-                    percentage = response["score"] / response["weight"]
+                if measure.weight != 0:
+                    percentage = response.score / measure.weight
                 else:
                     percentage = None
-                comment = response["comment"]
-                if response["not_relevant"]:
+                comment = response.comment
+                if response.not_relevant:
                     not_relevant = "Yes"
                 else:
                     not_relevant = "No"
@@ -280,70 +317,64 @@ class Exporter:
                 comment = None
                 not_relevant = None
 
-            numbering = prefix + str(qnode_measure["seq"] + 1) + ". "
-            worksheet.write(self.line, 0, '', format_header)
-            worksheet.write(
-                self.line, 1, numbering + qnode_measure["title"], format_bold_header)
+            numbering = prefix + str(qnode_measure.seq + 1) + ". "
+            rows.write(self.line, 0, '', format_header)
+            rows.write(
+                self.line, 1, numbering + measure.title,
+                formats['bold_header'])
 
             # Hide some columns from certain users
             if user_role in {'clerk', 'org_admin'}:
                 weight = None
             else:
-                weight = qnode_measure["weight"]
+                weight = measure.weight
 
             if user_role == 'clerk':
                 score = None
             else:
                 score = percentage
 
-            worksheet.write(self.line, 2, weight, format)
-            worksheet.write(self.line, 3, score, format_percent)
+            rows.write(self.line, 2, weight, format)
+            rows.write(self.line, 3, score, formats['percent'])
 
             self.line = self.line + 1
-            worksheet.write(self.line, 0, "Description", format_header)
-            worksheet.write(self.line, 1, qnode_measure["description"], format)
-            worksheet.write(self.line, 2, '', format)
-            self.line = self.line + 1
-            worksheet.write(self.line, 0, '', format_header)
-            worksheet.write(self.line, 1, '', format)
-            worksheet.write(self.line, 2, '', format)
-            self.line = self.line + 1
-            worksheet.write(self.line, 0, '', format_header)
-            worksheet.write(self.line, 1, '', format)
-            worksheet.write(self.line, 2, '', format)
-            self.line = self.line + 1
-            worksheet.write(self.line, 0, '', format_header)
-            worksheet.write(self.line, 1, '', format)
-            worksheet.write(self.line, 2, '', format)
+            rows.write(self.line, 0, "Description", format_header)
+            rows.write(self.line, 1, measure.description, format)
+            rows.write(self.line, 2, '', format)
             self.line = self.line + 1
-            worksheet.write(self.line, 0, "Comments", format_header_end)
-            worksheet.write(self.line, 1, comment, format_end1)
-            worksheet.write(self.line, 2, "Not Relevant", format_end2)
-            worksheet.write(self.line, 3, not_relevant, format_end3)
+            for i in range(3):
+                rows.write(self.line, 0, '', format_header)
+                rows.write(self.line, 1, '', format)
+                rows.write(self.line, 2, '', format)
+                self.line = self.line + 1
+            rows.write(self.line, 0, "Comments", formats['header_end'])
+            rows.write(self.line, 1, comment, formats['end1'])
+            rows.write(self.line, 2, "Not Relevant", formats['end2'])
+            rows.write(self.line, 3, not_relevant, formats['end3'])
             # answer option
-            rt = qnode_measure['response_type']
+            rt = measure.response_type
             parts_len = len(rt.parts)
             index = 0
             for part in rt.parts:
                 if 'name' in part:
-                    worksheet.write(self.line - parts_len + index, 2,
-                                    part["name"], format_part)
+                    rows.write(self.line - parts_len + index, 2,
+                               part["name"], formats['part'])
                 index = index + 1
 
             index = 0
-            if response and response["response_parts"] and not response["not_relevant"]:
-                for part in response["response_parts"]:
+            if response and response.response_parts and not response.not_relevant:
+                for part in response.response_parts:
                     if 'index' in part:
                         answer = "%d - %s" % (part['index'] + 1, part['note'])
                     else:
                         answer = part['value']
-                    worksheet.write(self.line - parts_len + index, 3,
-                                    answer, format_part_answer)
+                    rows.write(self.line - parts_len + index, 3,
+                               answer, formats['part_answer'])
                     index = index + 1
             else:
                 for i in range(0, parts_len):
-                    worksheet.write(self.line - parts_len + index, 3,
-                                    '', format_part_answer)
+                    rows.write(self.line - parts_len + index, 3,
+                               '', formats['part_answer'])
                     index = index + 1
 
             self.line = self.line + 1
@@ -354,7 +385,7 @@ class Exporter:
         """
         Open and write an Excel file
         """
-        workbook = xlsxwriter.Workbook(file_name)
+        workbook = xlsxwriter.Workbook(file_name, {'constant_memory': True})
         worksheet = workbook.add_worksheet('Response')
         worksheet_metadata = workbook.add_worksheet('Metadata')
 
@@ -400,7 +431,11 @@ class Exporter:
             level_length = len(levels)
             worksheet.set_column(0, level_length, 50)
 
-            measures = [qm.measure for qm in survey.ordered_qnode_measures]
+            children, qnode_measures = self.load_structure(
+                session, program_id, survey_id)
+            qnode_measures = list(
+                self.ordered_qnode_measures(children, qnode_measures))
+            measures = [qm.measure for qm in qnode_measures]
 
             max_parts = 0
             longest_response_type = None
@@ -425,8 +460,12 @@ class Exporter:
             self.write_response_header(
                 workbook, worksheet, levels, max_parts, response_parts)
 
-            for measure in measures:
-                qnode_measure = measure.get_qnode_measure(survey)
+            if submission:
+                responses, rnodes, history = self.load_submission(
+                    session, submission)
+
+            for qnode_measure in qnode_measures:
+                measure = qnode_measure.measure
                 self.write_qnode(
                     worksheet, qnode_measure.qnode, line, format, level_length - 1)
 
@@ -438,8 +477,7 @@ class Exporter:
                 importance = None
                 urgency = None
                 if submission:
-                    response = model.Response.from_measure(
-                        qnode_measure, submission)
+                    response = responses.get(measure.id)
                     url = base_url + "/#/3/measure/{}?submission={}".format(
                         measure.id, submission.id)
 
@@ -447,7 +485,7 @@ class Exporter:
                     # parent rnodes
                     parent = qnode_measure.qnode
                     while parent and (importance is None or urgency is None):
-                        rnode = model.ResponseNode.from_qnode(parent, submission)
+                        rnode = rnodes.get(parent.id)
                         if rnode is not None:
                             if importance is None:
                                 importance = rnode.importance
@@ -485,17 +523,10 @@ class Exporter:
                         export_approval_status.remove(response.approval)
 
                     for approval_status in export_approval_status:
-                        res = (session.query(model.ResponseHistory)
-                            .filter_by(submission_id=response.submission_id,
-                                measure_id=response.measure_id,
-                                approval=approval_status)
-                            .order_by(model.ResponseHistory.modified.desc())
-                            .first())
+                        res, user = history.get(
+                            (response.measure_id, approval_status),
+                            (None, None))
                         if res:
-                            user = session.query(model.AppUser).\
-                                filter_by(id=res.user_id).\
-                                first()
-
                             self.write_approval(worksheet, line,
                                 level_length + max_parts + 2, res,
                                 user, format, format_date)
@@ -535,6 +566,56 @@ class Exporter:
 
         workbook.close()
 
+    def load_submission(self, session, submission):
+        '''
+        Loads the submission's responses and response nodes, and the latest
+        version of each response in each approval state.
+
+        Returns:
+            Responses by measure ID, response nodes by qnode ID, and
+            (response history, user) pairs by (measure ID, approval).
+        '''
+        responses = {
+            response.measure_id: response
+            for response in (
+                session.query(model.Response)
+                .options(joinedload('user'))
+                .filter(model.Response.submission_id == submission.id))}
+
+        rnodes = {
+            rnode.qnode_id: rnode
+            for rnode in (
+                session.query(model.ResponseNode)
+                .filter(model.ResponseNode.submission_id == submission.id))}
+
+        ResponseHistory = model.ResponseHistory
+        history = {}
+        for res in (
+                session.query(ResponseHistory)
+                .filter(ResponseHistory.submission_id == submission.id,
+                        ResponseHistory.approval.in_(
+                            ['final', 'reviewed', 'approved']))
+                .distinct(ResponseHistory.measure_id,
+                          ResponseHistory.approval)
+                .order_by(ResponseHistory.measure_id,
+                          ResponseHistory.approval,
+                          ResponseHistory.modified.desc())):
+            history.setdefault((res.measure_id, res.approval), res)
+
+        user_ids = {res.user_id for res in history.values()}
+        users = {}
+        if user_ids:
+            users = {
+                user.id: user
+                for user in (
+                    session.query(model.AppUser)
+                    .filter(model.AppUser.id.in_(user_ids)))}
+
+        history = {
+            key: (res, users.get(res.user_id))
+            for key, res in history.items()}
+        return responses, rnodes, history
+
     def write_approval(self, worksheet, line, column_num, response, user,
                        format, format_date):
 
@@ -641,3 +722,40 @@ class Exporter:
                     sheet.write(line, col, "%s" % part["value"], format)
                 col = col + 1
         return col
+
+
+class RowBuffer:
+    '''
+    Collects cells and writes them to a worksheet in row order, as required
+    by xlsxwriter's constant_memory mode. Cells can be overwritten until their
+    row is flushed.
+    '''
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.rows = defaultdict(list)
+        self.next_row = 0
+
+    def write(self, row, col, *args):
+        self.add(row, (self.worksheet.write, row, col) + args)
+
+    def merge_range(self, first_row, first_col, last_row, last_col, *args):
+        self.add(first_row, (
+            self.worksheet.merge_range,
+            first_row, first_col, last_row, last_col) + args)
+
+    def add(self, row, call):
+        if row < self.next_row:
+            raise ValueError("Row %d has already been written" % row)
+        self.rows[row].append(call)
+
+    def flush(self, until=None):
+        '''
+        Writes all rows before `until`, or all rows if it is None.
+        '''
+        for row in sorted(self.rows):
+            if until is not None and row >= until:
+                break
+            for fn, *args in self.rows.pop(row):
+                fn(*args)
+            self.next_row = row + 1
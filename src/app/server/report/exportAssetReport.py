@@ -1,6 +1,5 @@
 import openpyxl as xl
 
-from concurrent.futures import ThreadPoolExecutor
 import os
 import tempfile
 
@@ -14,6 +13,7 @@ import tornado.web
 
 import base_handler
 import errors
+import executors
 import model
 from tornado.escape import json_encode
 
@@ -26,9 +26,8 @@ table1FirstColumn = 1
 table2FirstColumn = 12
 targetColumnName = 'Target'
 BUF_SIZE = 4096
-MAX_WORKERS = 4
 class ExportAssetHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('reports')
         
 
 
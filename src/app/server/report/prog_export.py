@@ -1,5 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
-import os
 import tempfile
 
 from tornado import gen
@@ -8,16 +6,17 @@ from tornado.concurrent import run_on_executor
 
 import base_handler
 import errors
+import executors
 from .export import Exporter
 import model
 
 
-BUF_SIZE = 4096
-MAX_WORKERS = 4
+# Workbooks larger than this (bytes) are spooled to disk
+SPOOL_SIZE = 8 * 1024**2
 
 
 class ExportProgramHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('reports')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -44,39 +43,32 @@ class ExportProgramHandler(base_handler.BaseHandler):
             policy.verify('report_survey_export')
             role = user_session.user.role
 
-        output_file = 'program_{0}_survey_{1}_{2}.xlsx'.format(
-            program_id, survey_id, fmt)
         base_url = ("%s://%s" % (
             self.request.protocol, self.request.host))
 
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            output_path = os.path.join(tmpdirname, output_file)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as output:
             if fmt == 'tabular':
                 yield self.export_tabular(
-                    output_path, program_id, survey_id, role, base_url)
+                    output, program_id, survey_id, role, base_url)
             else:
                 yield self.export_nested(
-                    output_path, program_id, survey_id, role, base_url)
+                    output, program_id, survey_id, role, base_url)
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header('Content-Disposition', 'attachment')
-
-            with open(output_path, 'rb') as f:
-                while True:
-                    data = f.read(BUF_SIZE)
-                    if not data:
-                        break
-                    self.write(data)
+            yield self.write_file(output)
 
         self.finish()
 
     @run_on_executor
-    def export_tabular(self, path, program_id, survey_id, user_role, base_url):
+    def export_tabular(self, output, program_id, survey_id, user_role,
+                       base_url):
         e = Exporter()
         program_id = e.process_tabular(
-            path, program_id, survey_id, None, user_role, base_url)
+            output, program_id, survey_id, None, user_role, base_url)
 
     @run_on_executor
-    def export_nested(self, path, program_id, survey_id, user_role, base_url):
+    def export_nested(self, output, program_id, survey_id, user_role,
+                      base_url):
         e = Exporter()
         program_id = e.process_nested(
-            path, program_id, survey_id, None, user_role, base_url)
+            output, program_id, survey_id, None, user_role, base_url)
@@ -1,7 +1,9 @@
 import json
+import os
 
-import numpy
-from sqlalchemy.orm import joinedload
+from expiringdict import ExpiringDict
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import array
 import tornado.web
 
 import base_handler
@@ -13,6 +15,11 @@ import logging
 
 log = logging.getLogger('app.report.sub_stats')
 
+# Dashboard charts request the same statistics repeatedly, so they are cached
+# for a short time (seconds). Set STATS_CACHE_TTL=0 to disable the cache.
+CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 30))
+cache = ExpiringDict(max_len=1000, max_age_seconds=max(CACHE_TTL, 1))
+
 
 class StatisticsHandler(base_handler.Paginate, base_handler.BaseHandler):
 
@@ -38,48 +45,64 @@ class StatisticsHandler(base_handler.Paginate, base_handler.BaseHandler):
             policy.verify('surveygroup_interact')
             policy.verify('report_chart')
 
-            responseNodes = (
-                session.query(model.ResponseNode)
-                .join(model.ResponseNode.qnode)
-                .join(model.ResponseNode.submission)
-                .options(joinedload('qnode'))
-                .filter(
-                    model.ResponseNode.program_id == program_id,
-                    model.QuestionNode.survey_id == survey_id,
-                    model.QuestionNode.parent_id == parent_id,
-                    model.Submission.approval.in_(included_approval_states),
-                    model.Submission.deleted == False,
-                    model.QuestionNode.deleted == False))
+            key = (str(program_id), str(survey_id), parent_id, approval)
+            son = cache.get(key) if CACHE_TTL > 0 else None
+            if son is None:
+                son = self.get_statistics(
+                    session, program_id, survey_id, parent_id,
+                    included_approval_states)
+                if CACHE_TTL > 0:
+                    cache[key] = son
 
-            response = []
-            for responseNode in responseNodes:
-                r = [res for res in response
-                     if res["qnodeId"] == str(responseNode.qnode.id)]
-                if len(r) == 0:
-                    r = {
-                        "qnodeId": str(responseNode.qnode.id),
-                        "title": str(responseNode.qnode.title),
-                        "data": [],
-                    }
-                    response.append(r)
-                else:
-                    r = r[0]
+        self.set_header("Content-Type", "application/json")
+        self.write(son)
+        self.finish()
 
-                r["data"].append(responseNode.score)
+    def get_statistics(
+            self, session, program_id, survey_id, parent_id,
+            included_approval_states):
+        '''
+        Aggregates the scores of the child qnodes of `parent_id` across all
+        submissions, returning one row per qnode.
+        @return the statistics as a JSON string
+        '''
+        score = model.ResponseNode.score
+        quartiles = (
+            func.percentile_cont(array([0.25, 0.5, 0.75]))
+            .within_group(score))
 
-            for r in response:
-                data = r["data"]
-                r["min"] = min(data)
-                r["max"] = max(data)
-                r["count"] = len(data)
-                numpy_array = numpy.array(data)
-                # r["std"] = numpy.std(numpy_array)
-                r["quartile"] = [
-                    numpy.percentile(numpy_array, 25),
-                    numpy.percentile(numpy_array, 50),
-                    numpy.percentile(numpy_array, 75),
-                ]
+        query = (
+            session.query(
+                model.QuestionNode.id,
+                model.QuestionNode.title,
+                func.min(score),
+                func.max(score),
+                func.count(score),
+                quartiles)
+            .select_from(model.ResponseNode)
+            .join(model.ResponseNode.qnode)
+            .join(model.ResponseNode.submission)
+            .filter(
+                model.ResponseNode.program_id == program_id,
+                model.QuestionNode.survey_id == survey_id,
+                model.QuestionNode.parent_id == parent_id,
+                model.Submission.approval.in_(included_approval_states),
+                model.Submission.deleted == False,
+                model.QuestionNode.deleted == False)
+            .group_by(
+                model.QuestionNode.id,
+                model.QuestionNode.title,
+                model.QuestionNode.seq)
+            .order_by(model.QuestionNode.seq))
 
-        self.set_header("Content-Type", "application/json")
-        self.write(json.dumps(response))
-        self.finish()
+        return json.dumps([
+            {
+                "qnodeId": str(qnode_id),
+                "title": str(title),
+                "min": min_score,
+                "max": max_score,
+                "count": count,
+                "quartile": list(quartile),
+            }
+            for qnode_id, title, min_score, max_score, count, quartile
+            in query])
@@ -1,10 +1,8 @@
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
 import datetime
 import itertools
 import logging
 from numbers import Number
-import os
 import tempfile
 
 import numpy as np
@@ -18,19 +16,24 @@ import xlsxwriter
 import base_handler
 from crud.approval import APPROVAL_STATES
 import errors
+import executors
 import model
 from utils import keydefaultdict
 
 
-BUF_SIZE = 4096
-MAX_WORKERS = 4
+# Workbooks larger than this (bytes) are spooled to disk
+SPOOL_SIZE = 8 * 1024**2
 MIN_CONSITUENTS = 5
+# Maximum number of cells to pivot at once when computing statistics
+STATS_BLOCK_SIZE = 2 * 1024**2
+STATISTIC_NAMES = [
+    "Min", "1st Quartile", "Median", "3rd Quartile", "Max", "Consituents"]
 
 log = logging.getLogger('app.report.temporal')
 
 
 class TemporalReportHandler(base_handler.BaseHandler):
-    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    executor = executors.get('reports')
 
     @tornado.web.authenticated
     @gen.coroutine
@@ -75,9 +78,9 @@ class TemporalReportHandler(base_handler.BaseHandler):
             else:
                 surveygroup_ids = None
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            outpath, outfile, info = yield self.process_temporal(
-                parameters, survey_id, tmpdir, extension, surveygroup_ids)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as output:
+            info = yield self.process_temporal(
+                parameters, survey_id, output, extension, surveygroup_ids)
 
             for message in info:
                 self.reason(message)
@@ -85,13 +88,7 @@ class TemporalReportHandler(base_handler.BaseHandler):
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header(
                 'Content-Disposition', 'attachment')
-
-            with open(outpath, 'rb') as f:
-                while True:
-                    data = f.read(BUF_SIZE)
-                    if not data:
-                        break
-                    self.write(data)
+            yield self.write_file(output)
 
         self.finish()
 
@@ -121,29 +118,30 @@ class TemporalReportHandler(base_handler.BaseHandler):
 
     @run_on_executor
     def process_temporal(
-            self, parameters, survey_id, tmpdir, extension, surveygroup_ids):
+            self, parameters, survey_id, output, extension, surveygroup_ids):
         with model.session_scope() as session:
             query = self.build_query(session, parameters, survey_id)
             responses = query.all()
 
             info = []
             if surveygroup_ids is not None:
-                surveygroups = (
-                    session.query(model.SurveyGroup)
-                    .filter(model.SurveyGroup.id.in_(surveygroup_ids)))
                 responses, filter_info = self.filter_by_surveygroup(
-                    responses, surveygroups)
+                    session, responses, surveygroup_ids)
                 info.extend(filter_info)
 
-            responses, filter_info = self.filter_deleted_structure(responses)
+            qnode_measures = self.load_qnode_measures(
+                session, responses, survey_id)
+            responses, filter_info = self.filter_deleted_structure(
+                responses, qnode_measures)
             info.extend(filter_info)
 
             interval = Interval.from_parameters(parameters)
-            bucketer = TemporalResponseBucketer(interval)
+            bucketer = TemporalResponseBucketer(interval, qnode_measures)
             for response in responses:
                 bucketer.add(response)
-            table_meta = bucketer.to_table_meta()
-            rows = self.create_detail_rows(table_meta)
+            organisations = self.load_organisations(
+                session, bucketer.organisation_ids)
+            table_meta = bucketer.to_table_meta(organisations)
 
             if parameters.type == 'summary':
                 report_type = 'summary'
@@ -151,32 +149,40 @@ class TemporalReportHandler(base_handler.BaseHandler):
                     session
                     .query(model.Organisation)
                     .get(parameters.organisation_id))
-                rows = self.convert_to_stats(
-                    rows, organisation, parameters.min_constituents)
+                rows = self.create_summary_rows(
+                    table_meta, organisation, parameters.min_constituents)
             else:
                 report_type = 'detail'
+                rows = self.create_detail_rows(table_meta)
 
             cols, rows = self.create_table(rows, table_meta, report_type)
 
         if extension == 'xlsx':
-            outfile = "%s.xlsx" % report_type
-            outpath = os.path.join(tmpdir, outfile)
-            writer = XlWriter(outpath)
+            writer = XlWriter(output)
         else:
             raise errors.MissingDocError(
                 "File type not supported: %s" % extension)
 
         writer.write(cols, rows, parameters, info)
 
-        return outpath, outfile, info
+        return info
 
     def build_query(self, session, parameters, survey_id):
-        # All responses to current survey
+        # All responses to current survey. Only the columns needed for the
+        # report are fetched: loading whole Response objects is much slower
+        # when there are hundreds of thousands of them.
         query = (
-            session.query(model.Response)
-            .options(joinedload('submission'))
-            .options(joinedload('submission.organisation'))
-            .options(joinedload('qnode_measure'))
+            session.query(
+                model.Response.measure_id,
+                model.Response.program_id,
+                model.Response.survey_id,
+                model.Response.submission_id,
+                model.Response.score,
+                model.Response.not_relevant,
+                model.Response.response_parts,
+                model.Submission.organisation_id,
+                model.Submission.created)
+            .select_from(model.Response)
             .join(model.Submission)
             .join(model.Survey)
             .join(model.Organisation)
@@ -281,143 +287,204 @@ class TemporalReportHandler(base_handler.BaseHandler):
             query = size_filter(query)
         return query
 
-    def filter_by_surveygroup(self, responses, surveygroups):
-        excluded_orgs = set()
-        excluded_programs = set()
+    def filter_by_surveygroup(self, session, responses, surveygroup_ids):
+        surveygroups = set(
+            session.query(model.SurveyGroup)
+            .filter(model.SurveyGroup.id.in_(surveygroup_ids)))
+        organisations = (
+            session.query(model.Organisation)
+            .options(joinedload('surveygroups'))
+            .filter(model.Organisation.id.in_(
+                {r.organisation_id for r in responses})))
+        programs = (
+            session.query(model.Program)
+            .options(joinedload('surveygroups'))
+            .filter(model.Program.id.in_(
+                {r.program_id for r in responses})))
+        excluded_orgs = {
+            org.id for org in organisations
+            if org.surveygroups.isdisjoint(surveygroups)}
+        excluded_programs = {
+            program.id for program in programs
+            if program.surveygroups.isdisjoint(surveygroups)}
+
         filtered_responses = []
+        reported_orgs = set()
+        reported_programs = set()
         for r in responses:
-            org = r.submission.organisation
-            program = r.submission.program
-            assert r.surveygroups == (org.surveygroups & program.surveygroups)
-            if org in excluded_orgs:
+            if r.organisation_id in excluded_orgs:
+                reported_orgs.add(r.organisation_id)
                 continue
-            elif org.surveygroups.isdisjoint(surveygroups):
-                excluded_orgs.add(org)
-                continue
-
-            if program in excluded_programs:
-                continue
-            elif program.surveygroups.isdisjoint(surveygroups):
-                excluded_programs.add(program)
+            if r.program_id in excluded_programs:
+                reported_programs.add(r.program_id)
                 continue
             filtered_responses.append(r)
 
         info = []
-        if excluded_orgs:
+        if reported_orgs:
             info.append(
                 "Excluded %d organisation(s) that are not in your survey "
-                "groups" % len(excluded_orgs))
-        if excluded_programs:
+                "groups" % len(reported_orgs))
+        if reported_programs:
             info.append(
                 "Excluded %d program(s) that are not in your survey "
-                "groups" % len(excluded_programs))
+                "groups" % len(reported_programs))
         return filtered_responses, info
 
-    def filter_deleted_structure(self, responses):
+    def load_qnode_measures(self, session, responses, survey_id):
+        '''
+        @return a dict of the QnodeMeasures that the responses belong to,
+            keyed by (program_id, survey_id, measure_id).
+        '''
+        program_ids = {r.program_id for r in responses}
+        qnode_measures = (
+            session.query(model.QnodeMeasure)
+            .options(joinedload('measure').joinedload('response_type'))
+            .filter(model.QnodeMeasure.survey_id == survey_id)
+            .filter(model.QnodeMeasure.program_id.in_(program_ids)))
+        return {
+            (qm.program_id, qm.survey_id, qm.measure_id): qm
+            for qm in qnode_measures}
+
+    def load_organisations(self, session, organisation_ids):
+        organisations = (
+            session.query(model.Organisation)
+            .filter(model.Organisation.id.in_(organisation_ids)))
+        return {org.id: org for org in organisations}
+
+    def filter_deleted_structure(self, responses, qnode_measures):
         deleted_things = keydefaultdict(
             lambda t: t.closest_deleted_ancestor() is not None)
-        filtered_responses = [
-            r for r in responses
-            if not deleted_things[r.qnode_measure]]
+        filtered_responses = []
+        for r in responses:
+            qm = qnode_measures.get((r.program_id, r.survey_id, r.measure_id))
+            if qm is not None and not deleted_things[qm]:
+                filtered_responses.append(r)
         return filtered_responses, []
 
+    def create_qm_rows(self, table_meta, qm_i):
+        qm = table_meta.qnode_measures[qm_i]
+        n_parts = table_meta.part_lengths[qm_i]
+        qm_rows = [QnodeMeasureRow(qm, -1)]
+        qm_rows.extend(QnodeMeasureRow(qm, i) for i in range(n_parts))
+
+        # The response type may change between programs. Part names are
+        # taken from the last response that has each part, so only the last
+        # occurrence of each program's qnode measure matters.
+        responses = table_meta.index[qm_i].ravel()
+        response_qms = OrderedDict()
+        for response_i in responses[responses >= 0]:
+            qm = table_meta.get_qnode_measure(table_meta.responses[response_i])
+            response_qms.pop(qm, None)
+            response_qms[qm] = True
+        for qm in response_qms:
+            for qm_row in qm_rows:
+                qm_row.update(qm)
+        return qm_rows
+
     def create_detail_rows(self, table_meta):
         '''
         @return a list of OrganisationRows. These need further transformation
             before they can be rendered; see OrganisationRow for details. The
-            rows are sorted in the same way as the keys in `table_meta`.
+            rows are sorted by measure, part and organisation.
         '''
         rows = []
-        # Measure varies the most slowly, then organisation, then temporal
-        # bucket.
-        qm_rowset = []
-        measure_id = None
-        org_id = None
-        n_parts = 0
-        qm_rows = None
-        org_rows = None
-
-        def commit_rowset():
-            qm_rowset.sort(key=lambda org_row: org_row.qm_row.part_i)
-            rows.extend(qm_rowset)
-            qm_rowset.clear()
-
-        for qm, organisation, bucket in table_meta.keys():
-            if measure_id != qm.measure_id:
-                commit_rowset()
-                measure_id = qm.measure_id
-                n_parts = table_meta.part_lengths[measure_id]
-                qm_rows = [QnodeMeasureRow(qm, -1)]
-                qm_rows.extend(QnodeMeasureRow(qm, i) for i in range(n_parts))
-                org_id = None
-
-            if org_id != organisation.id:
-                org_id = organisation.id
-                org_rows = [
-                    OrganisationRow(qm_row, organisation)
-                    for qm_row in qm_rows]
-                qm_rowset.extend(org_rows)
-
-            k = (qm, organisation, bucket)
-            response = table_meta.get(k)
-            for org_row in org_rows:
-                org_row.append(response)
-            if response is not None:
-                for qm_row in qm_rows:
-                    qm_row.update(response.qnode_measure)
-
-        commit_rowset()
-
+        for qm_i in range(len(table_meta.qnode_measures)):
+            qm_rows = self.create_qm_rows(table_meta, qm_i)
+            for qm_row in qm_rows:
+                for org_i, organisation in enumerate(
+                        table_meta.organisations):
+                    rows.append(self.create_organisation_row(
+                        table_meta, qm_row, qm_i, org_i, organisation))
         return rows
 
-    def convert_to_stats(self, rows, organisation, min_constituents):
+    def create_organisation_row(
+            self, table_meta, qm_row, qm_i, org_i, organisation):
+        org_row = OrganisationRow(qm_row, organisation)
+        if org_i is not None:
+            for response_i in table_meta.index[qm_i, org_i]:
+                if response_i < 0:
+                    org_row.append(None)
+                else:
+                    org_row.append(table_meta.responses[response_i])
+        return org_row
+
+    def create_summary_rows(self, table_meta, organisation, min_constituents):
+        '''
+        @return a list of rows: for each measure part, the given
+            organisation's row followed by statistics across all
+            organisations.
+        '''
+        try:
+            org_i = table_meta.organisations.index(organisation)
+        except ValueError:
+            org_i = None
+
         out_rows = []
-        for qm_row, org_rows in itertools.groupby(
-                rows, key=lambda r: r.qm_row):
-
-            org_rows = list(org_rows)
-
-            dataset = [row.data() for row in org_rows]
-            cells = list(zip(*dataset))
-            stats = [self.compute_stats(c, min_constituents) for c in cells]
-            stats = list(zip(*stats))
-            try:
-                out_rows.append(next(
-                    org_row for org_row in org_rows
-                    if org_row.organisation == organisation))
-            except StopIteration:
-                out_rows.append(OrganisationRow(qm_row, organisation))
-            out_rows.append(StatisticRow(
-                qm_row, "Min", list(stats[0])))
-            out_rows.append(StatisticRow(
-                qm_row, "1st Quartile", list(stats[1])))
-            out_rows.append(StatisticRow(
-                qm_row, "Median", list(stats[2])))
-            out_rows.append(StatisticRow(
-                qm_row, "3rd Quartile", list(stats[3])))
-            out_rows.append(StatisticRow(
-                qm_row, "Max", list(stats[4])))
-            out_rows.append(StatisticRow(
-                qm_row, "Consituents", list(stats[5])))
+        for qm_start, qm_stop in self.get_blocks(table_meta):
+            stats = self.compute_stats(
+                table_meta.pivot(qm_start, qm_stop), min_constituents)
+            row_i = 0
+            for qm_i in range(qm_start, qm_stop):
+                for qm_row in self.create_qm_rows(table_meta, qm_i):
+                    out_rows.append(self.create_organisation_row(
+                        table_meta, qm_row, qm_i, org_i, organisation))
+                    for name, stat in zip(STATISTIC_NAMES, stats):
+                        out_rows.append(
+                            StatisticRow(qm_row, name, stat[row_i]))
+                    row_i += 1
 
         return out_rows
 
-    def compute_stats(self, cells, min_constituents):
+    def get_blocks(self, table_meta):
+        '''
+        Splits the measures into ranges whose pivot tables are no larger
+        than STATS_BLOCK_SIZE, to bound memory use.
+        '''
+        n_cols = len(table_meta.organisations) * len(table_meta.buckets)
+        start = 0
+        n_cells = 0
+        for qm_i, n_parts in enumerate(table_meta.part_lengths):
+            n_qm_cells = (n_parts + 1) * n_cols
+            if qm_i > start and n_cells + n_qm_cells > STATS_BLOCK_SIZE:
+                yield start, qm_i
+                start = qm_i
+                n_cells = 0
+            n_cells += n_qm_cells
+        if start < len(table_meta.part_lengths):
+            yield start, len(table_meta.part_lengths)
+
+    def compute_stats(self, values, min_constituents):
+        '''
+        Summarises a (row, organisation, bucket) array along the organisation
+        axis. Cells that don't hold a number should be NaN.
+        @return a list of statistics in the order of STATISTIC_NAMES. Each
+            one is a list of rows, and each row has a value for each bucket.
+        '''
         # TODO: for multiple-choice, show categorical spread of answers
-        constituents = [c for c in cells if isinstance(c, Number)]
-        if len(constituents) < min_constituents:
-            return (None,) * 5 + (0,)
-        np_columns = np.array(constituents)
-        results = (
-            min(np_columns),
-            np.percentile(np_columns, 25),
-            np.percentile(np_columns, 50),
-            np.percentile(np_columns, 75),
-            max(np_columns),
-            len(constituents),
-        )
-
-        return results
+
+        # np.nanpercentile works on one slice at a time, which is slow for
+        # large tables. Instead, sort along the organisation axis (which puts
+        # NaNs last) and interpolate between ranks for all slices at once.
+        values = np.sort(values, axis=1)
+        counts = np.sum(~np.isnan(values), axis=1)
+        last = np.maximum(counts - 1, 0)
+        rows = np.arange(values.shape[0])[:, np.newaxis]
+        cols = np.arange(values.shape[2])[np.newaxis, :]
+
+        def percentile(q):
+            rank = last * (q / 100)
+            lower = np.floor(rank).astype(int)
+            upper = np.ceil(rank).astype(int)
+            a = values[rows, lower, cols]
+            b = values[rows, upper, cols]
+            return a + (b - a) * (rank - lower)
+
+        stats = [percentile(q) for q in (0, 25, 50, 75, 100)]
+        insufficient = counts < max(min_constituents, 1)
+        stats = [np.where(insufficient, None, s).tolist() for s in stats]
+        stats.append(np.where(insufficient, 0, counts).tolist())
+        return stats
 
     def create_table(self, rows, table_meta, report_type):
         base_url = "%s://%s" % (self.request.protocol, self.request.host)
@@ -443,11 +510,14 @@ class TemporalReportHandler(base_handler.BaseHandler):
 
 
 class XlWriter:
-    def __init__(self, outpath):
-        self.outpath = outpath
+    def __init__(self, output):
+        self.output = output
 
     def write(self, cols, rows, parameters, info):
-        with xlsxwriter.Workbook(self.outpath) as workbook:
+        # Rows are written in order, so they can be flushed to disk as they
+        # go instead of being held in memory.
+        options = {'constant_memory': True}
+        with xlsxwriter.Workbook(self.output, options) as workbook:
             cell_formats = self.make_formats(workbook)
             self.write_meta(parameters, info, workbook, cell_formats)
             self.write_data(cols, rows, workbook, cell_formats)
@@ -574,38 +644,59 @@ class Interval:
 
 class TableMeta:
     '''
-    Bucketed responses sorted by measure, organisation and time.
+    Bucketed responses pivoted by measure, organisation and time. `index`
+    holds the position in `responses` of the latest response for each
+    measure, organisation and bucket, or -1 if there is none.
     '''
 
     def __init__(
-            self, bucketed_responses, qnode_measures, part_lengths,
-            organisations, buckets):
-        self.bucketed_responses = bucketed_responses
+            self, responses, index, qnode_measures, part_lengths,
+            organisations, buckets, all_qnode_measures):
+        self.responses = responses
+        self.index = index
         self.qnode_measures = qnode_measures
         self.part_lengths = part_lengths
         self.organisations = organisations
         self.buckets = buckets
+        self.all_qnode_measures = all_qnode_measures
+        self.scores = np.array(
+            [response.score for response in responses], dtype=float)
 
-    def keys(self):
-        return itertools.product(
-            self.qnode_measures, self.organisations, self.buckets)
-
-    def __getitem__(self, k):
-        response = self.get(k)
-        if response is None:
-            raise KeyError("No such response %s", k)
-        return response
-
-    def get(self, k, default=None):
-        qm, organisation, bucket = k
-        k = (qm.measure_id, organisation.id, bucket)
-        return self.bucketed_responses.get(k, default)
+    def get_qnode_measure(self, response):
+        return self.all_qnode_measures[
+            (response.program_id, response.survey_id, response.measure_id)]
 
-    def __iter__(self):
-        return iter(self.keys())
+    def pivot(self, qm_start, qm_stop):
+        '''
+        @return a (row, organisation, bucket) array of the measures in the
+            given range. Each measure has a row for its score followed by one
+            for each of its parts. Cells without a numeric value are NaN.
+        '''
+        part_lengths = self.part_lengths[qm_start:qm_stop]
+        offsets = np.cumsum([0] + [n + 1 for n in part_lengths])
+        values = np.full(
+            (offsets[-1], len(self.organisations), len(self.buckets)),
+            np.nan)
+
+        index = self.index[qm_start:qm_stop]
+        qm_is, org_is, bucket_is = np.nonzero(index >= 0)
+        response_is = index[qm_is, org_is, bucket_is]
+        values[offsets[qm_is], org_is, bucket_is] = self.scores[response_is]
+
+        # Parts are stored as JSON, so they have to be unpacked one by one.
+        for qm_i, org_i, bucket_i, response_i in zip(
+                qm_is, org_is, bucket_is, response_is):
+            response = self.responses[response_i]
+            row_i = offsets[qm_i] + 1
+            for part_i in range(part_lengths[qm_i]):
+                value = get_part_value(response, part_i)
+                if isinstance(value, Number):
+                    values[row_i + part_i, org_i, bucket_i] = value
+
+        return values
 
     def __len__(self):
-        return len(self.bucketed_responses)
+        return len(self.responses)
 
 
 class TemporalResponseBucketer:
@@ -613,42 +704,64 @@ class TemporalResponseBucketer:
     Buckets responses by measure, organisation and time.
     '''
 
-    def __init__(self, interval):
+    def __init__(self, interval, all_qnode_measures):
         self.interval = interval
+        self.all_qnode_measures = all_qnode_measures
         self.bucketed_responses = {}
-        self.buckets = set()
         self.qnode_measure_map = {}
         self.part_lengths = defaultdict(lambda: 0)
-        self.organisations = set()
+        self.organisation_ids = set()
 
     def add(self, response):
-        bucket = self.interval.lower_bound(response.submission.created)
+        bucket = self.interval.temporal_bucket(response.created)
         mid = response.measure_id
-        k = (mid, response.submission.organisation.id, bucket)
+        k = (mid, response.organisation_id, bucket)
 
         if k in self.bucketed_responses:
-            if (self.bucketed_responses[k].submission.created >
-                    response.submission.created):
+            if self.bucketed_responses[k].created > response.created:
                 return
 
         self.bucketed_responses[k] = response
 
-        self.buckets.add(bucket)
-        self.qnode_measure_map[mid] = response.qnode_measure
-        n_parts = len(response.measure.response_type.parts)
+        qm = self.all_qnode_measures[
+            (response.program_id, response.survey_id, mid)]
+        self.qnode_measure_map[mid] = qm
+        n_parts = len(qm.measure.response_type.parts)
         self.part_lengths[mid] = max(self.part_lengths[mid], n_parts)
-        self.organisations.add(response.submission.organisation)
+        self.organisation_ids.add(response.organisation_id)
 
-    def to_table_meta(self):
-        buckets = sorted(self.buckets)
+    def to_table_meta(self, organisations):
+        '''
+        @param organisations a dict of Organisations by ID
+        '''
+        buckets = sorted({k[2] for k in self.bucketed_responses})
         qnode_measures = sorted(
             self.qnode_measure_map.values(),
             key=lambda qm: qm.get_path_tuple())
         organisations = sorted(
-            self.organisations, key=lambda o: o.name)
+            (organisations[org_id] for org_id in self.organisation_ids),
+            key=lambda o: o.name)
+
+        qm_index = {qm.measure_id: i for i, qm in enumerate(qnode_measures)}
+        org_index = {org.id: i for i, org in enumerate(organisations)}
+        bucket_index = {bucket: i for i, bucket in enumerate(buckets)}
+        keys = list(self.bucketed_responses)
+        index = np.full(
+            (len(qnode_measures), len(organisations), len(buckets)), -1,
+            dtype=int)
+        if keys:
+            index[
+                [qm_index[k[0]] for k in keys],
+                [org_index[k[1]] for k in keys],
+                [bucket_index[k[2]] for k in keys]] = np.arange(len(keys))
+
         return TableMeta(
-            self.bucketed_responses.copy(), qnode_measures,
-            dict(self.part_lengths), organisations, buckets)
+            [self.bucketed_responses[k] for k in keys], index,
+            qnode_measures,
+            [self.part_lengths[qm.measure_id] for qm in qnode_measures],
+            organisations,
+            [self.interval.lower_bound_of_bucket(b) for b in buckets],
+            self.all_qnode_measures)
 
 
 class QnodeMeasureRow:
@@ -719,20 +832,7 @@ class OrganisationRow:
             for response in self.responses]
 
     def get_part(self, response):
-        if response is None:
-            return None
-        if self.qm_row.part_i < 0:
-            return response.score
-        if response.not_relevant:
-            return "NA"
-        try:
-            part = response.response_parts[self.qm_row.part_i]
-        except (IndexError, TypeError):
-            return None
-        try:
-            return "%d. %s" % (part['index'] + 1, part['note'])
-        except KeyError:
-            return part.get('value', None)
+        return get_part_value(response, self.qm_row.part_i)
 
     def link(self, base_url):
         if self.latest_response is not None:
@@ -740,7 +840,7 @@ class OrganisationRow:
                 "Response",
                 "{}/#/3/measure/{}?submission={}".format(
                     base_url, self.latest_response.measure_id,
-                    self.latest_response.submission.id))
+                    self.latest_response.submission_id))
         else:
             return self.qm_row.link(base_url)
 
@@ -764,3 +864,20 @@ class Link:
     def __init__(self, title, url):
         self.title = title
         self.url = url
+
+
+def get_part_value(response, part_i):
+    if response is None:
+        return None
+    if part_i < 0:
+        return response.score
+    if response.not_relevant:
+        return "NA"
+    try:
+        part = response.response_parts[part_i]
+    except (IndexError, TypeError):
+        return None
+    try:
+        return "%d. %s" % (part['index'] + 1, part['note'])
+    except KeyError:
+        return part.get('value', None)
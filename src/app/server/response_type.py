@@ -1,9 +1,14 @@
+from functools import lru_cache
 import logging
 import statistics
-from py_expression_eval import Parser
+from threading import Lock
+
+from py_expression_eval import Parser, TFUNCALL, TNUMBER, TOP1, TOP2, TVAR
 from voluptuous import All, Any, Coerce, Length, Match, Optional, Required, \
     Schema
 
+from cache import LruCache
+
 
 log = logging.getLogger('app.response_type')
 
@@ -97,11 +102,131 @@ def unique_strings(ss):
 
 def parse(exp):
     try:
-        return parser.parse(exp) if exp else None
+        return compile_expression(exp) if exp else None
     except Exception as e:
         raise ExpressionError("'%s': %s" % (exp, e))
 
 
+@lru_cache(maxsize=1024)
+def compile_expression(exp):
+    return CompiledExpression(parser.parse(exp))
+
+
+class CompiledExpression:
+    '''
+    A parsed expression that has been translated to a Python function, so
+    that evaluating it is a single call instead of a walk over the token
+    list. Evaluation raises the same exceptions as the parsed expression.
+    Expressions that can't be translated are interpreted as before.
+    '''
+
+    # Operators that behave exactly like the parser's implementations
+    INLINE_OPS1 = {'-'}
+    INLINE_OPS2 = {
+        '+', '-', '*', '/', '%', '==', '!=', '>', '<', '>=', '<='}
+
+    def __init__(self, expression):
+        self.expression = expression
+        try:
+            self.evaluate = self.translate(expression)
+        except CompilationError:
+            self.evaluate = expression.evaluate
+
+    def evaluate(self, scope):
+        # Replaced by the translated function in __init__
+        return self.expression.evaluate(scope)
+
+    def variables(self):
+        return self.expression.variables()
+
+    def toString(self):
+        return self.expression.toString()
+
+    def translate(self, expression):
+        # Constants, names and operator functions are passed to the generated
+        # code by reference, so no part of the expression is ever interpreted
+        # as Python source.
+        namespace = {
+            '_var': variable_lookup(expression.functions),
+            '_call': call_function,
+        }
+
+        def ref(value):
+            name = '_%d' % len(namespace)
+            namespace[name] = value
+            return name
+
+        stack = []
+        for token in expression.tokens:
+            arity = {TOP1: 1, TOP2: 2, TFUNCALL: 2}.get(token.type_, 0)
+            if len(stack) < arity:
+                raise CompilationError()
+            if token.type_ == TNUMBER:
+                stack.append((ref(token.number_), None))
+            elif token.type_ == TVAR:
+                name = ref(token.index_)
+                stack.append((
+                    "(_s[%s] if %s in _s else _var(%s))" % (name, name, name),
+                    None))
+            elif token.type_ == TOP1:
+                a, _ = stack.pop()
+                if token.index_ in self.INLINE_OPS1:
+                    code = "(%s%s)" % (token.index_, a)
+                elif token.index_ in expression.ops1:
+                    code = "%s(%s)" % (ref(expression.ops1[token.index_]), a)
+                else:
+                    raise CompilationError()
+                stack.append((code, None))
+            elif token.type_ == TOP2:
+                b, _ = stack.pop()
+                a, _ = stack.pop()
+                if token.index_ in self.INLINE_OPS2:
+                    code = "(%s %s %s)" % (a, token.index_, b)
+                elif token.index_ in expression.ops2:
+                    code = "%s(%s, %s)" % (
+                        ref(expression.ops2[token.index_]), a, b)
+                else:
+                    raise CompilationError()
+                stack.append((code, token.index_))
+            elif token.type_ == TFUNCALL:
+                args, op = stack.pop()
+                f, _ = stack.pop()
+                if op != ',':
+                    # Only argument lists are unpacked into the call; leave
+                    # single arguments to the interpreter.
+                    raise CompilationError()
+                stack.append(("_call(%s, %s)" % (f, args), None))
+            else:
+                raise CompilationError()
+        if len(stack) != 1:
+            raise CompilationError()
+
+        source = (
+            "def evaluate(_s):\n"
+            "    _s = _s or {}\n"
+            "    return %s\n" % stack[0][0])
+        exec(compile(source, '<expression>', 'exec'), namespace)
+        return namespace['evaluate']
+
+
+class CompilationError(Exception):
+    pass
+
+
+def variable_lookup(functions):
+    def variable(name):
+        if name in functions:
+            return functions[name]
+        raise Exception('undefined variable: ' + name)
+    return variable
+
+
+def call_function(f, args):
+    if callable(f):
+        return f(*args)
+    raise Exception(f + ' is not a function')
+
+
 def refs(c_exp):
     return c_exp.variables() if c_exp else []
 
@@ -194,6 +319,63 @@ class ResponseType:
         return "ResponseType(%s)" % (self.name)
 
 
+class ResponseTypeCache:
+    '''
+    A process-wide cache of materialised response types. Entries are keyed by
+    the identity of the response type definition (a model.ResponseType) and
+    its modification time, so a changed definition is never served stale.
+    '''
+
+    def __init__(self, size=500):
+        self.cache = LruCache(size=size)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, definition):
+        '''
+        Returns:
+            The materialised ResponseType of a response type definition.
+        '''
+        key = (definition.id, definition.program_id, definition.modified)
+        if None in key:
+            # Not flushed yet, so it can't be identified
+            return ResponseType(
+                definition.name, definition.parts, definition.formula)
+
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+
+        materialised = ResponseType(
+            definition.name, definition.parts, definition.formula)
+        with self.lock:
+            self.cache[key] = materialised
+        return materialised
+
+    def invalidate(self, definition):
+        '''
+        Drop all cached versions of a response type definition.
+        '''
+        with self.lock:
+            for key in list(self.cache):
+                if key[:2] == (definition.id, definition.program_id):
+                    del self.cache[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+response_types = ResponseTypeCache()
+
+
 def response_part(p_def):
     if p_def['type'] == 'multiple_choice':
         return MultipleChoice(p_def)
@@ -13,12 +13,20 @@ depend on other measures, or they may stand alone.
 Together these form a single graph. This module solves the graph.
 '''
 
+from collections import defaultdict
 from datetime import datetime
+from threading import Lock
 
-from cache import instance_method_lru_cache
-from dag import Graph, GraphBuilder, NodeBuilder, Ops, OpsProxy
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import object_session
+
+from cache import instance_method_lru_cache, LruCache
+from dag import CompiledGraph, CompiledGraphBuilder, Graph, \
+    IterativeGraphBuilder, NodeBuilder, Ops, OpsProxy
 import model
-from response_type import ResponseError, ResponseType
+from response_type import ResponseError, response_types
 
 
 class ScoreError(Exception):
@@ -31,7 +39,7 @@ class ScoreError(Exception):
 class Calculator:
     def __init__(self, config):
         self.config = config
-        self.builder = GraphBuilder()
+        self.builder = IterativeGraphBuilder()
 
     @classmethod
     def structural(cls):
@@ -41,11 +49,25 @@ class Calculator:
         return cls(config)
 
     @classmethod
-    def scoring(cls, submission):
+    def scoring(cls, submission, preload=False):
+        '''
+        Args:
+            submission: The submission to calculate scores for.
+            preload: Load the whole survey and all of the submission's
+                responses up front, instead of one node at a time as the
+                graph is evaluated. Use this when most of the survey is
+                going to be recalculated.
+        '''
         config = GraphConfig()
-        manifest = ScoreManifest(submission)
+        if preload:
+            lookup = PreloadedLookup(submission)
+        else:
+            lookup = SessionLookup(submission)
+        manifest = ScoreManifest(submission, lookup)
         config.with_manifest(manifest)
-        return cls(config)
+        calculator = cls(config)
+        calculator.builder = SurveyGraphBuilder(submission.survey, config)
+        return calculator
 
     def mark_program_dirty(self, program, force_dependants=False):
         self.builder.add_with_dependants(
@@ -69,7 +91,7 @@ class Calculator:
 
     def execute(self):
         graph = self.builder.build()
-        graph.evaluate()
+        self.config.manifest.execute(graph)
 
 
 # Factories
@@ -85,8 +107,18 @@ class GraphConfig:
         self.survey_ops = OpsProxy()
         self.qnode_ops = OpsProxy()
         self.measure_ops = OpsProxy()
+        self.builders = {
+            model.Program: self.program_builder,
+            model.Survey: self.survey_builder,
+            model.QuestionNode: self.qnode_builder,
+            model.QnodeMeasure: self.measure_builder,
+        }
+
+    def ops(self, node):
+        return self.builders[type(node)].ops(node)
 
     def with_manifest(self, manifest):
+        self.manifest = manifest
         self.program_ops.ops = manifest.program_ops
         self.survey_ops.ops = manifest.survey_ops
         self.qnode_ops.ops = manifest.qnode_ops
@@ -101,13 +133,229 @@ class StructureManifest:
         self.qnode_ops = QnodeOps()
         self.measure_ops = MeasureOps()
 
+    def execute(self, graph):
+        graph.evaluate()
+
 
 class ScoreManifest:
-    def __init__(self, submission):
+    def __init__(self, submission, lookup):
         self.program_ops = SubmissionProgramOps()
-        self.survey_ops = SubmissionOps(submission)
-        self.qnode_ops = RnodeOps(submission)
-        self.measure_ops = ResponseOps(submission)
+        self.survey_ops = SubmissionOps(submission, lookup)
+        self.qnode_ops = RnodeOps(submission, lookup)
+        self.measure_ops = ResponseOps(submission, lookup)
+        self.submission = submission
+        self.lookup = lookup
+
+    def execute(self, graph):
+        '''
+        Score the submission in two phases. First, all missing rnodes are
+        created and inserted together. Then the graph is evaluated without
+        flushing, so the updated aggregates are written back in one batch
+        instead of being interleaved with the inserts.
+        '''
+        session = object_session(self.submission)
+        qnodes = [
+            meta.node for meta in graph.graph
+            if isinstance(meta.node, model.QuestionNode)]
+        self.lookup.create_rnodes(qnodes)
+        with session.no_autoflush:
+            graph.evaluate()
+        session.flush()
+
+
+# Submission lookups - these find the responses and rnodes that correspond to
+# nodes in the survey structure.
+
+
+class SessionLookup:
+    '''
+    Fetches responses and rnodes from the session one at a time, as they are
+    needed. This is cheapest when only a few measures are dirty, e.g. when a
+    single response is saved.
+    '''
+
+    def __init__(self, submission):
+        self.submission = submission
+        self.rnodes_by_qnode = {}
+
+    @instance_method_lru_cache()
+    def response(self, qnode_measure):
+        return model.Response.from_measure(qnode_measure, self.submission)
+
+    def rnode(self, qnode):
+        rnode = self.rnodes_by_qnode.get(qnode.id)
+        if rnode is None:
+            rnode = model.ResponseNode.from_qnode(qnode, self.submission)
+        return rnode
+
+    def find_rnodes(self, qnodes):
+        '''
+        Returns:
+            The existing rnodes of the given qnodes, keyed by qnode ID.
+        '''
+        qnode_ids = [qnode.id for qnode in qnodes]
+        if not qnode_ids:
+            return {}
+        session = object_session(self.submission)
+        rnodes = (
+            session.query(model.ResponseNode)
+            .filter(model.ResponseNode.submission_id == self.submission.id,
+                    model.ResponseNode.qnode_id.in_(qnode_ids))
+            .all())
+        return {rnode.qnode_id: rnode for rnode in rnodes}
+
+    def create_rnodes(self, qnodes):
+        '''
+        Ensure that every given qnode has an rnode in this submission. Missing
+        rnodes are inserted with a single flush.
+        '''
+        session = object_session(self.submission)
+        rnodes = self.find_rnodes(qnodes)
+        for qnode in qnodes:
+            if qnode.id in rnodes:
+                continue
+            rnode = model.ResponseNode(program=qnode.program, qnode=qnode)
+            rnode.submission_id = self.submission.id
+            session.add(rnode)
+            rnodes[qnode.id] = rnode
+        # Flush even if nothing was created, so that pending responses can be
+        # found by primary key while the graph is evaluated without autoflush.
+        session.flush()
+        self.rnodes_by_qnode.update(rnodes)
+
+    def child_rnodes(self, qnode):
+        for child in qnode.children:
+            rnode = self.rnode(child)
+            if rnode is not None:
+                yield rnode
+
+    def responses(self, qnode):
+        for qnode_measure in qnode.qnode_measures:
+            response = self.response(qnode_measure)
+            if response is not None:
+                yield response
+
+
+class PreloadedLookup(SessionLookup):
+    '''
+    Loads the survey structure and all of the submission's responses and
+    rnodes with a fixed number of set-based queries, and then serves lookups
+    from memory. The number of round trips doesn't depend on the size of the
+    survey.
+    '''
+
+    def __init__(self, submission):
+        super().__init__(submission)
+        session = object_session(submission)
+        self.structure = SurveyStructure(submission.survey)
+        responses = (
+            session.query(model.Response)
+            .filter(model.Response.submission_id == submission.id)
+            .all())
+        rnodes = (
+            session.query(model.ResponseNode)
+            .filter(model.ResponseNode.submission_id == submission.id)
+            .all())
+        self.responses_by_measure = {r.measure_id: r for r in responses}
+        self.rnodes_by_qnode = {r.qnode_id: r for r in rnodes}
+
+    def response(self, qnode_measure):
+        return self.responses_by_measure.get(qnode_measure.measure_id)
+
+    def rnode(self, qnode):
+        return self.rnodes_by_qnode.get(qnode.id)
+
+    def find_rnodes(self, qnodes):
+        return {
+            qnode.id: self.rnodes_by_qnode[qnode.id] for qnode in qnodes
+            if qnode.id in self.rnodes_by_qnode}
+
+
+class SurveyStructure:
+    '''
+    Loads the qnodes, qnode measures, variables and response types of a
+    survey with a fixed number of set-based queries, and links the structural
+    relationships between them so that walking the graph doesn't trigger lazy
+    loads.
+    '''
+
+    def __init__(self, survey):
+        session = object_session(survey)
+        program_id = survey.program_id
+        survey_id = survey.id
+
+        self.qnodes = (
+            session.query(model.QuestionNode)
+            .filter(model.QuestionNode.program_id == program_id,
+                    model.QuestionNode.survey_id == survey_id,
+                    model.QuestionNode.deleted == False)
+            .all())
+        self.qnode_measures = (
+            session.query(model.QnodeMeasure)
+            .options(joinedload('measure'))
+            .filter(model.QnodeMeasure.program_id == program_id,
+                    model.QnodeMeasure.survey_id == survey_id)
+            .all())
+        self.variables = (
+            session.query(model.MeasureVariable)
+            .filter(model.MeasureVariable.program_id == program_id,
+                    model.MeasureVariable.survey_id == survey_id)
+            .all())
+        # Response types are only needed in the identity map, so that
+        # Measure.response_type can be resolved without a query. Hold a
+        # reference so they aren't garbage collected.
+        self.response_types = (
+            session.query(model.ResponseType)
+            .filter(model.ResponseType.program_id == program_id)
+            .all())
+
+        self.link(survey)
+
+    def link(self, survey):
+        children = defaultdict(list)
+        for qnode in self.qnodes:
+            children[qnode.parent_id].append(qnode)
+        qnodes_by_id = {qnode.id: qnode for qnode in self.qnodes}
+
+        by_qnode = defaultdict(list)
+        for qnode_measure in self.qnode_measures:
+            if qnode_measure.qnode_id in qnodes_by_id:
+                by_qnode[qnode_measure.qnode_id].append(qnode_measure)
+
+        sources = defaultdict(list)
+        targets = defaultdict(list)
+        for var in self.variables:
+            sources[var.target_measure_id].append(var)
+            targets[var.source_measure_id].append(var)
+
+        by_seq = lambda ob: ob.seq
+        preload_collection(
+            survey, 'qnodes', sorted(children[None], key=by_seq))
+        for qnode in self.qnodes:
+            preload_collection(
+                qnode, 'parent', qnodes_by_id.get(qnode.parent_id))
+            preload_collection(
+                qnode, 'children', sorted(children[qnode.id], key=by_seq))
+            preload_collection(
+                qnode, 'qnode_measures',
+                sorted(by_qnode[qnode.id], key=by_seq))
+        for qnode_measure in self.qnode_measures:
+            preload_collection(
+                qnode_measure, 'source_vars',
+                sources[qnode_measure.measure_id])
+            preload_collection(
+                qnode_measure, 'target_vars',
+                targets[qnode_measure.measure_id])
+
+
+def preload_collection(ob, key, value):
+    '''
+    Set a relationship as though it had been loaded from the database.
+    Relationships that have already been loaded are left alone, so pending
+    changes are not lost.
+    '''
+    if key not in inspect(ob).dict:
+        set_committed_value(ob, key, value)
 
 
 # Survey builders - these know how to recursively build a DAG from the survey
@@ -181,6 +429,63 @@ class MeasureBuilder(NodeBuilder):
         return self.config.measure_ops
 
 
+# Compiled survey graphs - the topology of a survey's structure, cached so
+# that it doesn't need to be rediscovered every time a response is saved.
+
+
+compiled_graphs = LruCache(size=50)
+compiled_graphs_lock = Lock()
+
+
+def node_key(node):
+    return type(node), inspect(node).identity
+
+
+def compiled_survey_graph(survey, refresh=False):
+    '''
+    Returns:
+        The CompiledGraph of the survey's structure. It is cached for as long
+        as `survey.modified` is unchanged; any structural change updates that
+        field (see SurveyOps).
+    '''
+    key = (survey.id, survey.program_id, survey.modified)
+    with compiled_graphs_lock:
+        if not refresh and key in compiled_graphs:
+            return compiled_graphs[key]
+
+    SurveyStructure(survey)
+    config = GraphConfig()
+    builder = IterativeGraphBuilder()
+    builder.add_with_dependencies(survey, config.survey_builder)
+    compiled = CompiledGraph.from_builder(builder, node_key)
+
+    with compiled_graphs_lock:
+        compiled_graphs[key] = compiled
+    return compiled
+
+
+class SurveyGraphBuilder(CompiledGraphBuilder):
+    '''
+    Selects dirty nodes from the survey's cached CompiledGraph, and resolves
+    them to objects in the survey's session.
+    '''
+
+    def __init__(self, survey, config):
+        session = object_session(survey)
+        super().__init__(
+            compiled_survey_graph(survey), node_key,
+            lambda key: session.query(key[0]).get(key[1]),
+            config.ops)
+        self.survey = survey
+
+    def index(self, key):
+        if key not in self.compiled:
+            # The structure has changed without the survey's modification
+            # time being updated yet, e.g. earlier in this transaction.
+            self.compiled = compiled_survey_graph(self.survey, refresh=True)
+        return self.compiled.indices[key]
+
+
 # Survey structure ops - these update survey structure metadata.
 
 
@@ -292,13 +597,11 @@ class MeasureOps(CyclicMixin, Ops):
         entity.error = pluralize(
             n_errors, "A measure has an error", "%d measures have errors")
 
-    @instance_method_lru_cache()
     def get_response_type(self, response_type):
         '''
         Convert a response type definition to a materialised response type.
         '''
-        return ResponseType(
-            response_type.name, response_type.parts, response_type.formula)
+        return response_types.get(response_type)
 
 
 # Submission score ops - these update submission metadata (e.g. score).
@@ -314,43 +617,51 @@ class SubmissionProgramOps(Ops):
 
 
 class SubmissionOps(SurveyOps):
-    def __init__(self, submission):
+    def __init__(self, submission, lookup):
         self.submission = submission
+        self.lookup = lookup
 
     def evaluate(self, survey, dependencies, dependants):
         assert(self.submission.survey == survey)
+        rnodes = [
+            rnode for rnode in map(self.lookup.rnode, survey.qnodes)
+            if rnode is not None]
         stats = ResponseNodeStats()
-        for c in self.submission.rnodes:
+        for c in rnodes:
             stats.add_rnode(c)
         stats.to_submission(self.submission)
         self.errors(
             self.submission,
-            sum(1 for x in self.submission.rnodes if x.error))
+            sum(1 for x in rnodes if x.error))
 
 
 class RnodeOps(QnodeOps):
-    def __init__(self, submission):
+    def __init__(self, submission, lookup):
         self.submission = submission
+        self.lookup = lookup
 
     def evaluate(self, qnode, dependencies, dependants):
         assert(self.submission.survey == qnode.survey)
-        rnode = model.ResponseNode.from_qnode(qnode, self.submission, create=True)
+        rnode = self.lookup.rnode(qnode)
+        children = list(self.lookup.child_rnodes(qnode))
+        responses = list(self.lookup.responses(qnode))
         stats = ResponseNodeStats()
-        for child in rnode.children:
+        for child in children:
             stats.add_rnode(child)
-        for response in rnode.responses:
+        for response in responses:
             stats.add_response(response)
         stats.to_rnode(rnode)
 
         self.errors(
             rnode,
-            sum(1 for x in rnode.children if x.error),
-            sum(1 for x in rnode.responses if x.error))
+            sum(1 for x in children if x.error),
+            sum(1 for x in responses if x.error))
 
 
 class ResponseOps(MeasureOps):
-    def __init__(self, submission):
+    def __init__(self, submission, lookup):
         self.submission = submission
+        self.lookup = lookup
 
     def evaluate(self, qnode_measure, dependencies, dependants):
         assert(self.submission.survey == qnode_measure.survey)
@@ -383,9 +694,8 @@ class ResponseOps(MeasureOps):
             stats.reset(response)
             response.error = str(e)
 
-    @instance_method_lru_cache()
     def get_response(self, qnode_measure):
-        return model.Response.from_measure(qnode_measure, self.submission)
+        return self.lookup.response(qnode_measure)
 
     def external_variables(self, response, qnode_measure):
         scope = {}
@@ -415,6 +725,57 @@ class ResponseOps(MeasureOps):
         return scope
 
 
+def is_empty_part(part):
+    return (
+        part is None or part == {} or
+        ('index' not in part and 'value' not in part))
+
+
+def count_answers(parts, response_parts):
+    '''
+    Count the questions and answered questions of a response. Parts that
+    belong to the same submeasure are counted as one question.
+    @return (n_questions, n_answers)
+    '''
+    question = 0
+    answer = 0
+    if len(response_parts) == 0:
+        return question, answer
+
+    has_answer = True
+    seq = 0
+    for r, p in enumerate(parts):
+        if r < len(response_parts):
+            empty = is_empty_part(response_parts[r])
+        else:
+            empty = True
+        if 'submeasure_seq' not in p:
+            if seq > 0:
+                question += 1
+                if has_answer:
+                    answer += 1
+                else:
+                    has_answer = True
+            if empty and has_answer:
+                has_answer = False
+        elif has_answer or seq != p['submeasure_seq']:
+            if seq != p['submeasure_seq']:
+                if seq > 0:
+                    question += 1
+                    if has_answer:
+                        answer += 1
+                    else:
+                        has_answer = True
+                seq = p['submeasure_seq']
+            if empty and has_answer:
+                has_answer = False
+
+    if seq > 0 and has_answer:
+        answer += 1
+        question += 1
+    return question, answer
+
+
 class ResponseNodeStats:
     def __init__(self):
         self.score = 0.0
@@ -425,6 +786,8 @@ class ResponseNodeStats:
         self.n_not_relevant = 0
         self.max_importance = 0.0
         self.max_urgency = 0.0
+        self.n_questions = 0
+        self.n_answers = 0
 
     def add_rnode(self, rnode):
         self.score += rnode.score
@@ -435,6 +798,8 @@ class ResponseNodeStats:
         self.n_not_relevant += rnode.n_not_relevant
         self.max_importance = max(self.max_importance, rnode.max_importance or 0.0)
         self.max_urgency = max(self.max_importance, rnode.max_importance or 0.0)
+        self.n_questions += rnode.n_questions or 0
+        self.n_answers += rnode.n_answers or 0
 
     def add_response(self, response):
         self.score += response.score
@@ -448,6 +813,10 @@ class ResponseNodeStats:
             self.n_approved += 1
         if response.not_relevant:
             self.n_not_relevant += 1
+        n_questions, n_answers = count_answers(
+            response.measure.response_type.parts, response.response_parts)
+        self.n_questions += n_questions
+        self.n_answers += n_answers
 
     def to_rnode(self, rnode):
         rnode.score = self.score
@@ -458,6 +827,8 @@ class ResponseNodeStats:
         rnode.n_not_relevant = self.n_not_relevant
         rnode.max_importance = rnode.importance or self.max_importance
         rnode.max_urgency = rnode.urgency or self.max_urgency
+        rnode.n_questions = self.n_questions
+        rnode.n_answers = self.n_answers
 
     def to_submission(self, submission):
         pass
@@ -1,3 +1,6 @@
+from threading import Lock
+
+from expiringdict import ExpiringDict
 from sqlalchemy.orm.session import object_session
 
 import authz
@@ -14,13 +17,7 @@ class UserSession:
         self.policy = self.create_policy()
 
     def create_policy(self):
-        rule_declarations = config.get_resource('authz')
-        policy = authz.Policy(error_factory=errors.AuthzError, aspect='server')
-        for decl in rule_declarations:
-            policy.declare(decl)
-
-        policy.context.update({'s': self})
-        return policy
+        return base_policy().derive({'s': self})
 
     def member_of_any(self, surveygroups):
         surveygroups = {
@@ -52,3 +49,107 @@ class UserSession:
             .filter(model.PurchasedSurvey.organisation_id == self.org.id)
             .count())
         return count > 0
+
+
+class Identity:
+    '''
+    The facts about a user that are needed to authenticate a request.
+    '''
+    def __init__(self, user_id, role, organisation_id, deleted):
+        self.user_id = user_id
+        self.role = role
+        self.organisation_id = organisation_id
+        # True if the user or their organisation has been deleted
+        self.deleted = deleted
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            user.id, user.role, user.organisation_id,
+            user.deleted or user.organisation.deleted)
+
+    def __repr__(self):
+        return "Identity(user_id=%s, role=%s)" % (self.user_id, self.role)
+
+
+class IdentityCache:
+    '''
+    Short-lived cache of user identities, shared by all requests. Entries
+    expire after a few seconds so that changes made by other processes are
+    seen soon; changes made in this process should call `invalidate`.
+    '''
+
+    def __init__(self, max_len=1000, max_age_seconds=30):
+        self.identities = ExpiringDict(
+            max_len=max_len, max_age_seconds=max_age_seconds)
+        self.lock = Lock()
+
+    def get(self, session, user_ids):
+        '''
+        Look up identities, loading any that are not cached with one query.
+        @return a map of user ID to Identity; unknown users are omitted
+        '''
+        found = {}
+        missing = []
+        with self.lock:
+            for user_id in user_ids:
+                identity = self.identities.get(str(user_id))
+                if identity is not None:
+                    found[user_id] = identity
+                else:
+                    missing.append(user_id)
+        if not missing:
+            return found
+
+        rows = (
+            session.query(
+                model.AppUser.id, model.AppUser.role,
+                model.AppUser.organisation_id,
+                model.AppUser.deleted, model.Organisation.deleted)
+            .join(model.Organisation, model.AppUser.organisation)
+            .filter(model.AppUser.id.in_(missing)))
+        loaded = {
+            str(user_id): Identity(
+                user_id, role, org_id, deleted or org_deleted)
+            for user_id, role, org_id, deleted, org_deleted in rows}
+        self.update(loaded.values())
+
+        for user_id in missing:
+            if str(user_id) in loaded:
+                found[user_id] = loaded[str(user_id)]
+        return found
+
+    def update(self, identities):
+        with self.lock:
+            for identity in identities:
+                self.identities[str(identity.user_id)] = identity
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.identities.pop(str(user_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.identities.clear()
+
+
+identities = IdentityCache()
+
+
+_base_policy = (None, None)
+
+
+def base_policy():
+    '''
+    Get the policy declared in authz.yaml. The rules are compiled once and
+    shared by all user sessions, which derive their own context from it.
+    '''
+    global _base_policy
+    rule_declarations = config.get_resource('authz')
+    declarations, policy = _base_policy
+    if declarations is not rule_declarations:
+        policy = authz.Policy(error_factory=errors.AuthzError, aspect='server')
+        for decl in rule_declarations:
+            policy.declare(decl)
+        _base_policy = (rule_declarations, policy)
+    return policy
@@ -1,7 +1,9 @@
 import bleach
 from collections import defaultdict
 import datetime
+from functools import lru_cache
 import inspect
+from itertools import chain
 import logging
 import os
 import re
@@ -74,11 +76,11 @@ class ToSon:
     '''
 
     def __init__(self, *expressions, omit=False):
-        self._include = []
-        self._exclude = []
-        self._sanitise = []
+        self._include = PathMatcher()
+        self._exclude = PathMatcher()
+        self._sanitise = PathMatcher()
         self.omit = omit
-        self.visited = []
+        self.visited = set()
         self.add(*expressions)
 
     def add(self, *expressions):
@@ -100,32 +102,29 @@ class ToSon:
         '''
         for expression in expressions:
             if expression.startswith('<'):
-                self._sanitise.append(re.compile(expression[1:]))
-                self._include.append(re.compile(expression[1:]))
+                self._sanitise.add(expression[1:])
+                self._include.add(expression[1:])
             elif expression.startswith('!'):
-                self._exclude.append(re.compile(expression[1:]))
+                self._exclude.add(expression[1:])
             elif expression.startswith(r'\\'):
-                self._include.append(re.compile(expression[1:]))
+                self._include.add(expression[1:])
             else:
-                self._include.append(re.compile(expression))
+                self._include.add(expression)
 
     def exclude(self, *expressions):
         for expression in expressions:
-            self._exclude.append(re.compile(expression))
+            self._exclude.add(expression)
 
     def __call__(self, value, path=""):
-        log.debug('Visiting %s', path)
-        if value in self.visited:
+        key = id(value)
+        if key in self.visited:
             raise UtilException(
                 "Serialisation failed: cycle detected: %s" % path)
-        self.visited.append(value)
-        log.debug('Type is  %s', value.__class__)
+        self.visited.add(key)
 
         if isinstance(value, model.Base):
-            names = dir(value)
-
             son = DefaultMunch(undefined)
-            for name in names:
+            for name in self.field_plan(value):
                 if not self.can_emit(name, path):
                     continue
                 v = getattr(value, name)
@@ -168,13 +167,29 @@ class ToSon:
         else:
             son = value
 
-        if (isinstance(son, str) and
-                any(s.search(path) for s in self._sanitise)):
+        if (isinstance(son, str) and self._sanitise and
+                self._sanitise.search(path)):
             son = bleach.clean(son, strip=True)
 
-        self.visited.pop()
+        self.visited.discard(key)
         return son
 
+    def field_plan(self, value):
+        '''
+        Returns:
+            The names of the attributes of an entity that might be emitted,
+            in the same order as `dir(value)`.
+        '''
+        names = class_attributes(type(value))
+        extra = [
+            name for name in vars(value)
+            if name not in names.members and not name.startswith('_')]
+        if extra:
+            names = sorted(set(names.names).union(extra))
+        else:
+            names = names.names
+        return self._include.candidates(names)
+
     def can_emit(self, name, basepath):
         name = str(name)
         if name.startswith('_'):
@@ -183,16 +198,87 @@ class ToSon:
             return False
 
         path = "%s/%s" % (basepath, name)
-        log.debug('Testing %s', path)
-        if len(self._include) > 0:
-            if not any(item.search(path) for item in self._include):
+        if self._include:
+            if not self._include.search(path):
                 return False
-        if len(self._exclude) > 0:
-            if any(item.search(path) for item in self._exclude):
+        if self._exclude:
+            if self._exclude.search(path):
                 return False
         return True
 
 
+class ClassAttributes:
+    def __init__(self, cls):
+        self.names = tuple(
+            name for name in dir(cls)
+            if not name.startswith('_') and name != 'metadata')
+        self.members = frozenset(dir(cls))
+
+
+@lru_cache(maxsize=None)
+def class_attributes(cls):
+    '''
+    Returns:
+        The public attribute names of a class, as listed by `dir`. Instances
+        may have more attributes of their own.
+    '''
+    return ClassAttributes(cls)
+
+
+class PathMatcher:
+    '''
+    A set of regular expressions that are tested against field paths, as
+    used by ToSon. Most expressions look like r'/name$', which can only
+    match a field with that exact name. Those are indexed by name, so only
+    the expressions that could match a field are searched.
+    '''
+
+    # A final path component that is plain text, anchored to the end
+    LITERAL_NAME = re.compile(r'/(\w+)\$$')
+
+    def __init__(self):
+        self.by_name = defaultdict(list)
+        self.general = []
+        self.n_expressions = 0
+
+    def add(self, expression):
+        pattern = re.compile(expression)
+        match = self.LITERAL_NAME.search(expression)
+        # Alternation and inline flags could make the final name optional
+        if match and '|' not in expression and '(?' not in expression:
+            self.by_name[match.group(1)].append(pattern)
+        else:
+            self.general.append(pattern)
+        self.n_expressions += 1
+
+    def __bool__(self):
+        return self.n_expressions > 0
+
+    def search(self, path):
+        '''
+        Returns:
+            True if any expression matches the path.
+        '''
+        name = path[path.rfind('/') + 1:]
+        patterns = self.by_name.get(name, ())
+        if name.endswith('\n'):
+            # `$` also matches before a trailing newline
+            patterns = chain(patterns, self.by_name.get(name[:-1], ()))
+        for pattern in chain(patterns, self.general):
+            if pattern.search(path):
+                return True
+        return False
+
+    def candidates(self, names):
+        '''
+        Returns:
+            The names that an expression could match, in the same order.
+        '''
+        if self.general or not self:
+            return names
+        return [name for name in names if name in self.by_name]
+
+
 def to_camel_case(name):
     components = name.split('_')
     components = [components[0]] + [c.title() for c in components[1:]]
@@ -105,6 +105,33 @@ class AuthNTest(base.AqHttpTestBase):
                         super_email, user_email))
                 self.assertEqual(code, response.code)
 
+    def test_disabled_user(self):
+        '''
+        Ensure users are locked out as soon as they are disabled, even though
+        their identity is cached.
+        '''
+        with model.session_scope() as session:
+            clerk = (
+                session.query(model.AppUser)
+                .filter(model.AppUser.email == 'clerk')
+                .one())
+            clerk_id = str(clerk.id)
+
+        with base.mock_user('clerk'):
+            self.fetch(
+                "/program.json", method='GET',
+                follow_redirects=False, expected=200)
+
+        with base.mock_user('org_admin'):
+            self.fetch(
+                "/user/%s.json" % clerk_id, method='DELETE', expected=200)
+
+        with base.mock_user('clerk'):
+            response = self.fetch(
+                "/program.json", method='GET',
+                follow_redirects=False, expected=403)
+            self.assertIn("account has been disabled", response.reason)
+
     def test_impersonate_expired(self):
         '''
         Ensure superusers can't keep impersonating after jurisdiction
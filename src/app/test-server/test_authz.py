@@ -1,5 +1,8 @@
 import datetime
 import logging
+import os
+import time
+import unittest
 
 from munch import DefaultMunch
 from tornado.escape import json_encode
@@ -105,6 +108,33 @@ class TestPermissionError(Exception):
     pass
 
 
+@unittest.skipUnless(
+    os.environ.get('BENCHMARK'), "Set BENCHMARK=1 to run benchmarks")
+class AuthzBenchmark(base.LoggingTestCase):
+    '''
+    Measures how many rules can be verified per second, deriving a policy
+    for each request as the handlers do.
+    '''
+
+    setUp = AuthzMechanismTest.setUp
+
+    def test_verify_rate(self):
+        context = DefaultMunch.fromDict({
+            's': {
+                'has_role': lambda name: name in {'org_admin'},
+                'org': {'id': 'foo'}
+            },
+        }, default=undefined)
+        user_policy = self.policy.derive(context)
+        n = 20000
+        start = time.perf_counter()
+        for i in range(n):
+            policy = user_policy.derive({'org': context.s.org})
+            policy.verify('user_add')
+        duration = time.perf_counter() - start
+        log.info("%d verify calls per second", n / duration)
+
+
 class StatisticsAuthzTest(base.AqHttpTestBase):
 
     def test_get_statistics(self):
@@ -252,3 +282,27 @@ class ExporterAuthzTest(base.AqHttpTestBase):
             (self.organisation_id, self.program_id, self.survey_id),
             method='POST', body=json_encode(submission_son),
             expected=200, decode=False)
+
+
+class MetricsAuthzTest(base.AqHttpTestBase):
+
+    def test_metrics(self):
+        '''Server metrics are only shown to super administrators'''
+        response = self.fetch(
+            "/ping/metrics.json", follow_redirects=False, expected=302)
+        self.assertIn("/login/", response.headers['Location'])
+
+        with base.mock_user('admin'):
+            response = self.fetch(
+                "/ping/metrics.json", method='GET', expected=403)
+            self.assertIn("can't view server metrics", response.reason)
+
+        with base.mock_user('super_admin'):
+            son = self.fetch(
+                "/ping/metrics.json", method='GET', expected=200,
+                decode=True)
+            self.assertIn('executors', son)
+            self.assertIn('jobs', son)
+
+        # Health checks still work without logging in
+        self.fetch("/ping", method='GET', expected=200)
@@ -7,6 +7,7 @@ import sqlalchemy as sa
 from tornado.escape import json_encode
 
 import base
+from batch_score import BatchCalculator
 import config as app_config
 import model
 import notifications
@@ -339,15 +340,142 @@ class DaemonTest(base.AqHttpTestBase):
             self.assertAlmostEqual(functions[0].qnode.total_weight, 11 + 13)
             self.assertAlmostEqual(functions[1].qnode.total_weight, 3 + 6)
 
-    def test_recalculate_failure(self):
+    def test_recalculate_preloaded(self):
+        aid = self.create_submission()
+        with model.session_scope() as session:
+            submission = session.query(model.Submission).get(aid)
+            expected = [
+                (rnode.qnode_id, rnode.score, rnode.n_final)
+                for rnode in session.query(model.ResponseNode)
+                .filter_by(submission_id=aid)
+                .order_by(model.ResponseNode.qnode_id)]
+
+            calculator = Calculator.scoring(submission, preload=True)
+            calculator.mark_entire_survey_dirty(submission.survey)
+            calculator.execute()
+
+        with model.session_scope() as session:
+            actual = [
+                (rnode.qnode_id, rnode.score, rnode.n_final)
+                for rnode in session.query(model.ResponseNode)
+                .filter_by(submission_id=aid)
+                .order_by(model.ResponseNode.qnode_id)]
+            self.assertEqual(actual, expected)
+
+    def test_recalculate_batched_rnodes(self):
+        aid = self.create_submission()
+        with model.session_scope() as session:
+            (session.query(model.ResponseNode)
+                .filter_by(submission_id=aid)
+                .delete())
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement.split()[:3])
+
+        with model.session_scope() as session:
+            submission = session.query(model.Submission).get(aid)
+            engine = session.get_bind()
+            sa.event.listen(engine, 'before_cursor_execute', count)
+            try:
+                calculator = Calculator.scoring(submission, preload=True)
+                calculator.mark_entire_survey_dirty(submission.survey)
+                calculator.execute()
+            finally:
+                sa.event.remove(engine, 'before_cursor_execute', count)
+
+            functions = list(submission.rnodes)
+            self.assertAlmostEqual(functions[0].score, 33)
+
+        # All missing rnodes are inserted together
+        self.assertEqual(statements.count(['INSERT', 'INTO', 'rnode']), 1)
+
+    def test_recalculate_batch(self):
+        aids = [self.create_submission() for _ in range(3)]
+
+        def snapshot(session):
+            rnodes = [
+                (rnode.submission_id, rnode.qnode_id, rnode.score,
+                 rnode.n_draft, rnode.n_final, rnode.n_not_relevant,
+                 rnode.n_questions, rnode.n_answers,
+                 rnode.max_importance, rnode.error)
+                for rnode in session.query(model.ResponseNode)
+                .filter(model.ResponseNode.submission_id.in_(aids))
+                .order_by(model.ResponseNode.submission_id,
+                          model.ResponseNode.qnode_id)]
+            responses = [
+                (response.submission_id, response.measure_id, response.score,
+                 response.variables, response.error)
+                for response in session.query(model.Response)
+                .filter(model.Response.submission_id.in_(aids))
+                .order_by(model.Response.submission_id,
+                          model.Response.measure_id)]
+            return rnodes, responses
+
+        # Make the submissions differ, including an invalid response that
+        # can't be scored with array operations.
+        with model.session_scope() as session:
+            submissions = [
+                session.query(model.Submission).get(aid) for aid in aids]
+            responses = list(submissions[1].ordered_responses)
+            responses[0].not_relevant = True
+            responses[1].approval = 'approved'
+            responses[2].response_parts = [{'index': 5, 'note': "Bad"}]
+            for submission in submissions:
+                calculator = Calculator.scoring(submission, preload=True)
+                calculator.mark_entire_survey_dirty(submission.survey)
+                calculator.execute()
+            expected = snapshot(session)
+
+        with model.session_scope() as session:
+            for response in (
+                    session.query(model.Response)
+                    .filter(model.Response.submission_id.in_(aids))):
+                response.score = 0.0
+                response.variables = {}
+            for rnode in (
+                    session.query(model.ResponseNode)
+                    .filter(model.ResponseNode.submission_id.in_(aids))):
+                rnode.score = 0.0
+                rnode.n_final = 0
+
+        with model.session_scope() as session:
+            submissions = [
+                session.query(model.Submission).get(aid) for aid in aids]
+            BatchCalculator(submissions[0].survey, submissions).execute()
+
+        with model.session_scope() as session:
+            self.assertEqual(snapshot(session), expected)
+            errors = [
+                session.query(model.Submission).get(aid).error
+                for aid in aids]
+            self.assertEqual(errors[0], None)
+            self.assertNotEqual(errors[1], None)
+
+    def test_recalculate_batch_failure(self):
         aid = self.create_submission()
+        self.create_submission()
+        with model.session_scope() as session:
+            submission = session.query(model.Submission).get(aid)
+            response = next(submission.ordered_responses)
+            response.response_parts = [{'index': 5, 'note': "Bad"}]
+            submission.survey.modified = datetime.datetime.utcnow()
+
+        config = utils.get_config("recalculate.yaml")
+        with mock.patch('recalculate.send', lambda *args: None):
+            count, n_errors = recalculate.process_once(config)
+        self.assertEqual(count, 2)
+        self.assertEqual(n_errors, 1)
+
+    def move_process(self, aid):
+        '''Makes the submission stale by moving a process to a new function'''
         with model.session_scope() as session:
             submission = session.query(model.Submission).get(aid)
             sid = submission.program_id
             process_id = submission.survey.qnodes[0].children[0].id
             function_2_id = submission.survey.qnodes[1].id
 
-        # Move a process (qnode) to a different function
         with base.mock_user('author'):
             url = "/qnode/{}.json?programId={}".format(process_id, sid)
             qnode_son = self.fetch(
@@ -357,6 +485,15 @@ class DaemonTest(base.AqHttpTestBase):
                 method='PUT', expected=200, decode=True,
                 body=json_encode(qnode_son))
 
+    def test_recalculate_failure(self):
+        aid = self.create_submission()
+        with model.session_scope() as session:
+            submission = session.query(model.Submission).get(aid)
+            response = next(submission.ordered_responses)
+            response.response_parts = [{'index': 5, 'note': "Bad"}]
+
+        self.move_process(aid)
+
         # Run recalculation script
         config = utils.get_config("recalculate.yaml")
         messages = None
@@ -365,9 +502,7 @@ class DaemonTest(base.AqHttpTestBase):
             messages.append(msg)
 
         messages = []
-        with mock.patch('recalculate.send', send), \
-                mock.patch('response_type.ResponseType.validate',
-                           side_effect=ResponseTypeError):
+        with mock.patch('recalculate.send', send):
             count, n_errors = recalculate.process_once(config)
             self.assertEqual(n_errors, 1)
 
@@ -380,3 +515,18 @@ class DaemonTest(base.AqHttpTestBase):
                            side_effect=UnexpectedError):
             recalculate.process_loop()
         self.assertEqual(len(messages), 1)
+
+    def test_recalculate_failure_unbatched(self):
+        aid = self.create_submission()
+        self.move_process(aid)
+
+        # Score one submission at a time, with the usual Calculator.
+        config = utils.get_config("recalculate.yaml")
+        config['BATCH_SIZE'] = 1
+
+        with mock.patch('recalculate.send', lambda *args: None), \
+                mock.patch('response_type.ResponseType.validate',
+                           side_effect=ResponseTypeError):
+            count, n_errors = recalculate.process_once(config)
+        self.assertEqual(count, 1)
+        self.assertEqual(n_errors, 1)
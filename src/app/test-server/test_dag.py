@@ -1,14 +1,25 @@
+import gc
 from itertools import repeat
+import logging
+import os
+import random
+import time
+import unittest
 
 import base
-from dag import GraphBuilder, NodeBuilder, Ops, OpsProxy
+from dag import CompiledGraph, CompiledGraphBuilder, GraphBuilder, \
+    IterativeGraphBuilder, NodeBuilder, Ops, OpsProxy
+
+
+log = logging.getLogger('app.test.test_dag')
 
 
 class DagTest(base.LoggingTestCase):
+    GraphBuilder = GraphBuilder
 
     def test_simple(self):
         '''Test evaluation of a simple arithmetic tree'''
-        builder = GraphBuilder()
+        builder = self.GraphBuilder()
         a = Value('a')
         b = Value('b')
         c = Value('c')
@@ -28,7 +39,7 @@ class DagTest(base.LoggingTestCase):
 
     def test_disparate(self):
         '''Test evaluation of two disconnected graphs in a single object'''
-        builder = GraphBuilder()
+        builder = self.GraphBuilder()
         a = Value('a')
         b = Value('b')
         ops = Sum()
@@ -45,7 +56,7 @@ class DagTest(base.LoggingTestCase):
 
     def test_proxy(self):
         '''Test replacement of operations after tree is built'''
-        builder = GraphBuilder()
+        builder = self.GraphBuilder()
         a = Value('a')
         ops = OpsProxy()
         builder.add(a).with_ops(ops)
@@ -75,7 +86,7 @@ class DagTest(base.LoggingTestCase):
         three.dependants.append(b)
         four.dependants.append(b)
 
-        builder = GraphBuilder()
+        builder = self.GraphBuilder()
         vbuilder = VBuilder()
         builder.add_with_dependants(one, vbuilder)
         builder.add_with_dependants(two, vbuilder)
@@ -106,7 +117,7 @@ class DagTest(base.LoggingTestCase):
         three.dependants.append(b)
         four.dependants.append(b)
 
-        builder = GraphBuilder()
+        builder = self.GraphBuilder()
         vbuilder = VBuilder()
         builder.add_with_dependants(one, vbuilder)
         builder.add_with_dependants(two, vbuilder)
@@ -124,6 +135,175 @@ class DagTest(base.LoggingTestCase):
         self.assertFalse(three.cyclic)
         self.assertFalse(four.cyclic)
 
+    def test_compiled(self):
+        '''Evaluate part of a graph using a compiled topology'''
+        a = Value('a')
+        b = Value('b')
+        c = Value('c')
+        one = Value('one', 1)
+        two = Value('two', 2)
+        three = Value('three', 3)
+        four = Value('four', 4)
+
+        a.dependants.append(c)
+        b.dependants.append(c)
+        one.dependants.append(a)
+        two.dependants.append(a)
+        three.dependants.append(b)
+        four.dependants.append(b)
+
+        builder = self.GraphBuilder()
+        vbuilder = VBuilder()
+        for v in (one, two, three, four):
+            builder.add_with_dependants(v, vbuilder)
+        compiled = CompiledGraph.from_builder(builder, lambda v: v.name)
+        self.assertTrue(compiled.acyclic)
+        self.assertEqual(len(compiled), 7)
+
+        values = {v.name: v for v in (a, b, c, one, two, three, four)}
+        builder = CompiledGraphBuilder(
+            compiled, lambda v: v.name, values.__getitem__, vbuilder.ops)
+        builder.add_with_dependants(one)
+        builder.add_with_dependants(two)
+        graph = builder.build()
+        self.assertEqual(
+            {meta.node for meta in graph.graph}, {one, two, a, c})
+        self.assertEqual(graph.graph[-1].node, c)
+        graph.evaluate()
+        self.assertEqual(a.value, 3)
+        self.assertEqual(b.value, 0)
+        self.assertEqual(c.value, 3)
+
+        builder = CompiledGraphBuilder(
+            compiled, lambda v: v.name, values.__getitem__, vbuilder.ops)
+        builder.add_with_dependencies(c)
+        builder.build().evaluate()
+        self.assertEqual(b.value, 7)
+        self.assertEqual(c.value, 10)
+
+    def test_compiled_cyclic(self):
+        '''Compiled graphs have the same cycle semantics'''
+        a = Value('a')
+        b = Value('b')
+        c = Value('c')
+        one = Value('one', 1)
+        three = Value('three', 3)
+
+        a.dependants.append(c)
+        a.dependants.append(one)
+        b.dependants.append(c)
+        one.dependants.append(a)
+        three.dependants.append(b)
+
+        builder = self.GraphBuilder()
+        vbuilder = VBuilder()
+        builder.add_with_dependants(one, vbuilder)
+        builder.add_with_dependants(three, vbuilder)
+        compiled = CompiledGraph.from_builder(builder, lambda v: v.name)
+        self.assertFalse(compiled.acyclic)
+
+        values = {v.name: v for v in (a, b, c, one, three)}
+        builder = CompiledGraphBuilder(
+            compiled, lambda v: v.name, values.__getitem__, vbuilder.ops)
+        builder.add_with_dependants(three)
+        builder.add_with_dependants(one)
+        builder.build().evaluate()
+
+        self.assertTrue(a.cyclic)
+        self.assertTrue(c.cyclic)
+        self.assertTrue(one.cyclic)
+        self.assertFalse(b.cyclic)
+        self.assertFalse(three.cyclic)
+
+
+class IterativeDagTest(DagTest):
+    GraphBuilder = IterativeGraphBuilder
+
+    def test_deep(self):
+        '''Build a graph that is deeper than the recursion limit'''
+        values = [Value(i, 1) for i in range(5000)]
+        for v, dependant in zip(values, values[1:]):
+            v.dependants.append(dependant)
+
+        builder = self.GraphBuilder()
+        vbuilder = VBuilder()
+        builder.add_with_dependants(values[0], vbuilder)
+        graph = builder.build()
+        graph.evaluate()
+        self.assertEqual(graph.graph[-1].depth, 4999)
+        self.assertEqual(values[-1].value, 1)
+
+
+@unittest.skipUnless(
+    os.environ.get('BENCHMARK'), "Set BENCHMARK=1 to run benchmarks")
+class DagBenchmark(base.LoggingTestCase):
+    '''
+    Compares the recursive and iterative graph builders on synthetic
+    surveys: a tree of categories with measures at the leaves, and some
+    measures depending on others.
+    '''
+
+    def test_10k(self):
+        self.compare(10000)
+
+    def test_100k(self):
+        self.compare(100000)
+
+    def compare(self, size):
+        times = {}
+        results = set()
+        for builder_class in (GraphBuilder, IterativeGraphBuilder):
+            leaves, values = synthetic_graph(size)
+            # Garbage collection pauses depend on what the previous run left
+            # behind, so keep them out of the measurement.
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                builder = builder_class()
+                vbuilder = VBuilder()
+                for leaf in leaves:
+                    builder.add_with_dependants(leaf, vbuilder)
+                graph = builder.build()
+                times[builder_class.__name__] = time.perf_counter() - start
+            finally:
+                gc.enable()
+            graph.evaluate()
+            self.assertEqual(len(graph.graph), len(values))
+            results.add(tuple(v.value for v in values))
+            del builder, graph
+        self.assertEqual(len(results), 1)
+        log.info(
+            "Built %d nodes: %s", size, ', '.join(
+                '%s: %.3fs' % item for item in sorted(times.items())))
+
+
+def synthetic_graph(size, branching=10, n_links=None):
+    '''
+    Returns:
+        The leaves, and all of the nodes (root first).
+    '''
+    rng = random.Random(size)
+    values = [Value(0)]
+    for i in range(1, size):
+        value = Value(i)
+        value.dependants.append(values[(i - 1) // branching])
+        values.append(value)
+    leaves = values[(size - 2) // branching + 1:]
+    for leaf in leaves:
+        leaf.value = 1
+
+    # Links between leaves, like measure variables. These always point to a
+    # later leaf, so there are no cycles.
+    if n_links is None:
+        n_links = len(leaves) // 10
+    for _ in range(n_links):
+        a, b = sorted(rng.sample(range(len(leaves)), 2))
+        link = Link(leaves[b])
+        leaves[a].dependants.append(link)
+        values.append(link)
+    return leaves, values
+
 
 class Value:
     def __init__(self, name, value=0):
@@ -170,3 +350,9 @@ class VSum(Ops):
 
     def cyclic(self, node, dependencies, dependants):
         node.cyclic = True
+
+
+class Link(Value):
+    def __init__(self, target):
+        super().__init__('link')
+        self.dependants.append(target)
@@ -0,0 +1,54 @@
+from threading import Event
+
+import base
+import errors
+from executors import BoundedExecutor
+
+
+class ExecutorTest(base.LoggingTestCase):
+
+    def test_back_pressure(self):
+        '''Tasks are refused when the queue is full'''
+        executor = BoundedExecutor('test', max_workers=1, max_queue=1)
+        release = Event()
+        try:
+            running = executor.submit(release.wait)
+            queued = executor.submit(lambda: 'done')
+            with self.assertRaises(errors.ServiceUnavailableError) as ec:
+                executor.submit(lambda: 'refused')
+            self.assertEqual(ec.exception.status_code, 503)
+
+            release.set()
+            self.assertTrue(running.result(timeout=5))
+            self.assertEqual(queued.result(timeout=5), 'done')
+
+            # There's room again once the queue has drained.
+            self.assertEqual(
+                executor.submit(lambda: 'accepted').result(timeout=5),
+                'accepted')
+        finally:
+            release.set()
+            executor.shutdown()
+
+        stats = executor.stats()
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['queued'], 0)
+        self.assertGreater(stats['queue_time_max'], 0)
+
+    def test_failure(self):
+        '''Exceptions are passed to the caller and counted'''
+        executor = BoundedExecutor('test', max_workers=1, max_queue=0)
+        try:
+            future = executor.submit(lambda: 1 / 0)
+            with self.assertRaises(ZeroDivisionError):
+                future.result(timeout=5)
+        finally:
+            executor.shutdown()
+
+        stats = executor.stats()
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['failed'], 1)
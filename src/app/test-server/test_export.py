@@ -0,0 +1,349 @@
+import datetime
+import os
+import tempfile
+
+import openpyxl
+import xlsxwriter
+
+import base
+import model
+from report.export import Exporter, RowBuffer
+from score import Calculator
+
+
+# More parts than there are rows in a measure's block of the nested export,
+# so the part names reach back into the rows above it.
+SEVEN_PARTS = [
+    {
+        'id': 'p%d' % i,
+        'name': "Part %d" % i,
+        'type': 'multiple_choice',
+        'options': [
+            {'score': 0.0, 'name': "No"},
+            {'score': 1.0, 'name': "Yes"},
+        ],
+    }
+    for i in range(1, 8)
+]
+
+# Deeper than the number of colours that categories are given.
+N_LEVELS = 6
+
+
+class RecordingWorksheet:
+    '''Records the order of the calls that RowBuffer makes.'''
+
+    def __init__(self):
+        self.calls = []
+
+    def write(self, row, col, *args):
+        self.calls.append(('write', row, col) + args)
+
+    def merge_range(self, first_row, first_col, last_row, last_col, *args):
+        self.calls.append(
+            ('merge_range', first_row, first_col, last_row, last_col) + args)
+
+
+class RowBufferTest(base.LoggingTestCase):
+
+    def test_overwrite(self):
+        '''The last write to a cell wins if its row hasn't been flushed'''
+        worksheet = RecordingWorksheet()
+        rows = RowBuffer(worksheet)
+        rows.write(0, 1, 'first')
+        rows.write(0, 1, 'second')
+        rows.flush()
+        self.assertEqual(worksheet.calls, [
+            ('write', 0, 1, 'first'),
+            ('write', 0, 1, 'second'),
+        ])
+
+    def test_write_flushed_row(self):
+        '''Rows that have been flushed can't be written to again'''
+        worksheet = RecordingWorksheet()
+        rows = RowBuffer(worksheet)
+        rows.write(0, 0, 'a')
+        rows.write(2, 0, 'c')
+        rows.flush(until=2)
+        self.assertEqual(worksheet.calls, [('write', 0, 0, 'a')])
+
+        with self.assertRaises(ValueError):
+            rows.write(0, 0, 'late')
+        with self.assertRaises(ValueError):
+            rows.merge_range(0, 1, 0, 3, 'late')
+
+        # Rows at or after the flush point are still open.
+        rows.write(2, 1, 'd')
+        rows.flush()
+        self.assertEqual(worksheet.calls[1:], [
+            ('write', 2, 0, 'c'),
+            ('write', 2, 1, 'd'),
+        ])
+
+    def test_flush_order(self):
+        '''Rows are written in ascending order, whatever order they came in'''
+        worksheet = RecordingWorksheet()
+        rows = RowBuffer(worksheet)
+        rows.write(5, 0, 'f')
+        rows.merge_range(1, 0, 1, 2, 'b')
+        rows.write(3, 2, 'd')
+        rows.write(1, 3, 'b2')
+        rows.flush()
+        self.assertEqual(worksheet.calls, [
+            ('merge_range', 1, 0, 1, 2, 'b'),
+            ('write', 1, 3, 'b2'),
+            ('write', 3, 2, 'd'),
+            ('write', 5, 0, 'f'),
+        ])
+
+    def test_constant_memory(self):
+        '''Cells written out of row order survive constant_memory mode'''
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'test.xlsx')
+            workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+            rows = RowBuffer(workbook.add_worksheet('Scoring'))
+            rows.write(2, 0, 'third')
+            rows.write(0, 0, 'first')
+            rows.write(1, 0, 'wrong')
+            rows.write(1, 0, 'second')
+            rows.flush()
+            workbook.close()
+
+            worksheet = openpyxl.load_workbook(path)['Scoring']
+            self.assertEqual(
+                [row[0].value for row in worksheet.iter_rows()],
+                ['first', 'second', 'third'])
+
+
+class ExportTest(base.AqModelTestBase):
+
+    def setUp(self):
+        super().setUp()
+        with model.session_scope() as session:
+            program = session.query(model.Program).one()
+            response_type = model.ResponseType(
+                program=program, name="Seven Parts", parts=SEVEN_PARTS,
+                formula=None)
+            session.add(response_type)
+
+            survey = model.Survey(
+                program=program,
+                title="Deep Survey",
+                description="Test")
+            survey.structure = {
+                'levels': [
+                    {'title': "Level %d" % (i + 1), 'label': 'L%d' % (i + 1),
+                     'has_measures': i == N_LEVELS - 1}
+                    for i in range(N_LEVELS)
+                ],
+                'measure': {'title': 'Measures', 'label': 'M'},
+            }
+            session.add(survey)
+            program.surveys.append(survey)
+
+            # Explicitly add to collections because backrefs are one-way.
+            parent = None
+            for i in range(N_LEVELS):
+                qnode = model.QuestionNode(
+                    program=program, survey=survey, parent=parent,
+                    title="Category %d" % (i + 1),
+                    description="Description %d" % (i + 1), seq=-1)
+                session.add(qnode)
+                if parent:
+                    parent.children = [qnode]
+                    parent.children.reorder()
+                else:
+                    survey.qnodes = [qnode]
+                    survey.qnodes.reorder()
+                parent = qnode
+
+            for title, weight in (("Measure A", 10), ("Measure B", 20)):
+                measure = model.Measure(
+                    program=program, title=title, weight=weight,
+                    description="%s description" % title,
+                    response_type=response_type)
+                session.add(measure)
+                model.QnodeMeasure(
+                    program=program, survey=survey, qnode=parent,
+                    measure=measure, seq=-1)
+            parent.qnode_measures.reorder()
+            session.flush()
+
+            calculator = Calculator.structural()
+            calculator.mark_entire_survey_dirty(survey)
+            calculator.execute()
+
+            clerk = (
+                session.query(model.AppUser)
+                .filter_by(email='clerk')
+                .one())
+            submission = model.Submission(
+                program=program,
+                survey=survey,
+                organisation=clerk.organisation,
+                title="Export Submission",
+                approval='final')
+            session.add(submission)
+
+            answers = {
+                "Measure A": (
+                    [1, 0, 1, 0, 1, 0, 1], datetime.datetime(2020, 1, 1)),
+                "Measure B": ([0] * 7, datetime.datetime(2020, 1, 2)),
+            }
+            for qnode_measure in parent.qnode_measures:
+                title = qnode_measure.measure.title
+                indices, modified = answers[title]
+                session.add(model.Response(
+                    qnode_measure=qnode_measure,
+                    submission=submission,
+                    user=clerk,
+                    comment="Comment %s" % title[-1],
+                    not_relevant=False,
+                    modified=modified,
+                    approval='final',
+                    response_parts=[
+                        {'index': i, 'note': ["No", "Yes"][i]}
+                        for i in indices]))
+            session.flush()
+
+            calculator = Calculator.scoring(submission)
+            calculator.mark_entire_survey_dirty(survey)
+            calculator.execute()
+
+            self.program_id = str(program.id)
+            self.survey_id = str(survey.id)
+            self.submission_id = str(submission.id)
+            self.measure_ids = {
+                qm.measure.title: str(qm.measure_id)
+                for qm in parent.qnode_measures}
+
+        # Measure A is edited, and then reviewed and approved. Each change
+        # leaves a version in the history.
+        self.update_response(
+            "Measure A", 'org_admin', 'final', datetime.datetime(2020, 2, 1))
+        self.update_response(
+            "Measure A", 'consultant', 'reviewed',
+            datetime.datetime(2020, 3, 1))
+        self.update_response(
+            "Measure A", 'authority', 'approved',
+            datetime.datetime(2020, 4, 1))
+
+    def update_response(self, measure_title, email, approval, modified):
+        with model.session_scope(version=True) as session:
+            response = (
+                session.query(model.Response)
+                .get((self.submission_id, self.measure_ids[measure_title])))
+            response.user = (
+                session.query(model.AppUser)
+                .filter_by(email=email)
+                .one())
+            response.approval = approval
+            response.modified = modified
+
+    def export(self, method_name):
+        with tempfile.TemporaryDirectory() as dir_name:
+            path = os.path.join(dir_name, 'export.xlsx')
+            method = getattr(Exporter(), method_name)
+            method(
+                path, self.program_id, self.survey_id, self.submission_id,
+                'admin', 'http://example.com')
+            return openpyxl.load_workbook(path)
+
+    def test_nested(self):
+        '''Part names reach back over earlier rows in deep surveys'''
+        worksheet = self.export('process_nested')['Scoring']
+
+        def cell(row, col):
+            return worksheet.cell(row=row + 1, column=col + 1).value
+
+        # Each category has a title row and a description row.
+        for i in range(N_LEVELS):
+            self.assertEqual(
+                cell(i * 2, 0), "1. " * (i + 1) + "Category %d" % (i + 1))
+            self.assertEqual(cell(i * 2 + 1, 1), "Description %d" % (i + 1))
+        self.assertEqual(cell(0, 2), 30)
+        self.assertAlmostEqual(cell(0, 3), 40 / 30)
+
+        numbering = "1. " * N_LEVELS
+        self.assertEqual(cell(12, 1), numbering + "1. Measure A")
+        self.assertEqual(cell(13, 0), "Description")
+        self.assertEqual(cell(13, 1), "Measure A description")
+        self.assertEqual(cell(17, 0), "Comments")
+        self.assertEqual(cell(17, 1), "Comment A")
+
+        self.assertEqual(cell(18, 1), numbering + "2. Measure B")
+        self.assertEqual(cell(23, 0), "Comments")
+        self.assertEqual(cell(23, 1), "Comment B")
+        self.assertEqual(cell(23, 2), "Not Relevant")
+        self.assertEqual(cell(23, 3), "No")
+
+        # The parts of each measure end on its comment row, so they cover the
+        # rows above it, back into the previous block. Where they overlap, the
+        # later write wins.
+        self.assertEqual(
+            [cell(row, 2) for row in range(10, 16)],
+            ["Part %d" % i for i in range(1, 7)])
+        self.assertEqual(
+            [cell(row, 3) for row in range(10, 16)],
+            ["2 - Yes", "1 - No", "2 - Yes", "1 - No", "2 - Yes", "1 - No"])
+        self.assertEqual(
+            [cell(row, 2) for row in range(16, 23)],
+            ["Part %d" % i for i in range(1, 8)])
+        self.assertEqual(
+            [cell(row, 3) for row in range(16, 23)],
+            ["1 - No"] * 7)
+
+        self.assertEqual(worksheet.max_row, 24)
+
+    def test_tabular(self):
+        '''Each approval state shows its latest version'''
+        workbook = self.export('process_tabular')
+        worksheet = workbook['Response']
+
+        def row_values(row):
+            return [c.value for c in worksheet[row + 1]]
+
+        header = row_values(0)
+        self.assertEqual(
+            header[:N_LEVELS + 1],
+            ["Level %d" % (i + 1) for i in range(N_LEVELS)] + ["Measure"])
+        self.assertEqual(
+            header[N_LEVELS + 1:N_LEVELS + 8],
+            ["Part %d" % i for i in range(1, 8)])
+        approval_col = header.index("Final Report By")
+        self.assertEqual(header[approval_col:approval_col + 6], [
+            "Final Report By", "Final Report Date",
+            "Review By", "Reviewed Date",
+            "Approved By", "Approved Date",
+        ])
+        score_col = header.index("Score")
+        comment_col = header.index("Comment")
+
+        row = row_values(1)
+        self.assertEqual(
+            row[:N_LEVELS + 1],
+            ["1. Category %d" % (i + 1) for i in range(N_LEVELS)] +
+            ["1. Measure A"])
+        self.assertEqual(row[N_LEVELS + 1:N_LEVELS + 8], [
+            "2 - Yes", "1 - No", "2 - Yes", "1 - No", "2 - Yes", "1 - No",
+            "2 - Yes"])
+        # The final version is the later of the two in the history.
+        self.assertEqual(row[approval_col:approval_col + 6], [
+            "Org Admin", datetime.datetime(2020, 2, 1),
+            "Consultant", datetime.datetime(2020, 3, 1),
+            "Authority", datetime.datetime(2020, 4, 1),
+        ])
+        self.assertEqual(row[score_col], 40)
+        self.assertEqual(row[comment_col], "Comment A; ")
+
+        row = row_values(2)
+        self.assertEqual(row[N_LEVELS], "2. Measure B")
+        self.assertEqual(row[approval_col:approval_col + 6], [
+            "Clerk", datetime.datetime(2020, 1, 2),
+            None, None,
+            None, None,
+        ])
+        self.assertEqual(row[score_col], 0)
+
+        worksheet = workbook['Metadata']
+        self.assertEqual(worksheet['B4'].value, "Export Submission")
@@ -0,0 +1,217 @@
+import logging
+
+import base
+import errors
+from importer.sub_import import ImportSubmissionHandler
+import model
+from score import Calculator
+
+
+log = logging.getLogger('app.test.test_import')
+
+
+YES_NO_PARTS = [
+    {
+        'id': part_id,
+        'type': 'multiple_choice',
+        'options': [
+            {'score': 0.0, 'name': "No"},
+            {'score': 1.0, 'name': "Yes"},
+        ],
+    }
+    for part_id in 'abcd'
+]
+
+
+class SubmissionImportTest(base.AqModelTestBase):
+
+    def setUp(self):
+        super().setUp()
+        # The import doesn't use the request, so the handler doesn't need to
+        # be initialised.
+        self.handler = object.__new__(ImportSubmissionHandler)
+
+        # The importer expects three levels of categories, and four parts
+        # per response.
+        with model.session_scope() as session:
+            program = session.query(model.Program).one()
+            response_type = model.ResponseType(
+                program=program, name="Four Parts", parts=YES_NO_PARTS,
+                formula=None)
+            session.add(response_type)
+
+            survey = model.Survey(
+                program=program,
+                title="Import Survey",
+                description="Test")
+            survey.structure = {
+                'levels': [
+                    {'title': 'Functions', 'label': 'F',
+                     'has_measures': False},
+                    {'title': 'Processes', 'label': 'P',
+                     'has_measures': False},
+                    {'title': 'Subprocesses', 'label': 'S',
+                     'has_measures': True},
+                ],
+                'measure': {'title': 'Measures', 'label': 'M'},
+            }
+            session.add(survey)
+            program.surveys.append(survey)
+
+            def create_qnode(title, parent=None):
+                qnode = model.QuestionNode(
+                    program=program, survey=survey, parent=parent,
+                    title=title, description="Test", seq=-1)
+                session.add(qnode)
+                if parent:
+                    parent.children.append(qnode)
+                else:
+                    survey.qnodes.append(qnode)
+                return qnode
+
+            def create_measure(qnode, title, weight):
+                measure = model.Measure(
+                    program=program, title=title, weight=weight,
+                    response_type=response_type)
+                session.add(measure)
+                model.QnodeMeasure(
+                    program=program, survey=survey, qnode=qnode,
+                    measure=measure, seq=-1)
+
+            function = create_qnode("Function 1")
+            process = create_qnode("Process 1", function)
+            subprocess_1 = create_qnode("Subprocess 1", process)
+            subprocess_2 = create_qnode("Subprocess 2", process)
+            create_measure(subprocess_1, "Measure A\nDetails", 10)
+            create_measure(subprocess_1, "Measure B", 20)
+            create_measure(subprocess_2, "Measure C", 5)
+            for qnode in (function, process, subprocess_1, subprocess_2):
+                qnode.children.reorder()
+                qnode.qnode_measures.reorder()
+            survey.qnodes.reorder()
+            session.flush()
+
+            calculator = Calculator.structural()
+            calculator.mark_entire_survey_dirty(survey)
+            calculator.execute()
+
+    def rows(self):
+        # Rows as read from the sheet, without the header. The last row is
+        # ignored by the importer.
+        return [
+            ["1 Function 1", "1.1 Process 1", "1.1.1 Subprocess 1",
+             "1.1.1.1 Measure A", "Yes", "No", "Yes", "Yes",
+             '', '', "Comment A"],
+            ["1 Function 1", "1.1 Process 1", "1.1.1 Subprocess 1",
+             "1.1.1.2 Measure B", "No", "No", "y es", "No",
+             '', '', "Comment B"],
+            ["1 Function 1", "1.1 Process 1", "1.1.2 Subprocess 2",
+             "1.1.2.1 Measure C", "Yes", "Yes", "Yes", "Yes",
+             '', '', ''],
+            ["Footer"],
+        ]
+
+    def import_rows(self, session, rows):
+        survey = (
+            session.query(model.Survey)
+            .filter_by(title="Import Survey")
+            .one())
+        user = (
+            session.query(model.AppUser)
+            .filter_by(email='clerk')
+            .one())
+        submission = model.Submission(
+            program=survey.program,
+            survey=survey,
+            organisation=user.organisation,
+            title="Imported",
+            approval='draft')
+        session.add(submission)
+        session.flush()
+        self.handler.process_submission_file(rows, session, submission, user)
+        return submission
+
+    def test_import(self):
+        with model.session_scope() as session:
+            submission = self.import_rows(session, self.rows())
+            submission_id = submission.id
+
+        with model.session_scope() as session:
+            submission = session.query(model.Submission).get(submission_id)
+            responses = {
+                r.measure.title.split('\n')[0]: r
+                for r in submission.responses}
+            self.assertEqual(
+                sorted(responses), ["Measure A", "Measure B", "Measure C"])
+
+            response = responses["Measure A"]
+            self.assertEqual(response.response_parts, [
+                {'index': 1, 'note': "Yes"},
+                {'index': 0, 'note': "No"},
+                {'index': 1, 'note': "Yes"},
+                {'index': 1, 'note': "Yes"},
+            ])
+            self.assertEqual(response.comment, "Comment A")
+            self.assertEqual(response.approval, 'draft')
+            self.assertEqual(response.user.email, 'clerk')
+            self.assertEqual(response.score, 30)
+            self.assertIs(response.error, None)
+
+            # Options are matched regardless of case and spaces.
+            response = responses["Measure B"]
+            self.assertEqual(
+                [part['index'] for part in response.response_parts],
+                [0, 0, 1, 0])
+            self.assertEqual(response.score, 20)
+
+            response = responses["Measure C"]
+            self.assertEqual(response.score, 20)
+
+            rnodes = {
+                rnode.qnode.title: rnode for rnode in (
+                    session.query(model.ResponseNode)
+                    .filter_by(submission_id=submission_id))}
+            self.assertEqual(
+                sorted(rnodes),
+                ["Function 1", "Process 1", "Subprocess 1", "Subprocess 2"])
+            self.assertEqual(rnodes["Subprocess 1"].score, 50)
+            self.assertEqual(rnodes["Subprocess 2"].score, 20)
+            self.assertEqual(rnodes["Process 1"].score, 70)
+            self.assertEqual(rnodes["Function 1"].score, 70)
+            self.assertEqual(rnodes["Function 1"].n_draft, 3)
+            self.assertIs(submission.error, None)
+
+    def test_bad_rows(self):
+        '''All of the rows that can't be imported are reported together'''
+        rows = self.rows()
+        rows[0][1] = "1.1 No Such Process"
+        rows[1][5] = "Maybe"
+        rows[2][3] = "1.1.2.1 No Such Measure"
+
+        with model.session_scope() as session:
+            with self.assertRaises(errors.ModelError) as ec:
+                self.import_rows(session, rows)
+            message = ec.exception.reason
+            self.assertIn("Could not import 3 row(s)", message)
+            self.assertIn(
+                "Row 2: 1.1 No Such Process: Survey structure does not match",
+                message)
+            self.assertIn(
+                "Row 3: 1.1.1.2 Measure B: Response 2: 'Maybe' is not a "
+                "valid option", message)
+            self.assertIn(
+                "Row 4: 1.1.2.1 No Such Measure: This survey does not match "
+                "the target survey", message)
+            self.assertEqual(session.query(model.Response).count(), 0)
+
+    def test_duplicate_rows(self):
+        '''A measure can only be imported once'''
+        rows = self.rows()
+        rows[2] = list(rows[0])
+
+        with model.session_scope() as session:
+            with self.assertRaises(errors.ModelError) as ec:
+                self.import_rows(session, rows)
+            self.assertIn(
+                "Row 4: 1.1.1.1 Measure A: Same measure as row 2",
+                ec.exception.reason)
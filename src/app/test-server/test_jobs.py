@@ -0,0 +1,60 @@
+from threading import Event
+
+import base
+from executors import BoundedExecutor
+import jobs
+
+
+class JobTest(base.LoggingTestCase):
+
+    def test_progress(self):
+        '''Jobs report their current step while they run'''
+        executor = BoundedExecutor('test', max_workers=1, max_queue=0)
+        started = Event()
+        release = Event()
+
+        def task(job, value):
+            job.advance("first")
+            job.advance("second")
+            started.set()
+            release.wait()
+            return value
+
+        try:
+            future = jobs.run(executor, 'test job', 3, task, 'done')
+            self.assertTrue(started.wait(timeout=5))
+            son = [j for j in jobs.stats() if j['name'] == 'test job'][-1]
+            self.assertEqual(son['state'], 'running')
+            self.assertEqual(son['step'], "second")
+            self.assertEqual(son['done'], 1)
+            self.assertEqual(son['total'], 3)
+
+            release.set()
+            self.assertEqual(future.result(timeout=5), 'done')
+        finally:
+            release.set()
+            executor.shutdown()
+
+        job = jobs.get(son['id'])
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.n_done, 3)
+
+    def test_failure(self):
+        '''Failed jobs keep their error'''
+        executor = BoundedExecutor('test', max_workers=1, max_queue=0)
+
+        def task(job):
+            job.advance("dividing")
+            return 1 / 0
+
+        try:
+            future = jobs.run(executor, 'failing job', 1, task)
+            with self.assertRaises(ZeroDivisionError):
+                future.result(timeout=5)
+        finally:
+            executor.shutdown()
+
+        son = [j for j in jobs.stats() if j['name'] == 'failing job'][-1]
+        self.assertEqual(son['state'], 'failed')
+        self.assertEqual(son['step'], "dividing")
+        self.assertEqual(son['error'], 'ZeroDivisionError')
@@ -8,8 +8,9 @@ from tornado.escape import json_encode
 
 import base
 import model
+import response_type
 from response_type import ResponseType, ResponseError
-from score import Calculator
+from score import Calculator, count_answers
 
 
 log = logging.getLogger('app.test.test_response')
@@ -236,6 +237,77 @@ class ResponseTypeTest(base.LoggingTestCase):
         self.assertCountEqual(rt.free_vars, ['a', 'ext'])
         self.assertCountEqual(rt.unbound_vars, ['ext'])
 
+    def test_compiled_expressions(self):
+        expressions = [
+            '(a + b) * 0.5', 'a >= 0.5 and b < 2 or a == 3', '-a - -b',
+            'max(a, b, 2) / ext', 'median(a, b, ext)', 'a ^ 2 % 3',
+            'sqrt(abs(a))', 'max(a)', 'a / 0', 'undefined + 1', "'x' || a",
+        ]
+        scopes = [
+            {'a': 1, 'b': 2, 'ext': 4},
+            {'a': 0, 'b': -1.5, 'ext': 0},
+            {'a': 'x', 'b': 2},
+            {},
+        ]
+
+        def outcome(expression, scope):
+            try:
+                return expression.evaluate(scope)
+            except Exception as e:
+                return type(e), str(e)
+
+        for text in expressions:
+            interpreted = response_type.parser.parse(text)
+            compiled = response_type.parse(text)
+            self.assertIs(compiled, response_type.parse(text))
+            self.assertEqual(compiled.variables(), interpreted.variables())
+            for scope in scopes:
+                self.assertEqual(
+                    outcome(compiled, scope), outcome(interpreted, scope),
+                    "%s with %s" % (text, scope))
+
+    def test_response_type_cache(self):
+        cache = response_type.ResponseTypeCache()
+        t = TEST_RESPONSE_TYPES[1]
+        definition = model.ResponseType(
+            id='a2a8c80e-0ae9-4caf-9d0f-9a4e7a6bd0c3',
+            program_id='a8c3d8f4-ee52-4d22-8e2c-a2d6f4c0a1f1',
+            name=t['name'], parts=t['parts'], formula=t['formula'])
+
+        rt = cache.get(definition)
+        self.assertIs(cache.get(definition), rt)
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+        # Changing the definition gives it a new version stamp
+        definition.formula = 'a + b'
+        self.assertIsNot(cache.get(definition), rt)
+        self.assertEqual(cache.get(definition).formula.toString(), '(a+b)')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        cache.invalidate(definition)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_count_answers(self):
+        parts = [
+            {'id': 'a', 'submeasure_seq': 1},
+            {'id': 'b', 'submeasure_seq': 1},
+            {'id': 'c', 'submeasure_seq': 2},
+            {'id': 'd', 'submeasure_seq': 3},
+        ]
+        self.assertEqual(count_answers(parts, []), (0, 0))
+        self.assertEqual(count_answers(parts, [
+            {'index': 0}, {'value': 1}, {'index': 1}, {'index': 0},
+        ]), (3, 3))
+        # An unanswered part leaves its submeasure unanswered. The last
+        # submeasure is only counted when it has been answered.
+        self.assertEqual(count_answers(parts, [
+            {'index': 0}, {}, {'index': 1}, {'note': 'x'},
+        ]), (2, 1))
+        # Missing parts are unanswered
+        self.assertEqual(count_answers(parts, [
+            {'index': 0}, {'value': 1}, {'index': 1},
+        ]), (2, 2))
+
 
 class SubmissionTest(base.AqHttpTestBase):
     def test_create(self):
@@ -663,3 +735,82 @@ class SubmissionTest(base.AqHttpTestBase):
                     self.assertEqual(a1.file_name, a2.file_name)
                     self.assertEqual(a1.url, a2.url)
                     self.assertEqual(a1.blob, a2.blob)
+
+    def test_promote(self):
+        '''Raising a submission's approval raises its responses' too'''
+        with model.session_scope() as session:
+            user = (
+                session.query(model.AppUser)
+                .filter_by(email='clerk')
+                .one())
+            survey = (
+                session.query(model.Survey)
+                .filter_by(title='Survey 1')
+                .one())
+
+            submission = self.create_submission(survey, user)
+            submission_id = str(submission.id)
+            old_versions = {
+                str(r.measure_id): r.version for r in submission.responses}
+            self.assertEqual(len(old_versions), 6)
+            self.assertTrue(all(
+                r.approval == 'final' for r in submission.responses))
+            self.assertEqual(list(submission.rnodes)[0].n_final, 4)
+            self.assertEqual(list(submission.rnodes)[0].n_reviewed, 0)
+
+        with base.mock_user('consultant'):
+            submission_son = self.fetch(
+                "/submission/%s.json" % submission_id, method='GET',
+                expected=200, decode=True)
+            self.fetch(
+                "/submission/%s.json?approval=reviewed" % submission_id,
+                method='PUT', body=json_encode(submission_son),
+                expected=200, decode=True)
+
+        with model.session_scope() as session:
+            submission = (
+                session.query(model.Submission)
+                .get(submission_id))
+            self.assertEqual(submission.approval, 'reviewed')
+
+            responses = submission.responses
+            self.assertEqual(len(responses), 6)
+            for response in responses:
+                old_version = old_versions[str(response.measure_id)]
+                self.assertEqual(response.approval, 'reviewed')
+                self.assertEqual(response.version, old_version + 1)
+
+            # One history row per response, holding the state it had before
+            # it was promoted.
+            ResponseHistory = model.ResponseHistory
+            history = (
+                session.query(ResponseHistory)
+                .filter(ResponseHistory.submission_id == submission_id,
+                        ResponseHistory.approval == 'final')
+                .all())
+            self.assertEqual(
+                sorted((str(h.measure_id), h.version) for h in history),
+                sorted(old_versions.items()))
+
+            # The counts of the categories are updated, but the scores
+            # aren't changed by the approval state.
+            rnodes = list(submission.rnodes)
+            self.assertEqual(rnodes[0].n_draft, 4)
+            self.assertEqual(rnodes[0].n_final, 4)
+            self.assertEqual(rnodes[0].n_reviewed, 4)
+            self.assertEqual(rnodes[0].n_approved, 0)
+            self.assertEqual(rnodes[1].n_reviewed, 0)
+            self.assertEqual(rnodes[0].score, 33)
+
+            # The promotion is recorded once for the whole submission.
+            activities = (
+                session.query(model.Activity)
+                .filter(model.Activity.ob_type == 'submission')
+                .all())
+            messages = [a.message for a in activities]
+            self.assertIn(
+                "First submission: 6 response(s) set to reviewed", messages)
+            self.assertEqual(
+                session.query(model.Activity)
+                .filter(model.Activity.ob_type == 'response')
+                .count(), 0)
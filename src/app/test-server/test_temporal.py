@@ -0,0 +1,98 @@
+import numpy as np
+
+import base
+from report.sub_temporal import STATISTIC_NAMES, STATS_BLOCK_SIZE, \
+    TableMeta, TemporalReportHandler
+
+
+def make_table_meta(part_lengths, n_organisations, n_buckets):
+    return TableMeta(
+        [], None, None, part_lengths,
+        ['org %d' % i for i in range(n_organisations)],
+        ['bucket %d' % i for i in range(n_buckets)],
+        None)
+
+
+class TemporalStatsTest(base.LoggingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # The statistics methods don't use the request, so the handler
+        # doesn't need to be initialised.
+        self.handler = object.__new__(TemporalReportHandler)
+
+    def test_compute_stats(self):
+        '''Statistics match numpy's, ignoring NaNs'''
+        min_constituents = 3
+        rng = np.random.RandomState(0)
+        values = rng.uniform(0, 100, size=(5, 8, 4))
+        values[rng.uniform(size=values.shape) < 0.3] = np.nan
+        # Some slices with too few or no constituents
+        values[1, :, 0] = np.nan
+        values[2, 2:, 1] = np.nan
+        values[3, 3:, 2] = np.nan
+
+        stats = self.handler.compute_stats(values, min_constituents)
+        self.assertEqual(len(stats), len(STATISTIC_NAMES))
+
+        n_cut = 0
+        for row_i in range(values.shape[0]):
+            for bucket_i in range(values.shape[2]):
+                vs = values[row_i, :, bucket_i]
+                vs = vs[~np.isnan(vs)]
+                actual = [stat[row_i][bucket_i] for stat in stats]
+                if len(vs) < min_constituents:
+                    n_cut += 1
+                    self.assertEqual(actual, [None] * 5 + [0])
+                    continue
+                expected = [
+                    np.min(vs),
+                    np.percentile(vs, 25),
+                    np.percentile(vs, 50),
+                    np.percentile(vs, 75),
+                    np.max(vs),
+                ]
+                for a, e in zip(actual, expected):
+                    self.assertAlmostEqual(a, e)
+                self.assertEqual(actual[-1], len(vs))
+
+        self.assertGreaterEqual(n_cut, 2)
+
+    def test_compute_stats_single(self):
+        '''A single constituent is its own min, quartiles and max'''
+        values = np.array([[[np.nan], [7.0], [np.nan]]])
+        stats = self.handler.compute_stats(values, 1)
+        self.assertEqual(stats, [[[7.0]]] * 5 + [[[1]]])
+
+    def test_blocks(self):
+        '''Measures are split into blocks of at most STATS_BLOCK_SIZE cells'''
+        n_cols = 4 * 2
+        rows_per_block = STATS_BLOCK_SIZE // n_cols
+        half = rows_per_block // 2
+        # Each measure has a row for its score as well as one for each part.
+        part_lengths = [half - 1] * 5 + [rows_per_block * 2, 0, 3]
+        table_meta = make_table_meta(part_lengths, 4, 2)
+
+        blocks = list(self.handler.get_blocks(table_meta))
+        self.assertEqual(blocks, [(0, 2), (2, 4), (4, 5), (5, 6), (6, 8)])
+
+        # Blocks are contiguous and cover every measure
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], len(part_lengths))
+        for (_, stop), (start, _) in zip(blocks, blocks[1:]):
+            self.assertEqual(stop, start)
+
+        # Only a measure that is too big on its own can exceed the limit
+        for start, stop in blocks:
+            n_cells = sum(n + 1 for n in part_lengths[start:stop]) * n_cols
+            if stop - start > 1:
+                self.assertLessEqual(n_cells, STATS_BLOCK_SIZE)
+
+    def test_blocks_small(self):
+        '''Small tables are summarised in one block'''
+        table_meta = make_table_meta([0, 2, 1], 3, 5)
+        self.assertEqual(
+            list(self.handler.get_blocks(table_meta)), [(0, 3)])
+
+        table_meta = make_table_meta([], 3, 5)
+        self.assertEqual(list(self.handler.get_blocks(table_meta)), [])
@@ -240,3 +240,30 @@ class ConversionTest(base.LoggingTestCase):
         }
         to_son = ToSon(r'/safe_html$', r'</strip.*$', r'^/a_dict$')
         self.assertEqual(output, to_son(input))
+
+    def test_son_path_index(self):
+        # Expressions ending in a literal field name are looked up by name;
+        # the full path must still match.
+        input = {
+            'a/b': 1,
+            'b': 2,
+            'c': [{'b': 3, 'd': 4}, {'b': 5, 'd': 6}],
+        }
+        output = {
+            'a/b': 1,
+            'c': [{'b': 3}, {'b': 5, 'd': 6}],
+        }
+        to_son = ToSon(
+            r'^/a/b$',
+            r'/c$',
+            r'/[0-9]+$',
+            r'/c/[0-9]+/b$',
+            r'/c/1/d$',
+            omit=True)
+        self.assertEqual(output, to_son(input))
+
+        # Members of instances are found as well as class attributes
+        node = TestNode(int_col=1)
+        node.extra = 'foo'
+        to_son = ToSon(r'/int_col$', r'/extra$', omit=True)
+        self.assertEqual({'intCol': 1, 'extra': 'foo'}, to_son(node))